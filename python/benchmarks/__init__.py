@@ -0,0 +1,19 @@
+"""
+Benchmark suite of ingestion, query and rendering hot paths.
+
+Cases run against local stub of GIOŚ API (testing.StubGiosServer)
+and PostgreSQL/PostGIS benchmark DataBase seeded with synthetic
+stations, sensors and hourly readings (see seed module).
+DataBase and Django cases are skipped when they are not available.
+
+Results are written as JSON to benchmarks/results, runs of different
+commits are compared with 'compare' command.
+
+Example:
+    $ cd python
+    $ createdb haqs_bench
+    $ python -m benchmarks seed --years 2
+    $ python -m benchmarks run --repeat 5
+    $ DJANGO_SETTINGS_MODULE=webapp.settings python -m benchmarks run query
+    $ python -m benchmarks compare results/<baseline>.json results/<current>.json
+"""
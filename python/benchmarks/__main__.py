@@ -0,0 +1,117 @@
+"""
+Command line of benchmark suite, see benchmarks package.
+"""
+import argparse
+import sys
+
+import psycopg2
+
+from . import cases
+from .runner import RESULTS_DIR, compare_results, registered_cases, run_cases, save_results
+
+
+def seed(args):
+    from haqs_api.testing import StubGiosServer
+
+    from .seed import seed_database
+
+    server = StubGiosServer.synthetic(n_stations=args.stations,
+                                      sensors_per_station=args.sensors_per_station,
+                                      seed=args.seed)
+    conn = psycopg2.connect(args.dsn or cases.bench_dsn())
+    try:
+        stats = seed_database(conn, server, years=args.years, seed=args.seed, force=args.force)
+    finally:
+        conn.close()
+    print("seeded {stations} stations, {sensors} sensors and {readings} readings "
+          "in {seconds:.1f}s".format(**stats))
+    return 0
+
+
+def run(args):
+    context = cases.Context(n_stations=args.stations,
+                            sensors_per_station=args.sensors_per_station,
+                            latency=args.latency,
+                            insert_rows=args.insert_rows,
+                            legacy_insert_rows=args.legacy_insert_rows,
+                            max_workers=args.workers,
+                            dsn=args.dsn,
+                            seed=args.seed)
+    context.repeat = args.repeat
+    context.warmup = args.warmup
+    if context.db_error:
+        print("DataBase cases skipped: {}".format(context.db_error))
+    try:
+        results = run_cases(context, registered_cases(args.cases),
+                            repeat=args.repeat, warmup=args.warmup)
+    finally:
+        context.close()
+
+    parameters = {key: value for key, value in vars(args).items()
+                  if key not in ("func", "dsn", "output")}
+    path = save_results(results, parameters, args.output)
+    print("results saved to {}".format(path))
+    return 0
+
+
+def compare(args):
+    rows, regressions = compare_results(args.baseline, args.current, args.threshold)
+    print("{:<40} {:>12} {:>12} {:>8}".format("case", "baseline ms", "current ms", "ratio"))
+    for name, baseline, current, ratio in rows:
+        print("{:<40} {:>12.2f} {:>12.2f} {:>8.2f}{}".format(
+            name, baseline * 1e3, current * 1e3, ratio, "  !" if name in regressions else ""))
+    if regressions:
+        print("{} case(s) slower by more than {:.0%}".format(len(regressions), args.threshold))
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Benchmarks of haqs_api and webapp hot paths.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    def add_data_arguments(subparser):
+        subparser.add_argument("--stations", type=int, default=250)
+        subparser.add_argument("--sensors-per-station", type=int, default=4)
+        subparser.add_argument("--seed", type=int, default=0)
+        subparser.add_argument("--dsn", default=None,
+                               help="benchmark DataBase, default HAQS_BENCH_DATABASE_URL "
+                                    "or HAQS_DB_* settings with haqs_bench DataBase")
+
+    seed_parser = subparsers.add_parser("seed", help="create and fill benchmark DataBase")
+    add_data_arguments(seed_parser)
+    seed_parser.add_argument("--years", type=float, default=1)
+    seed_parser.add_argument("--force", action="store_true",
+                             help="allow DataBase which name does not contain 'bench'")
+    seed_parser.set_defaults(func=seed)
+
+    run_parser = subparsers.add_parser("run", help="run benchmark cases")
+    add_data_arguments(run_parser)
+    run_parser.add_argument("cases", nargs="*",
+                            help="case names or groups (ingestion, query, rendering), all by default")
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--warmup", type=int, default=1)
+    run_parser.add_argument("--latency", type=float, default=0.01,
+                            help="stub API response delay in seconds")
+    run_parser.add_argument("--workers", type=int, default=16)
+    run_parser.add_argument("--insert-rows", type=int, default=20000)
+    run_parser.add_argument("--legacy-insert-rows", type=int, default=1000)
+    run_parser.add_argument("--output", default=None,
+                            help="results file, default {}/<timestamp>-<commit>.json".format(RESULTS_DIR))
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="relative slowdown reported as regression")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+"""
+Benchmark cases of ingestion, query and rendering hot paths.
+
+Every case function gets Context and returns callable which
+is timed by runner.measure(). Inserting cases write readings
+dated before BACKFILL_BEFORE (far before seeded history), so they
+do not change latest readings used by query cases, and they are
+removed by Context.close().
+"""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from haqs_api import haqs_api, http_cache
+from haqs_api.db import dsn_from_env
+from haqs_api.harvester import Harvester
+from haqs_api.ingest import bulk_insert_readings
+from haqs_api.testing import StubGiosServer
+
+from .runner import Skip, case
+
+WEBAPP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                          "webapp")
+
+BACKFILL_START = datetime(1990, 1, 1)
+BACKFILL_BEFORE = "2000-01-01"
+
+
+def bench_dsn(environ=None):
+    """
+    Function returns connection string of benchmark DataBase,
+    HAQS_BENCH_DATABASE_URL or HAQS_DB_* settings
+    with HAQS_BENCH_DB_NAME (default 'haqs_bench') DataBase.
+    """
+    environ = os.environ if environ is None else environ
+    if environ.get("HAQS_BENCH_DATABASE_URL"):
+        return environ["HAQS_BENCH_DATABASE_URL"]
+    environ = {key: value for key, value in environ.items() if key != "HAQS_DATABASE_URL"}
+    environ["HAQS_DB_NAME"] = environ.get("HAQS_BENCH_DB_NAME", "haqs_bench")
+    return dsn_from_env(environ)
+
+
+@contextmanager
+def legacy_api_urls(url):
+    """
+    Context manager points request URLs of haqs_api
+    module functions at stub server.
+    """
+    names = ("stations_request", "sensors_request", "data_request", "aq_index_request")
+    saved = {name: getattr(haqs_api, name) for name in names}
+    haqs_api.stations_request = url + "station/findAll"
+    haqs_api.sensors_request = url + "station/sensors/"
+    haqs_api.data_request = url + "data/getData/"
+    haqs_api.aq_index_request = url + "aqindex/getIndex/"
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(haqs_api, name, value)
+
+
+class Context(object):
+    """
+    Shared state of benchmark run: stub GIOŚ server, harvester,
+    DataBase connection (None when DataBase is not available)
+    and sizes of measured workloads.
+    """
+
+    def __init__(self, n_stations=250, sensors_per_station=4, n_hours=72, latency=0.01,
+                 insert_rows=20000, legacy_insert_rows=1000, max_workers=16,
+                 dsn=None, seed=0):
+        http_cache.disable()
+        self.server = StubGiosServer.synthetic(n_stations=n_stations,
+                                               sensors_per_station=sensors_per_station,
+                                               n_hours=n_hours, latency=latency,
+                                               seed=seed).start()
+        self.harvester = Harvester(self.server.url, max_workers=max_workers)
+        self.stations_json = self.server.stations
+        self.n_stations = len(self.stations_json)
+        self.sensors_df = self.harvester.create_sensors_df(self.stations_json)
+        self.n_sensors = len(self.sensors_df)
+        self.insert_rows = insert_rows
+        self.legacy_insert_rows = legacy_insert_rows
+        self.tmp_dir = tempfile.mkdtemp(prefix="haqs_bench_")
+        self._next_hour = 0
+
+        self.conn = None
+        self.db_error = None
+        try:
+            self.conn = psycopg2.connect(dsn or bench_dsn())
+        except psycopg2.Error as e:
+            self.db_error = str(e).strip()
+        self.django_error = self._setup_django()
+
+    def _setup_django(self):
+        if not os.environ.get("DJANGO_SETTINGS_MODULE"):
+            return "DJANGO_SETTINGS_MODULE is not set"
+        if WEBAPP_DIR not in sys.path:
+            sys.path.insert(0, WEBAPP_DIR)
+        try:
+            import django
+
+            django.setup()
+        except Exception as e:
+            return "{}: {}".format(type(e).__name__, e)
+        return None
+
+    def available(self, requirement):
+        if requirement == "db":
+            return self.conn is not None
+        if requirement == "django":
+            return self.django_error is None
+        return False
+
+    def backfill_records(self, count):
+        """
+        Function returns count new (sensor_id, date, reading)
+        records dated before BACKFILL_BEFORE.
+        """
+        sensor_ids = self.sensors_df["sensor_id"].tolist()
+        records = []
+        for position in range(count):
+            hour = self._next_hour + position // len(sensor_ids)
+            date = BACKFILL_START + timedelta(hours=hour)
+            records.append((sensor_ids[position % len(sensor_ids)],
+                            date.strftime("%Y-%m-%d %H:%M:%S"), float(position % 97)))
+        self._next_hour += count // len(sensor_ids) + 1
+        return records
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.rollback()
+            cur = self.conn.cursor()
+            cur.execute("DELETE FROM readings WHERE ts < %s;", (BACKFILL_BEFORE,))
+            cur.execute("SELECT to_regclass('public.anomaly_state') IS NOT NULL;")
+            if cur.fetchone()[0]:
+                cur.execute("DELETE FROM reading_flags WHERE ts < %s;", (BACKFILL_BEFORE,))
+                cur.execute("DELETE FROM anomaly_state WHERE ts < %s;", (BACKFILL_BEFORE,))
+            cur.execute("SELECT to_regclass('public.readings_hourly') IS NOT NULL;")
+            if cur.fetchone()[0]:
+                from haqs_api.rollups import GRAINS
+
+                for _, sensor_table, parameter_table, _ in GRAINS:
+                    for table in (sensor_table, parameter_table):
+                        cur.execute("DELETE FROM public.{} WHERE bucket < %s;".format(table),
+                                    (BACKFILL_BEFORE,))
+            self.conn.commit()
+            self.conn.close()
+        self.harvester.close()
+        self.server.stop()
+
+
+def _batches(context, count, rows):
+    batches = iter([context.backfill_records(rows) for _ in range(count)])
+    return lambda: next(batches)
+
+
+"""INGESTION"""
+
+
+@case("harvester.create_sensors_df", "ingestion", items="n_stations")
+def harvester_create_sensors_df(context):
+    return lambda: context.harvester.create_sensors_df(context.stations_json)
+
+
+@case("haqs_api.create_sensors_df", "ingestion", items="n_stations")
+def legacy_create_sensors_df(context):
+    def run():
+        with legacy_api_urls(context.server.url):
+            haqs_api.create_sensors_df(context.stations_json)
+    return run
+
+
+@case("harvester.get_latest_sensors_readings", "ingestion", items="n_sensors")
+def harvester_latest_readings(context):
+    return lambda: context.harvester.get_latest_sensors_readings(context.sensors_df.copy())
+
+
+@case("haqs_api.get_latest_sensors_readings", "ingestion", items="n_sensors")
+def legacy_latest_readings(context):
+    def run():
+        with legacy_api_urls(context.server.url):
+            haqs_api.get_latest_sensors_readings(context.sensors_df.copy())
+    return run
+
+
+@case("db_insert_sensor_readings", "ingestion", items="legacy_insert_rows", requires=("db",))
+def legacy_insert(context):
+    next_batch = _batches(context, context.repeat + context.warmup, context.legacy_insert_rows)
+
+    def run():
+        for record in next_batch():
+            haqs_api.db_insert_sensor_readings(context.conn, *record)
+    return run
+
+
+@case("bulk_insert_readings", "ingestion", items="insert_rows", requires=("db",))
+def bulk_insert(context):
+    next_batch = _batches(context, context.repeat + context.warmup, context.insert_rows)
+    return lambda: bulk_insert_readings(context.conn, next_batch(), refresh_latest=False,
+                                        update_rollups=False, detect_anomalies=False)
+
+
+@case("bulk_insert_readings[anomaly]", "ingestion", items="insert_rows", requires=("db",))
+def bulk_insert_with_anomaly(context):
+    next_batch = _batches(context, context.repeat + context.warmup, context.insert_rows)
+    return lambda: bulk_insert_readings(context.conn, next_batch(), refresh_latest=False,
+                                        update_rollups=False)
+
+
+@case("bulk_insert_readings[rollups]", "ingestion", items="insert_rows", requires=("db",))
+def bulk_insert_with_rollups(context):
+    next_batch = _batches(context, context.repeat + context.warmup, context.insert_rows)
+    return lambda: bulk_insert_readings(context.conn, next_batch(), refresh_latest=False)
+
+
+"""QUERY"""
+
+
+@case("return_readings_gdf", "query", requires=("db",))
+def readings_gdf(context):
+    return lambda: haqs_api.return_readings_gdf(context.conn, limit=100)
+
+
+@case("return_parameter_gdf", "query", requires=("db",))
+def parameter_gdf(context):
+    return lambda: haqs_api.return_parameter_gdf(context.conn, parameter="PM10")
+
+
+def _stations_request(cold):
+    from django.core.cache import cache
+    from django.test import RequestFactory
+    from stations.views import stations_dataset
+
+    request = RequestFactory().get("/stations_data/", HTTP_ACCEPT_ENCODING="gzip")
+
+    def run():
+        if cold:
+            cache.clear()
+        response = stations_dataset(request)
+        if response.status_code != 200:
+            raise Skip("stations_dataset returned {}".format(response.status_code))
+    return run
+
+
+@case("stations_dataset[cold]", "query", requires=("db", "django"))
+def stations_dataset_cold(context):
+    return _stations_request(cold=True)
+
+
+@case("stations_dataset[warm]", "query", requires=("db", "django"))
+def stations_dataset_warm(context):
+    return _stations_request(cold=False)
+
+
+def _series_request(context, mode):
+    from django.test import RequestFactory
+    from stations.views import station_series
+
+    pm10 = context.sensors_df[context.sensors_df["parameter"] == "PM10"]
+    if pm10.empty:
+        raise Skip("no PM10 sensors")
+    station_id = str(pm10["station_id"].iloc[0])
+    request = RequestFactory().get("/stations/{}/series".format(station_id),
+                                   {"parameter": "PM10", "mode": mode},
+                                   HTTP_ACCEPT_ENCODING="gzip")
+
+    def run():
+        response = station_series(request, station_id)
+        if response.status_code != 200:
+            raise Skip("station_series returned {}".format(response.status_code))
+    return run
+
+
+@case("station_series[minmax]", "query", requires=("db", "django"))
+def station_series_minmax(context):
+    return _series_request(context, "minmax")
+
+
+@case("station_series[lttb]", "query", requires=("db", "django"))
+def station_series_lttb(context):
+    return _series_request(context, "lttb")
+
+
+"""RENDERING"""
+
+
+def _param_df(context):
+    stations_df = haqs_api.create_stations_gdf(context.stations_json)
+    sensors_df = context.harvester.get_latest_sensors_readings(context.sensors_df.copy())
+    return haqs_api.get_param_df(stations_df, sensors_df, "PM10")
+
+
+@case("ReadingsMap.update", "rendering", items="n_stations")
+def readings_map_update(context):
+    from haqs_api.maps import ReadingsMap
+
+    param_df = _param_df(context)
+    readings_map = ReadingsMap(param_df)
+    return lambda: readings_map.update(param_df)
+
+
+@case("show_readings_map", "rendering", items="n_stations")
+def show_readings_map(context):
+    """
+    Map is built as in haqs_api.show_readings_map(), but saved
+    as standalone HTML instead of being displayed in notebook.
+    """
+    from haqs_api.maps import ReadingsMap
+
+    param_df = _param_df(context)
+    path = os.path.join(context.tmp_dir, "readings_map.html")
+    return lambda: ReadingsMap(param_df, tile=haqs_api.CARTODBPOSITRON).update(param_df).save_html(path)
@@ -0,0 +1,193 @@
+"""
+Timing and result files of benchmark suite.
+
+Each case is a function which gets Context and returns
+callable measured by measure(). Results of a run are written
+as one JSON document, so runs of different commits can be
+compared with compare_results().
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+_cases = []
+
+
+class Skip(Exception):
+    pass
+
+
+def case(name, group, items=None, requires=()):
+    """
+    Decorator registers benchmark case.
+
+    Args:
+        name (string):
+            unique case name, used to compare runs
+
+        group (string):
+            ingestion, query or rendering
+
+        items (string) - default None:
+            Context attribute with number of items processed
+            by one call, throughput is reported when given
+
+        requires (tuple) - default ():
+            'db' and/or 'django', case is skipped when
+            requirement is not available
+    """
+    def register(setup):
+        _cases.append({"name": name, "group": group, "items": items,
+                       "requires": tuple(requires), "setup": setup})
+        return setup
+    return register
+
+
+def registered_cases(names=None):
+    if not names:
+        return list(_cases)
+    return [entry for entry in _cases if entry["name"] in names or entry["group"] in names]
+
+
+def measure(func, repeat=5, warmup=1):
+    """
+    Function calls func warmup + repeat times and
+    returns wall clock timings (seconds) of measured calls.
+    """
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def summarize(timings, items=None):
+    timings = np.asarray(timings)
+    summary = {"repeat": len(timings),
+               "min": float(timings.min()),
+               "median": float(np.median(timings)),
+               "mean": float(timings.mean()),
+               "p95": float(np.percentile(timings, 95)),
+               "max": float(timings.max())}
+    if items:
+        summary["items"] = int(items)
+        summary["throughput"] = float(items / summary["median"])
+    return summary
+
+
+def run_cases(context, cases, repeat=5, warmup=1):
+    """
+    Function runs cases and returns dictionary
+    name -> summary (or skip reason / error).
+    """
+    results = {}
+    for entry in cases:
+        name = entry["name"]
+        missing = [requirement for requirement in entry["requires"]
+                   if not context.available(requirement)]
+        if missing:
+            results[name] = {"group": entry["group"],
+                             "skipped": "{} not available".format(", ".join(missing))}
+            print("{:<40} skipped ({} not available)".format(name, ", ".join(missing)))
+            continue
+        try:
+            func = entry["setup"](context)
+            timings = measure(func, repeat=repeat, warmup=warmup)
+        except Skip as e:
+            results[name] = {"group": entry["group"], "skipped": str(e)}
+            print("{:<40} skipped ({})".format(name, e))
+            continue
+        except Exception as e:
+            results[name] = {"group": entry["group"],
+                             "error": "{}: {}".format(type(e).__name__, e)}
+            print("{:<40} failed: {}: {}".format(name, type(e).__name__, e))
+            continue
+        items = getattr(context, entry["items"]) if entry["items"] else None
+        results[name] = dict(summarize(timings, items), group=entry["group"])
+        print("{:<40} median {:9.2f} ms  p95 {:9.2f} ms{}".format(
+            name, results[name]["median"] * 1e3, results[name]["p95"] * 1e3,
+            "  {:,.0f} items/s".format(results[name]["throughput"]) if items else ""))
+    return results
+
+
+def git_commit():
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                         stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    versions = {}
+    for name in ("numpy", "pandas", "geopandas", "psycopg2", "requests", "bokeh", "django"):
+        module = sys.modules.get(name)
+        if module is not None:
+            versions[name] = getattr(module, "__version__", None)
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "versions": versions}
+
+
+def save_results(results, parameters, path=None):
+    """
+    Function writes results JSON and returns its path,
+    default path is results/<timestamp>-<commit>.json.
+    """
+    started = datetime.utcnow()
+    commit = git_commit()
+    document = {"commit": commit,
+                "created": started.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "parameters": parameters,
+                "environment": environment(),
+                "results": results}
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, "{}-{}.json".format(
+            started.strftime("%Y%m%dT%H%M%S"), commit or "unknown"))
+    with open(path, "w") as results_file:
+        json.dump(document, results_file, indent=2, sort_keys=True)
+    return path
+
+
+def compare_results(baseline_path, current_path, threshold=0.1):
+    """
+    Function compares median timings of two result files.
+
+    Returns:
+        rows (list):
+            (name, baseline median, current median, ratio)
+            of cases present in both files
+
+        regressions (list):
+            names of cases slower by more than threshold
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)["results"]
+    with open(current_path) as current_file:
+        current = json.load(current_file)["results"]
+
+    rows, regressions = [], []
+    for name in sorted(set(baseline) & set(current)):
+        if "median" not in baseline[name] or "median" not in current[name]:
+            continue
+        ratio = current[name]["median"] / baseline[name]["median"]
+        rows.append((name, baseline[name]["median"], current[name]["median"], ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
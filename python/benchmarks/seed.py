@@ -0,0 +1,119 @@
+"""
+Synthetic benchmark DataBase.
+
+Stations and sensors are the same as served by
+StubGiosServer.synthetic() with the same seed, so harvester and
+DataBase cases work on one data set. Hourly readings of every
+sensor are generated by PostgreSQL (generate_series), so years
+of readings are written without round trips.
+
+All tables are dropped and created again, seeding refuses to run
+on DataBase which name does not contain 'bench' unless force
+is passed.
+"""
+import time
+
+from haqs_api.anomaly import create_anomaly_tables
+from haqs_api.daemon import upsert_metadata
+from haqs_api.harvester import sensors_frame
+from haqs_api.haqs_api import (create_latest_readings_view, create_postgis_extension,
+                               create_readings_table, create_sensors_table,
+                               create_stations_table)
+from haqs_api.ingest import refresh_latest_readings
+from haqs_api.rollups import GRAINS, create_rollup_tables, rebuild_rollups
+from haqs_api.testing import PARAMETERS
+
+DROP_SQL = """
+    DROP MATERIALIZED VIEW IF EXISTS public.latest_readings CASCADE;
+    DROP TABLE IF EXISTS public.readings, public.sensors, public.stations CASCADE;
+    DROP TABLE IF EXISTS {rollups} CASCADE;
+    DROP TABLE IF EXISTS public.reading_flags, public.anomaly_state CASCADE;
+"""
+
+READINGS_SQL = """
+    SELECT setseed(%(seed)s);
+    INSERT INTO public.readings (sensor_id, ts, reading)
+    SELECT sensors.sensor_id, hours.ts,
+        CASE WHEN random() < %(missing_rate)s THEN NULL
+             ELSE round((levels.level * exp(0.5 * sqrt(-2 * ln(1 - random()))
+                                             * cos(2 * pi() * random())))::numeric, 3)
+        END
+    FROM sensors
+    INNER JOIN (VALUES {levels}) AS levels (parameter, level)
+        ON levels.parameter = sensors.sensor_parameter
+    CROSS JOIN generate_series(date_trunc('hour', now()) - %(hours)s * interval '1 hour',
+                               date_trunc('hour', now()), interval '1 hour') AS hours (ts)
+    ORDER BY hours.ts, sensors.sensor_id;
+"""
+
+
+def rollup_tables():
+    return ", ".join("public.{}, public.{}".format(sensor_table, parameter_table)
+                     for _, sensor_table, parameter_table, _ in GRAINS)
+
+
+def seed_database(conn, server, years=1, missing_rate=0.05, seed=0, force=False):
+    """
+    Function creates benchmark tables and fills them with
+    stations and sensors of stub server and hourly readings.
+
+    Args:
+        conn (psycopg2.connection)
+
+        server (testing.StubGiosServer):
+            source of stations and sensors
+
+        years (float) - default 1:
+            length of readings history
+
+        missing_rate (float) - default 0.05:
+            fraction of readings without value
+
+        seed (int) - default 0
+
+        force (bool) - default False:
+            seed DataBase which name does not contain 'bench'
+
+    Returns:
+        stats (dict):
+            stations, sensors, readings and seconds
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT current_database();")
+    database = cur.fetchone()[0]
+    if "bench" not in database and not force:
+        raise RuntimeError("refusing to drop tables of '{}' DataBase, "
+                           "use dedicated benchmark DataBase".format(database))
+
+    start = time.perf_counter()
+    create_postgis_extension(conn)
+    cur.execute(DROP_SQL.format(rollups=rollup_tables()))
+    conn.commit()
+    create_stations_table(conn)
+    create_sensors_table(conn)
+    create_readings_table(conn)
+
+    sensors_df = sensors_frame([server.sensors[station["id"]] for station in server.stations])
+    upsert_metadata(conn, server.stations, sensors_df)
+    conn.commit()
+
+    levels = ", ".join(cur.mogrify("(%s, %s)", (code, level)).decode()
+                       for code, (_, _, level) in PARAMETERS.items())
+    cur.execute(READINGS_SQL.format(levels=levels),
+                {"seed": seed / 2 ** 31, "missing_rate": missing_rate,
+                 "hours": int(years * 365 * 24)})
+    readings = cur.rowcount
+    conn.commit()
+
+    create_latest_readings_view(conn)
+    refresh_latest_readings(conn)
+    create_rollup_tables(conn)
+    rebuild_rollups(conn)
+    create_anomaly_tables(conn)
+
+    conn.autocommit = True
+    cur.execute("VACUUM ANALYZE;")
+    conn.autocommit = False
+
+    return {"stations": len(server.stations), "sensors": len(sensors_df),
+            "readings": readings, "seconds": time.perf_counter() - start}
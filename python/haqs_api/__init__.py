@@ -0,0 +1,20 @@
+"""
+Home Air Quality Station tools.
+
+Core modules (fetch, ingest, query) depend only on requests,
+numpy and psycopg2, pandas is imported on first use:
+    http_cache, harvester, db, schema, ingest, rollups,
+    aq_index, sync, daemon, readers
+
+Optional extras are imported only by modules which need them:
+    haqs_api       - geopandas, folium, matplotlib, bokeh (lazily)
+    maps           - bokeh, matplotlib (selenium with chromedriver
+                     or geckodriver for PNG export)
+    interpolation,
+    nearest        - scipy (rasterio for GeoTIFF output)
+    export         - pyarrow
+    mqtt_bridge    - paho-mqtt
+
+Ingestion command line (python -m haqs_api) is expected to start
+without importing any of the extras, see tests/test_import_budget.py.
+"""
@@ -0,0 +1,177 @@
+"""
+Command line entry point.
+
+Example:
+    $ python -m haqs_api stub --port 8080 &
+    $ HAQS_DATABASE_URL=postgresql://localhost/haqs \\
+        python -m haqs_api run --api-url http://127.0.0.1:8080/pjp-api/rest/
+    $ python -m haqs_api --log-format json run --metrics-port 9108
+"""
+import argparse
+import logging
+import os
+import time
+
+DEFAULT_SPOOL_DIR = os.path.join(os.path.expanduser("~"), ".cache", "haqs_api", "mqtt_spool")
+
+
+def _harvester(args):
+    from .harvester import Harvester
+
+    return Harvester(args.api_url, max_workers=args.workers)
+
+
+def _log_metrics():
+    from . import metrics
+
+    logging.info("metrics: %s", metrics.summary(), extra={"metrics": metrics.summary()})
+
+
+def run(args):
+    from .daemon import IngestionDaemon
+
+    if args.metrics_port:
+        from . import metrics
+
+        metrics.start_http_server(args.metrics_port)
+    daemon = IngestionDaemon(_harvester(args),
+                             checkpoint=args.checkpoint,
+                             metadata_interval=args.metadata_interval,
+                             max_batch=args.max_batch,
+                             jitter=args.jitter,
+                             lookback_hours=args.lookback_hours)
+    daemon.install_signal_handlers()
+    stats = daemon.run(max_cycles=args.max_cycles)
+    logging.info("finished: %s", stats)
+    _log_metrics()
+    return 0
+
+
+def sync(args):
+    from .db import connection
+    from .sync import sync_readings
+
+    with _harvester(args) as harvester, connection() as conn:
+        print(sync_readings(conn, harvester, lookback_hours=args.lookback_hours))
+    _log_metrics()
+    return 0
+
+
+def migrate(args):
+    from .schema import main
+
+    argv = ["--chunk-size", str(args.chunk_size)] + (["--drop-old"] if args.drop_old else [])
+    return main(argv)
+
+
+def mqtt(args):
+    import signal
+    import threading
+
+    from .db import connection
+    from .mqtt_bridge import MqttBridge, create_home_tables
+
+    with connection() as conn:
+        create_home_tables(conn)
+
+    bridge = MqttBridge(args.host, args.port,
+                        default_device=args.device,
+                        batch_size=args.batch_size,
+                        flush_interval=args.flush_interval,
+                        spool_dir=args.spool_dir,
+                        username=args.username,
+                        password=args.password)
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    signal.signal(signal.SIGINT, lambda *_: stopped.set())
+    bridge.start()
+    while not stopped.wait(60):
+        logging.info("mqtt bridge: %s", bridge.stats())
+    bridge.stop()
+    logging.info("finished: %s", bridge.stats())
+    return 0
+
+
+def stub(args):
+    from .testing import StubGiosServer
+
+    server = StubGiosServer.synthetic(n_stations=args.stations, host=args.host, port=args.port,
+                                      latency=args.latency)
+    with server:
+        print("Stub GIOŚ API listening on {}".format(server.url))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m haqs_api",
+                                     description="Home Air Quality Station data services")
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--log-format", choices=("text", "json"), default="text",
+                        help="json writes one document per log record")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    def api_arguments(command):
+        from .harvester import GIOS_API_URL
+
+        command.add_argument("--api-url", default=GIOS_API_URL)
+        command.add_argument("--workers", type=int, default=16,
+                             help="maximum number of concurrent API requests")
+        command.add_argument("--lookback-hours", type=int, default=3)
+
+    command = commands.add_parser("run", help="run scheduled ingestion daemon")
+    api_arguments(command)
+    command.add_argument("--checkpoint", default="haqs_checkpoint.json")
+    command.add_argument("--metadata-interval", type=float, default=24 * 3600,
+                         help="seconds between stations and sensors refreshes")
+    command.add_argument("--max-batch", type=int, default=500,
+                         help="maximum number of sensors pulled in one cycle")
+    command.add_argument("--jitter", type=float, default=0.1,
+                         help="random pull delay as a fraction of sensor cadence")
+    command.add_argument("--max-cycles", type=int, default=None)
+    command.add_argument("--metrics-port", type=int, default=None,
+                         help="serve Prometheus metrics on port (prometheus_client is required)")
+    command.set_defaults(func=run)
+
+    command = commands.add_parser("sync", help="insert readings published since last sync")
+    api_arguments(command)
+    command.set_defaults(func=sync)
+
+    command = commands.add_parser("migrate", help="migrate readings table to current schema")
+    command.add_argument("--chunk-size", type=int, default=50000)
+    command.add_argument("--drop-old", action="store_true")
+    command.set_defaults(func=migrate)
+
+    command = commands.add_parser("mqtt", help="write home station MQTT readings to DataBase")
+    command.add_argument("--host", default="localhost", help="MQTT broker host")
+    command.add_argument("--port", type=int, default=1883)
+    command.add_argument("--username", default=None)
+    command.add_argument("--password", default=None)
+    command.add_argument("--device", default="home",
+                         help="device_id of topics without device prefix")
+    command.add_argument("--batch-size", type=int, default=5000)
+    command.add_argument("--flush-interval", type=float, default=1.0)
+    command.add_argument("--spool-dir", default=DEFAULT_SPOOL_DIR)
+    command.set_defaults(func=mqtt)
+
+    command = commands.add_parser("stub", help="serve synthetic GIOŚ API for local runs")
+    command.add_argument("--host", default="127.0.0.1")
+    command.add_argument("--port", type=int, default=8080)
+    command.add_argument("--stations", type=int, default=250)
+    command.add_argument("--latency", type=float, default=0)
+    command.set_defaults(func=stub)
+
+    args = parser.parse_args(argv)
+    from .metrics import configure_logging
+
+    configure_logging(args.log_level, args.log_format)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,50 @@
+"""
+Deferred imports of heavy optional dependencies.
+
+Geo and plotting stacks (geopandas, folium, matplotlib, bokeh)
+take seconds and hundreds of MB to import, while ingestion only
+needs HTTP and DataBase. lazy_import() returns module proxy which
+imports the real module on first attribute access.
+
+Example:
+    In [1]: gpd = lazy_import('geopandas')  # nothing is imported yet
+            gpd.GeoDataFrame                # geopandas is imported here
+"""
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module proxy, real module is imported on first attribute
+    access and its attributes are copied into the proxy, so
+    following lookups do not go through __getattr__.
+    """
+
+    def _load(self):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if sys.modules.get(self.__name__) is None:
+            return "<lazy module '{}'>".format(self.__name__)
+        return repr(sys.modules[self.__name__])
+
+
+def lazy_import(name):
+    """
+    Function returns module if it was already imported,
+    LazyModule proxy otherwise.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
@@ -0,0 +1,319 @@
+"""
+Streaming detection of faulty readings.
+
+Every ingestion batch (see ingest.bulk_insert_readings()) is checked
+against per-sensor state kept in anomaly_state table, so detection
+never rescans history. State of a sensor has constant size: last
+WINDOW values (for rolling median and MAD), flat line counter
+and drift bias. Checks:
+
+    negative  - value below zero
+    spike     - value further than SPIKE_MADS scaled MADs from
+                rolling median of last WINDOW values
+    flatline  - same value above parameter floor (FLAT_FLOORS)
+                repeated FLAT_COUNT or more times
+    neighbour - value far from median of the same parameter measured
+                at the same hour by stations within NEIGHBOUR_RADIUS
+    drift     - exponentially weighted log ratio to neighbour median
+                stays above DRIFT_LOG_RATIO
+
+Flags are written to reading_flags table. Flagged readings are kept
+in readings table, but are excluded from rollups (and indexes computed
+from them) and from latest_readings view used by maps.
+
+Example:
+    In [1]: create_anomaly_tables(conn)
+            bulk_insert_readings(conn, records)
+    In [2]: return_flags_df(conn).head(2)
+    Out[2]:     sensor_id  ts                         flag      value   expected
+                0   642        2018-10-14 13:00:00+00:00  spike     912.0   31.2
+                1   3575       2018-10-14 13:00:00+00:00  flatline  7.0     7.0
+"""
+import math
+from collections import deque
+
+from psycopg2.extras import execute_values
+
+from ._lazy import lazy_import
+from .schema import LATEST_READINGS_VIEW_SQL, READING_FLAGS_TABLE_SQL
+
+pd = lazy_import("pandas")
+
+WINDOW = 48
+MIN_WINDOW = 12
+SPIKE_MADS = 6.0
+# MAD of normal distribution is 1 / 1.4826 of its standard deviation
+MAD_SCALE = 1.4826
+# spread used for spikes is at least MIN_SPREAD and MIN_RELATIVE_SPREAD of median
+MIN_SPREAD = 1.0
+MIN_RELATIVE_SPREAD = 0.1
+FLAT_COUNT = 6
+# values repeated near reporting resolution or detection limit are normal
+# (e.g. C6H6 or SO2 at night), so only values above floor are flatlines
+FLAT_FLOORS = {"PM10": 5.0, "PM2.5": 5.0, "NO2": 5.0, "O3": 5.0,
+               "SO2": 5.0, "CO": 300.0, "C6H6": 1.0}
+DEFAULT_FLAT_FLOOR = 1.0
+NEIGHBOUR_RADIUS = 30000
+MIN_NEIGHBOURS = 2
+NEIGHBOUR_RATIO = 3.0
+NEIGHBOUR_MARGIN = 10.0
+DRIFT_ALPHA = 1.0 / 48
+DRIFT_MIN_COUNT = 48
+DRIFT_LOG_RATIO = math.log(2)
+
+ANOMALY_STATE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS public.anomaly_state
+    (
+        sensor_id INTEGER PRIMARY KEY,
+        ts TIMESTAMPTZ NOT NULL,
+        recent REAL[] NOT NULL,
+        flat_value REAL,
+        flat_count INTEGER NOT NULL,
+        bias REAL NOT NULL,
+        bias_count INTEGER NOT NULL
+    );
+"""
+
+# ingested readings with parameter and median of unflagged neighbour readings of the same hour
+BATCH_SQL = """
+    WITH pairs AS
+    (
+        SELECT touched.sensor_id, near_sensors.sensor_id AS neighbour_id
+        FROM (SELECT DISTINCT sensor_id FROM {touched}) touched
+        INNER JOIN sensors on sensors.sensor_id = touched.sensor_id
+        INNER JOIN stations on stations.station_id = sensors.station_id
+        INNER JOIN stations near
+            ON near.station_id <> stations.station_id
+            AND ST_DWithin(near.geom::geography, stations.geom::geography, %(radius)s)
+        INNER JOIN sensors near_sensors
+            ON near_sensors.station_id = near.station_id
+            AND near_sensors.sensor_parameter = sensors.sensor_parameter
+    )
+    SELECT ingested.sensor_id, ingested.ts, ingested.reading, ingested_sensors.sensor_parameter,
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY readings.reading),
+        count(readings.reading)
+    FROM {touched} ingested
+    LEFT JOIN sensors ingested_sensors on ingested_sensors.sensor_id = ingested.sensor_id
+    LEFT JOIN pairs on pairs.sensor_id = ingested.sensor_id
+    LEFT JOIN readings
+        ON readings.sensor_id = pairs.neighbour_id
+        AND readings.ts = ingested.ts
+        AND NOT EXISTS (SELECT 1 FROM reading_flags
+                        WHERE reading_flags.sensor_id = readings.sensor_id
+                            AND reading_flags.ts = readings.ts)
+    WHERE ingested.reading IS NOT NULL
+    GROUP BY ingested.sensor_id, ingested.ts, ingested.reading, ingested_sensors.sensor_parameter
+    ORDER BY ingested.sensor_id, ingested.ts;
+"""
+
+
+def create_anomaly_tables(conn):
+    """
+    Function creates reading_flags and anomaly_state tables.
+    latest_readings view created before flags existed is
+    created again, so it skips flagged readings.
+    """
+    cur = conn.cursor()
+    cur.execute(READING_FLAGS_TABLE_SQL)
+    cur.execute(ANOMALY_STATE_TABLE_SQL)
+    cur.execute("""
+                    SELECT definition FROM pg_matviews
+                    WHERE schemaname = 'public' AND matviewname = 'latest_readings';
+                """)
+    row = cur.fetchone()
+    if row is not None and "reading_flags" not in row[0]:
+        cur.execute("DROP MATERIALIZED VIEW public.latest_readings;")
+        cur.execute(LATEST_READINGS_VIEW_SQL)
+    conn.commit()
+
+
+def anomaly_exists(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('public.anomaly_state') IS NOT NULL;")
+    return cur.fetchone()[0]
+
+
+def flags_exist(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('public.reading_flags') IS NOT NULL;")
+    return cur.fetchone()[0]
+
+
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+class SensorState(object):
+    """
+    Constant memory detection state of one sensor.
+
+    Args:
+        ts (datetime) - default None:
+            time of last checked reading
+
+        recent (list) - default ():
+            last WINDOW values, oldest first
+
+        flat_value (float) - default None:
+            value of current flat line
+
+        flat_count (int) - default 0:
+            number of repetitions of flat_value
+
+        bias (float) - default 0.0:
+            weighted mean of log ratios to neighbour median
+
+        bias_count (int) - default 0:
+            number of readings in bias (at most DRIFT_MIN_COUNT)
+
+    Example:
+        In [1]: state = SensorState()
+                [state.check(ts, value) for ts, value in readings][-1]
+        Out[1]: [('spike', 31.2)]
+    """
+
+    def __init__(self, ts=None, recent=(), flat_value=None, flat_count=0,
+                 bias=0.0, bias_count=0):
+        self.ts = ts
+        self.recent = deque(recent, maxlen=WINDOW)
+        self.flat_value = flat_value
+        self.flat_count = flat_count
+        self.bias = bias
+        self.bias_count = bias_count
+
+    def expected(self):
+        """
+        Function returns (median, spread) of recent values,
+        None when there are less than MIN_WINDOW values.
+        """
+        if len(self.recent) < MIN_WINDOW:
+            return None
+        median = _median(self.recent)
+        mad = _median([abs(value - median) for value in self.recent])
+        return median, max(MAD_SCALE * mad, MIN_SPREAD, MIN_RELATIVE_SPREAD * abs(median))
+
+    def check(self, ts, value, neighbour_median=None, neighbours=0,
+              flat_floor=DEFAULT_FLAT_FLOOR):
+        """
+        Function returns list of (flag, expected value) pairs of reading.
+        State is updated only by readings newer than
+        already checked ones, older readings are only checked.
+        Repeated values not above flat_floor are not flatlines.
+        """
+        flags = []
+        if value < 0:
+            flags.append(("negative", 0.0))
+
+        expected = self.expected()
+        if expected is not None and abs(value - expected[0]) > SPIKE_MADS * expected[1]:
+            flags.append(("spike", expected[0]))
+
+        newer = self.ts is None or ts > self.ts
+        flat_count = self.flat_count + 1 if value == self.flat_value else 1
+        if newer and flat_count >= FLAT_COUNT and value > flat_floor:
+            flags.append(("flatline", value))
+
+        with_neighbours = neighbours >= MIN_NEIGHBOURS and neighbour_median is not None
+        if with_neighbours and abs(value - neighbour_median) > (NEIGHBOUR_RATIO * neighbour_median
+                                                                + NEIGHBOUR_MARGIN):
+            flags.append(("neighbour", neighbour_median))
+
+        if not newer:
+            return flags
+
+        if with_neighbours and value >= 0:
+            ratio = math.log1p(value) - math.log1p(max(neighbour_median, 0.0))
+            if self.bias_count == 0:
+                self.bias = ratio
+            else:
+                self.bias += DRIFT_ALPHA * (ratio - self.bias)
+            self.bias_count = min(self.bias_count + 1, DRIFT_MIN_COUNT)
+            if self.bias_count >= DRIFT_MIN_COUNT and abs(self.bias) > DRIFT_LOG_RATIO:
+                flags.append(("drift", neighbour_median))
+
+        # spikes are kept in window, so genuine level shifts are accepted after WINDOW / 2 readings
+        if value >= 0:
+            self.recent.append(value)
+        self.flat_value = value
+        self.flat_count = flat_count
+        self.ts = ts
+        return flags
+
+    def row(self, sensor_id):
+        return (sensor_id, self.ts, list(self.recent), self.flat_value, self.flat_count,
+                self.bias, self.bias_count)
+
+
+def _load_states(cur, sensor_ids):
+    cur.execute("""
+                    SELECT sensor_id, ts, recent, flat_value, flat_count, bias, bias_count
+                    FROM anomaly_state
+                    WHERE sensor_id = ANY(%s);
+                """, (sensor_ids,))
+    return {row[0]: SensorState(*row[1:]) for row in cur.fetchall()}
+
+
+def detect_anomalies(conn, touched_table="ingested_readings"):
+    """
+    Function checks readings listed in touched_table
+    (sensor_id, ts, reading), writes their flags and
+    saves state of touched sensors. Changes are not
+    committed, function is called inside ingestion
+    transaction before rollups are updated.
+
+    Returns:
+        flagged (int):
+            number of written flags
+    """
+    cur = conn.cursor()
+    cur.execute(BATCH_SQL.format(touched=touched_table), {"radius": NEIGHBOUR_RADIUS})
+    rows = cur.fetchall()
+    if not rows:
+        return 0
+
+    states = _load_states(cur, sorted({row[0] for row in rows}))
+    flags = []
+    for sensor_id, ts, value, parameter, neighbour_median, neighbours in rows:
+        state = states.get(sensor_id)
+        if state is None:
+            state = states[sensor_id] = SensorState()
+        flat_floor = FLAT_FLOORS.get(parameter, DEFAULT_FLAT_FLOOR)
+        for flag, expected in state.check(ts, value, neighbour_median, neighbours, flat_floor):
+            flags.append((sensor_id, ts, flag, value, expected))
+
+    if flags:
+        execute_values(cur, """
+                                INSERT INTO public.reading_flags (sensor_id, ts, flag, value, expected)
+                                VALUES %s
+                                ON CONFLICT (sensor_id, ts, flag) DO NOTHING;
+                            """, flags, page_size=1000)
+    execute_values(cur, """
+                            INSERT INTO public.anomaly_state
+                                (sensor_id, ts, recent, flat_value, flat_count, bias, bias_count)
+                            VALUES %s
+                            ON CONFLICT (sensor_id) DO UPDATE
+                            SET ts = EXCLUDED.ts, recent = EXCLUDED.recent,
+                                flat_value = EXCLUDED.flat_value, flat_count = EXCLUDED.flat_count,
+                                bias = EXCLUDED.bias, bias_count = EXCLUDED.bias_count;
+                        """, [state.row(sensor_id) for sensor_id, state in states.items()],
+                   template="(%s, %s, %s::real[], %s, %s, %s, %s)", page_size=1000)
+    return len(flags)
+
+
+def return_flags_df(conn, start=None, sensor_id=None):
+    """
+    Function returns flags of readings newer than start
+    (all by default) of all sensors or of sensor_id.
+    """
+    sql =   """
+                SELECT sensor_id, ts, flag, value, expected
+                FROM reading_flags
+                WHERE (%(start)s::timestamptz IS NULL OR ts >= %(start)s::timestamptz)
+                    AND (%(sensor_id)s::integer IS NULL OR sensor_id = %(sensor_id)s::integer)
+                ORDER BY ts DESC, sensor_id;
+            """
+    return pd.read_sql_query(sql, con=conn, params={"start": start, "sensor_id": sensor_id})
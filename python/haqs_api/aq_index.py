@@ -0,0 +1,300 @@
+"""
+Air quality index computed from stored readings.
+
+Index of every station is computed locally, from hourly rollups
+(readings_hourly), instead of requesting aqindex/getIndex for
+each station. PM10 and PM2.5 are averaged over 24 hours and O3
+over 8 hours (rolling means, at least 75% of hours required),
+other pollutants use hourly means. Pollutant levels are looked up
+in thresholds of selected scale and station index is the worst
+level of its pollutants.
+
+Scales:
+    gios - Polish index (Bardzo dobry ... Bardzo zły)
+    eaqi - European Air Quality Index (Good ... Extremely poor)
+
+Indexes are kept in aq_index (station) and aq_index_pollutants
+(sensor) tables. ingest.bulk_insert_readings() updates them for
+stations and hours touched by inserted readings.
+
+Example:
+    In [1]: create_aq_index_tables(conn)
+            update_aq_index(conn, start=datetime(2018, 10, 1))
+            conn.commit()
+    In [2]: return_aq_index_df(conn).head(2)
+    Out[2]:     station_id  ts                         level  category     pollutant
+                0   114         2018-10-14 13:00:00+00:00  1      Dobry        PM10
+                1   117         2018-10-14 13:00:00+00:00  2      Umiarkowany  PM2.5
+"""
+from datetime import timedelta
+
+import numpy as np
+from psycopg2.extras import execute_values
+
+from ._lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+# upper bounds of levels (ug/m3), value above last bound gets the worst level
+SCALES = {
+    "gios": {
+        "categories": ("Bardzo dobry", "Dobry", "Umiarkowany", "Dostateczny", "Zły", "Bardzo zły"),
+        "thresholds": {
+            "PM10": (20, 50, 80, 110, 150),
+            "PM2.5": (13, 35, 55, 75, 110),
+            "O3": (70, 120, 150, 180, 240),
+            "NO2": (40, 100, 150, 200, 400),
+            "SO2": (50, 100, 200, 350, 500),
+            "C6H6": (6, 11, 16, 21, 51),
+            "CO": (3000, 7000, 11000, 15000, 21000),
+        },
+    },
+    "eaqi": {
+        "categories": ("Good", "Fair", "Moderate", "Poor", "Very poor", "Extremely poor"),
+        "thresholds": {
+            "PM10": (20, 40, 50, 100, 150),
+            "PM2.5": (10, 20, 25, 50, 75),
+            "O3": (50, 100, 130, 240, 380),
+            "NO2": (40, 90, 120, 230, 340),
+            "SO2": (100, 200, 350, 500, 750),
+        },
+    },
+}
+
+# rolling mean window in hours, other parameters use hourly means
+AVERAGING_HOURS = {"PM10": 24, "PM2.5": 24, "O3": 8}
+MIN_COVERAGE = 0.75
+MAX_WINDOW = max(AVERAGING_HOURS.values())
+HOUR = timedelta(hours=1)
+
+
+def create_aq_index_tables(conn):
+    cur = conn.cursor()
+    cur.execute("""
+                    CREATE TABLE IF NOT EXISTS public.aq_index
+                    (
+                        scale VARCHAR(8) NOT NULL,
+                        station_id INTEGER NOT NULL,
+                        ts TIMESTAMPTZ NOT NULL,
+                        level SMALLINT NOT NULL,
+                        pollutant VARCHAR(10) NOT NULL,
+                        PRIMARY KEY (scale, station_id, ts)
+                    );
+                    CREATE TABLE IF NOT EXISTS public.aq_index_pollutants
+                    (
+                        scale VARCHAR(8) NOT NULL,
+                        sensor_id INTEGER NOT NULL,
+                        ts TIMESTAMPTZ NOT NULL,
+                        mean REAL NOT NULL,
+                        level SMALLINT NOT NULL,
+                        PRIMARY KEY (scale, sensor_id, ts)
+                    );
+                """)
+    conn.commit()
+
+
+def aq_index_exists(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('public.aq_index') IS NOT NULL;")
+    return cur.fetchone()[0]
+
+
+def pollutant_levels(values, parameter, scale="gios"):
+    """
+    Function returns array of index levels (0 - best) of
+    parameter values, -1 for NaN values and parameters
+    which are not part of the scale.
+
+    Example:
+        In [1]: pollutant_levels([12.0, 20.0, 20.1, 170.0], 'PM10')
+        Out[1]: array([0, 0, 1, 5])
+    """
+    values = np.asarray(values, dtype=float)
+    thresholds = SCALES[scale]["thresholds"].get(parameter)
+    if thresholds is None:
+        return np.full(values.shape, -1)
+    levels = np.searchsorted(thresholds, values, side="left")
+    return np.where(np.isnan(values), -1, levels)
+
+
+def rolling_means(hourly, hours):
+    """
+    Function returns rolling means of (sensors x hours) matrix
+    of hourly means. Means of windows with less than
+    MIN_COVERAGE of hours are NaN.
+    """
+    present = ~np.isnan(hourly)
+    padding = np.zeros((hourly.shape[0], 1))
+    sums = np.concatenate([padding, np.cumsum(np.where(present, hourly, 0.0), axis=1)], axis=1)
+    counts = np.concatenate([padding, np.cumsum(present, axis=1)], axis=1)
+
+    end = np.arange(1, hourly.shape[1] + 1)
+    start = np.maximum(end - hours, 0)
+    window_sums = sums[:, end] - sums[:, start]
+    window_counts = counts[:, end] - counts[:, start]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = window_sums / window_counts
+    return np.where(window_counts >= np.ceil(MIN_COVERAGE * hours), means, np.nan)
+
+
+def _hourly_df(conn, start, end, station_ids=None):
+    sql =   """
+                SELECT hourly.sensor_id, sensors.station_id, sensors.sensor_parameter,
+                    hourly.bucket, hourly.mean
+                FROM readings_hourly hourly
+                INNER JOIN sensors on sensors.sensor_id = hourly.sensor_id
+                WHERE hourly.bucket >= %(start)s AND hourly.bucket <= %(end)s
+                    AND sensors.sensor_parameter = ANY(%(parameters)s)
+                    AND (%(station_ids)s::integer[] IS NULL
+                         OR sensors.station_id = ANY(%(station_ids)s::integer[]));
+            """
+    parameters = sorted(set().union(*(scale["thresholds"] for scale in SCALES.values())))
+    return pd.read_sql_query(sql, con=conn, params={"start": start - timedelta(hours=MAX_WINDOW - 1),
+                                                    "end": end,
+                                                    "parameters": parameters,
+                                                    "station_ids": station_ids})
+
+
+def compute_aq_index(conn, start=None, end=None, station_ids=None, scale="gios"):
+    """
+    Function computes index of all (or selected) stations for
+    every hour between start and end with one query.
+
+    Args:
+        conn (psycopg2.connection):
+            connection object for DataBase session.
+
+        start, end (datetime) - default None:
+            first and last hour (inclusive), current hour when None
+
+        station_ids (list) - default None:
+            stations to compute, all stations when None
+
+        scale (string) - default 'gios':
+            'gios' or 'eaqi'
+
+    Returns:
+        stations_df (pd.DataFrame):
+            station_id, ts, level, category, pollutant
+
+        pollutants_df (pd.DataFrame):
+            sensor_id, station_id, parameter, ts, mean, level
+    """
+    if end is None:
+        end = pd.Timestamp.now(tz="UTC").floor(HOUR)
+    end = pd.Timestamp(end).tz_localize("UTC") if pd.Timestamp(end).tz is None else pd.Timestamp(end)
+    start = end if start is None else pd.Timestamp(start)
+    start = start.tz_localize("UTC") if start.tz is None else start
+    start, end = start.floor(HOUR), end.floor(HOUR)
+
+    hourly_df = _hourly_df(conn, start.to_pydatetime(), end.to_pydatetime(), station_ids)
+    hours = pd.date_range(start - timedelta(hours=MAX_WINDOW - 1), end, freq=HOUR)
+
+    sensors = hourly_df[["sensor_id", "station_id", "sensor_parameter"]].drop_duplicates("sensor_id")
+    sensor_index = pd.Index(sensors["sensor_id"].values)
+    matrix = np.full((len(sensors), len(hours)), np.nan)
+    if len(hourly_df):
+        rows = sensor_index.get_indexer(hourly_df["sensor_id"].values)
+        columns = hours.get_indexer(pd.to_datetime(hourly_df["bucket"], utc=True))
+        found = columns >= 0
+        matrix[rows[found], columns[found]] = hourly_df["mean"].values[found]
+
+    # means and levels of all sensors of one parameter are computed at once
+    first = MAX_WINDOW - 1
+    means = np.full((len(sensors), len(hours) - first), np.nan)
+    levels = np.full(means.shape, -1)
+    parameters = sensors["sensor_parameter"].values
+    for parameter in np.unique(parameters):
+        selected = parameters == parameter
+        means[selected] = rolling_means(matrix[selected], AVERAGING_HOURS.get(parameter, 1))[:, first:]
+        levels[selected] = pollutant_levels(means[selected], parameter, scale)
+
+    pollutants_df = pd.DataFrame({
+        "sensor_id": np.repeat(sensors["sensor_id"].values, means.shape[1]),
+        "station_id": np.repeat(sensors["station_id"].values, means.shape[1]),
+        "parameter": np.repeat(parameters, means.shape[1]),
+        "ts": np.tile(hours[first:], len(sensors)),
+        "mean": means.ravel(),
+        "level": levels.ravel(),
+    })
+    pollutants_df = pollutants_df[pollutants_df["level"] >= 0].reset_index(drop=True)
+
+    worst = pollutants_df.sort_values("level", ascending=False, kind="mergesort") \
+                         .drop_duplicates(["station_id", "ts"])
+    stations_df = worst[["station_id", "ts", "level", "parameter"]] \
+        .rename(columns={"parameter": "pollutant"}) \
+        .sort_values(["station_id", "ts"]).reset_index(drop=True)
+    stations_df.insert(3, "category", np.asarray(SCALES[scale]["categories"])[stations_df["level"].values])
+
+    return stations_df, pollutants_df
+
+
+def save_aq_index(conn, stations_df, pollutants_df, scale="gios"):
+    """
+    Function upserts computed indexes. Changes are not committed.
+    """
+    cur = conn.cursor()
+    execute_values(cur, """
+                            INSERT INTO public.aq_index (scale, station_id, ts, level, pollutant)
+                            VALUES %s
+                            ON CONFLICT (scale, station_id, ts) DO UPDATE
+                            SET level = EXCLUDED.level, pollutant = EXCLUDED.pollutant;
+                        """,
+                   [(scale, int(row.station_id), row.ts.to_pydatetime(), int(row.level), row.pollutant)
+                    for row in stations_df.itertuples(index=False)],
+                   page_size=10000)
+    execute_values(cur, """
+                            INSERT INTO public.aq_index_pollutants (scale, sensor_id, ts, mean, level)
+                            VALUES %s
+                            ON CONFLICT (scale, sensor_id, ts) DO UPDATE
+                            SET mean = EXCLUDED.mean, level = EXCLUDED.level;
+                        """,
+                   [(scale, int(row.sensor_id), row.ts.to_pydatetime(), float(row.mean), int(row.level))
+                    for row in pollutants_df.itertuples(index=False)],
+                   page_size=10000)
+
+
+def update_aq_index(conn, touched_table="ingested_readings", start=None, end=None,
+                    scales=tuple(SCALES)):
+    """
+    Function recomputes indexes of hours and stations touched by
+    readings listed in touched_table (sensor_id, ts). Reading of hour h
+    changes windows ending between h and h + 23 hours. When start is
+    given, all stations are recomputed between start and end instead.
+    Changes are not committed, function is called inside ingestion
+    transaction after rollups were updated.
+    """
+    station_ids = None
+    if start is None:
+        cur = conn.cursor()
+        cur.execute("""
+                        SELECT min(touched.ts), max(touched.ts), array_agg(DISTINCT sensors.station_id)
+                        FROM {} touched
+                        INNER JOIN sensors on sensors.sensor_id = touched.sensor_id;
+                    """.format(touched_table))
+        start, last, station_ids = cur.fetchone()
+        if start is None:
+            return
+        now = pd.Timestamp.now(tz="UTC").floor(HOUR)
+        end = min(pd.Timestamp(last) + timedelta(hours=MAX_WINDOW - 1), now)
+        start = min(pd.Timestamp(start), now)
+
+    for scale in scales:
+        stations_df, pollutants_df = compute_aq_index(conn, start, end, station_ids, scale)
+        save_aq_index(conn, stations_df, pollutants_df, scale)
+
+
+def return_aq_index_df(conn, scale="gios", ts=None):
+    """
+    Function returns latest (or given hour) index of every station.
+    """
+    sql =   """
+                SELECT DISTINCT ON (station_id) station_id, ts, level, pollutant
+                FROM aq_index
+                WHERE scale = %(scale)s AND (%(ts)s::timestamptz IS NULL OR ts = %(ts)s::timestamptz)
+                ORDER BY station_id, ts DESC;
+            """
+    aq_index_df = pd.read_sql_query(sql, con=conn, params={"scale": scale, "ts": ts})
+    aq_index_df.insert(3, "category",
+                       np.asarray(SCALES[scale]["categories"])[aq_index_df["level"].values.astype(int)])
+    return aq_index_df
@@ -0,0 +1,318 @@
+"""
+Scheduled ingestion of GIOŚ data.
+
+Stations and sensors metadata (and exact p95 of monthly rollups)
+is refreshed periodically (once a day by default) and readings of each sensor are pulled when the sensor is
+expected to publish new value. Publication cadence of each sensor is
+estimated from dates in its payloads, due sensors are kept in priority
+queue (heap) ordered by next pull time. Random jitter spreads requests
+so they are not all sent at once on the hour.
+
+Due sensors are downloaded concurrently by Harvester (bounded thread
+pool) and inserted with ingest.bulk_insert_readings(). Per-sensor
+high-water marks, cadences and next pull times are saved to JSON
+checkpoint after each cycle, so restarted daemon resumes the schedule.
+SIGTERM and SIGINT finish current cycle, save checkpoint and exit.
+
+Example:
+    $ HAQS_DATABASE_URL=postgresql://localhost/haqs \\
+        python -m haqs_api run --checkpoint haqs_checkpoint.json
+"""
+import heapq
+import json
+import logging
+import os
+import random
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+from .db import connection
+from .harvester import Harvester, stations_frame
+from .ingest import bulk_insert_readings
+from .rollups import refresh_monthly_p95, rollups_exist
+from .sync import get_high_water_marks, new_records
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+DEFAULT_CADENCE = 3600
+MIN_CADENCE = 15 * 60
+MAX_CADENCE = 24 * 3600
+# delay of retry when sensor has not published expected value yet
+MIN_RETRY = 5 * 60
+
+
+def estimate_cadence(data_json, default=DEFAULT_CADENCE):
+    """
+    Function returns median number of seconds between
+    consecutive values of GIOŚ getData payload.
+    """
+    dates = sorted(row["date"] for row in (data_json or {}).get("values", [])
+                   if row["value"] is not None)
+    if len(dates) < 2:
+        return default
+    parsed = [datetime.strptime(date, DATE_FORMAT) for date in dates]
+    steps = sorted((b - a).total_seconds() for a, b in zip(parsed, parsed[1:]) if b > a)
+    if not steps:
+        return default
+    return min(max(steps[len(steps) // 2], MIN_CADENCE), MAX_CADENCE)
+
+
+def upsert_metadata(conn, stations_json, sensors_df):
+    """
+    Function inserts new and updates changed stations and sensors.
+    Changes are not committed.
+    """
+    stations_df = stations_frame(stations_json)
+    cur = conn.cursor()
+    execute_values(cur, """
+                            INSERT INTO public.stations (station_id, geom)
+                            VALUES %s
+                            ON CONFLICT (station_id) DO UPDATE
+                            SET geom = EXCLUDED.geom;
+                        """,
+                   list(zip(stations_df["station_id"].tolist(),
+                            stations_df["longitude"].tolist(),
+                            stations_df["latitude"].tolist())),
+                   template="(%s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))")
+    execute_values(cur, """
+                            INSERT INTO public.sensors (sensor_id, sensor_parameter, station_id)
+                            VALUES %s
+                            ON CONFLICT (sensor_id) DO UPDATE
+                            SET sensor_parameter = EXCLUDED.sensor_parameter,
+                                station_id = EXCLUDED.station_id;
+                        """,
+                   list(zip(sensors_df["sensor_id"].tolist(),
+                            sensors_df["parameter"].tolist(),
+                            sensors_df["station_id"].tolist())))
+
+
+class IngestionDaemon(object):
+    """
+    Long running ingestion service.
+
+    Args:
+        harvester (harvester.Harvester) - default None:
+            API client, new one with default settings is used when None
+
+        checkpoint (string) - default None:
+            path of JSON checkpoint, state is not persisted when None
+
+        metadata_interval (float) - default 86400:
+            seconds between stations and sensors refreshes
+            (and monthly p95 updates)
+
+        max_batch (int) - default 500:
+            maximum number of sensors pulled in one cycle
+
+        jitter (float) - default 0.1:
+            random delay added to each pull,
+            as a fraction of sensor cadence
+
+        lookback_hours (int) - default 3:
+            values up to lookback_hours older than latest stored
+            reading are inserted when missing
+    """
+
+    def __init__(self, harvester=None, checkpoint=None, metadata_interval=24 * 3600,
+                 max_batch=500, jitter=0.1, lookback_hours=3):
+        self.harvester = harvester or Harvester()
+        self.checkpoint = checkpoint
+        self.metadata_interval = metadata_interval
+        self.max_batch = max_batch
+        self.jitter = jitter
+        self.lookback_hours = lookback_hours
+
+        self.marks = {}
+        self.cadences = {}
+        self.due = {}
+        self.next_metadata = 0
+        self._queue = []
+        self._stop = threading.Event()
+        self.stats = {"cycles": 0, "pulled": 0, "failed": 0, "inserted": 0}
+
+    def load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return False
+        with open(self.checkpoint) as checkpoint_file:
+            state = json.load(checkpoint_file)
+        self.marks = {int(k): v for k, v in state["marks"].items()}
+        self.cadences = {int(k): v for k, v in state["cadences"].items()}
+        self.due = {int(k): v for k, v in state["due"].items()}
+        self.next_metadata = state["next_metadata"]
+        self._queue = [(due, sensor_id) for sensor_id, due in self.due.items()]
+        heapq.heapify(self._queue)
+        return True
+
+    def save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        state = {"marks": self.marks,
+                 "cadences": self.cadences,
+                 "due": self.due,
+                 "next_metadata": self.next_metadata}
+        with open(self.checkpoint + ".tmp", "w") as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(self.checkpoint + ".tmp", self.checkpoint)
+
+    def schedule(self, sensor_id, due):
+        self.due[sensor_id] = due
+        heapq.heappush(self._queue, (due, sensor_id))
+
+    def _jitter(self, sensor_id):
+        cadence = self.cadences.get(sensor_id, DEFAULT_CADENCE)
+        return random.uniform(0, self.jitter * cadence)
+
+    def refresh_metadata(self):
+        """
+        Function refreshes stations and sensors tables
+        (and p95 of monthly rollups) and schedules new
+        sensors. Removed sensors are dropped from schedule.
+        """
+        stations_json = self.harvester.get_stations()
+        sensors_df = self.harvester.create_sensors_df(stations_json)
+        with connection() as conn:
+            upsert_metadata(conn, stations_json, sensors_df)
+            if rollups_exist(conn):
+                refresh_monthly_p95(conn)
+            if not self.marks:
+                self.marks = {sensor_id: mark for sensor_id, mark
+                              in get_high_water_marks(conn).items() if mark is not None}
+
+        sensor_ids = set(sensors_df["sensor_id"].tolist())
+        now = time.time()
+        for sensor_id in sensor_ids - set(self.due):
+            # spread first pulls of new sensors over one minute
+            self.schedule(sensor_id, now + random.uniform(0, 60))
+        for sensor_id in set(self.due) - sensor_ids:
+            del self.due[sensor_id]
+
+        self.next_metadata = now + self.metadata_interval
+        logger.info("metadata refreshed: %d stations, %d sensors",
+                    len(stations_json), len(sensor_ids))
+
+    def pop_due(self, now):
+        """
+        Function returns sensors which pull time has passed.
+        Outdated heap entries (rescheduled or removed sensors) are skipped.
+        """
+        sensor_ids = []
+        while self._queue and self._queue[0][0] <= now and len(sensor_ids) < self.max_batch:
+            due, sensor_id = heapq.heappop(self._queue)
+            if self.due.get(sensor_id) == due:
+                sensor_ids.append(sensor_id)
+        return sensor_ids
+
+    def _since(self, sensor_id):
+        mark = self.marks.get(sensor_id)
+        if mark is None:
+            return None
+        since = datetime.strptime(mark, DATE_FORMAT) - timedelta(hours=self.lookback_hours)
+        return since.strftime(DATE_FORMAT)
+
+    def pull(self, sensor_ids):
+        """
+        Function downloads and inserts new readings of sensors
+        and schedules their next pulls.
+        """
+        payloads = self.harvester.get_sensors_data(sensor_ids)
+        now = time.time()
+
+        records = []
+        marks = {}
+        next_due = {}
+        for sensor_id, data_json in zip(sensor_ids, payloads):
+            cadence = self.cadences.get(sensor_id, DEFAULT_CADENCE)
+            if data_json is None:
+                self.stats["failed"] += 1
+                next_due[sensor_id] = now + MIN_RETRY
+                continue
+
+            cadence = self.cadences[sensor_id] = estimate_cadence(data_json, cadence)
+            sensor_records = new_records(sensor_id, data_json, self._since(sensor_id))
+            records.extend(sensor_records)
+
+            mark = self.marks.get(sensor_id)
+            latest = max([record[1] for record in sensor_records] + [mark or ""])
+            if latest and latest != mark:
+                # new value published, next one expected one cadence later
+                marks[sensor_id] = latest
+                next_due[sensor_id] = now + cadence
+            else:
+                # value is late, check again soon
+                next_due[sensor_id] = now + max(MIN_RETRY, cadence / 4)
+
+        with connection() as conn:
+            inserted, skipped = bulk_insert_readings(conn, records)
+
+        # marks are moved only when readings are stored
+        self.marks.update(marks)
+        for sensor_id, due in next_due.items():
+            self.schedule(sensor_id, due + self._jitter(sensor_id))
+
+        self.stats["pulled"] += len(sensor_ids)
+        self.stats["inserted"] += inserted
+        logger.info("pulled %d sensors, inserted %d readings, skipped %d",
+                    len(sensor_ids), inserted, skipped,
+                    extra={"event": "pull", "sensors": len(sensor_ids),
+                           "inserted": inserted, "skipped": skipped})
+        return inserted
+
+    def run_once(self):
+        """
+        Function runs one scheduling cycle and returns
+        number of seconds until next scheduled work.
+        """
+        now = time.time()
+        if now >= self.next_metadata:
+            try:
+                self.refresh_metadata()
+            except Exception:
+                logger.exception("metadata refresh failed")
+                self.next_metadata = now + MIN_RETRY
+
+        sensor_ids = self.pop_due(now)
+        if sensor_ids:
+            try:
+                self.pull(sensor_ids)
+            except Exception:
+                logger.exception("readings pull failed")
+                for sensor_id in sensor_ids:
+                    self.schedule(sensor_id, now + MIN_RETRY + self._jitter(sensor_id))
+            self.save_checkpoint()
+
+        self.stats["cycles"] += 1
+        next_due = min(self._queue[0][0] if self._queue else self.next_metadata,
+                       self.next_metadata)
+        return max(next_due - time.time(), 0)
+
+    def stop(self, *args):
+        logger.info("stopping")
+        self._stop.set()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def run(self, max_cycles=None):
+        """
+        Function runs scheduling loop until stop() is called
+        (or SIGTERM / SIGINT is received) or max_cycles are done.
+        """
+        self.load_checkpoint()
+        cycles = 0
+        try:
+            while not self._stop.is_set():
+                wait = self.run_once()
+                cycles += 1
+                if max_cycles is not None and cycles >= max_cycles:
+                    break
+                self._stop.wait(wait)
+        finally:
+            self.save_checkpoint()
+            self.harvester.close()
+        return self.stats
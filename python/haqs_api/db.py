@@ -0,0 +1,295 @@
+"""
+DataBase connection settings and connection pool.
+
+Connection settings are read from environment:
+    HAQS_DATABASE_URL - libpq connection string or URI,
+                        overrides all variables below
+    HAQS_DB_NAME      - default 'haqs'
+    HAQS_DB_USER      - default 'postgres'
+    HAQS_DB_PASSWORD  - default 'postgres'
+    HAQS_DB_HOST      - default 'localhost'
+    HAQS_DB_PORT      - default 5432
+    HAQS_DB_POOL_MIN  - default 1
+    HAQS_DB_POOL_MAX  - default 10
+
+Example:
+    In [1]: with connection() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT count(*) FROM readings;")
+    In [2]: get_pool().stats()
+    Out[2]: {'size': 1, 'idle': 1, 'in_use': 0, 'max_size': 10,
+             'created': 1, 'waits': 0, 'wait_time': 0.0, 'max_wait_time': 0.0}
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PoolClosed(Exception):
+    pass
+
+
+def dsn_from_env(environ=None):
+    """
+    Function returns DataBase connection string
+    built from environment variables.
+    """
+    environ = os.environ if environ is None else environ
+    if environ.get("HAQS_DATABASE_URL"):
+        return environ["HAQS_DATABASE_URL"]
+    return extensions.make_dsn(dbname=environ.get("HAQS_DB_NAME", "haqs"),
+                               user=environ.get("HAQS_DB_USER", "postgres"),
+                               password=environ.get("HAQS_DB_PASSWORD", "postgres"),
+                               host=environ.get("HAQS_DB_HOST", "localhost"),
+                               port=environ.get("HAQS_DB_PORT", "5432"))
+
+
+@contextmanager
+def savepoint(conn, name="sp1"):
+    """
+    Context manager wraps statements with savepoint.
+    Savepoint is released when statements succeed and
+    rolled back (then released) when exception is raised.
+
+    Example:
+        In [1]: with savepoint(conn):
+                    cur.execute(sql)
+    """
+    cur = conn.cursor()
+    cur.execute("SAVEPOINT {};".format(name))
+    try:
+        yield cur
+    except Exception:
+        cur.execute("ROLLBACK TO SAVEPOINT {};".format(name))
+        cur.execute("RELEASE SAVEPOINT {};".format(name))
+        raise
+    else:
+        cur.execute("RELEASE SAVEPOINT {};".format(name))
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of psycopg2 connections.
+
+    When all connections are in use getconn() waits
+    until one of them is returned. Connections are
+    returned to the pool with clean transaction state.
+    Connecting and rolling back happen outside of
+    the pool lock, pool slot is reserved meanwhile.
+
+    Args:
+        dsn (string) - default dsn_from_env():
+            DataBase connection string
+
+        minconn (int) - default 1:
+            number of connections opened up front
+
+        maxconn (int) - default 10:
+            maximum number of open connections
+
+        timeout (float) - default 30:
+            seconds getconn() waits for free connection
+    """
+
+    def __init__(self, dsn=None, minconn=1, maxconn=10, timeout=30):
+        self.dsn = dsn or dsn_from_env()
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+
+        self._idle = []
+        self._in_use = set()
+        # slots reserved by connections being opened or rolled back
+        self._reserved = 0
+        self._cond = threading.Condition()
+        self._created = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._closed = False
+
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        self._created += 1
+        return conn
+
+    def getconn(self, timeout=None):
+        """
+        Function returns connection from the pool.
+        Connection has to be given back with putconn().
+        PoolClosed is raised after closeall().
+        """
+        timeout = self.timeout if timeout is None else timeout
+        with self._cond:
+            started = None
+            while not self._closed and not self._idle and self._size() >= self.maxconn:
+                if started is None:
+                    started = time.time()
+                    self._waits += 1
+                remaining = timeout - (time.time() - started)
+                if remaining <= 0:
+                    raise PoolTimeout("No free connection within {} seconds".format(timeout))
+                self._cond.wait(remaining)
+            if self._closed:
+                raise PoolClosed("Connection pool is closed")
+
+            if started is not None:
+                waited = time.time() - started
+                self._wait_time += waited
+                self._max_wait_time = max(self._max_wait_time, waited)
+
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn.closed:
+                    self._in_use.add(conn)
+                    return conn
+            self._reserved += 1
+
+        try:
+            conn = psycopg2.connect(self.dsn)
+        except Exception:
+            with self._cond:
+                self._reserved -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._reserved -= 1
+            self._created += 1
+            if not self._closed:
+                self._in_use.add(conn)
+                return conn
+            self._cond.notify()
+        conn.close()
+        raise PoolClosed("Connection pool is closed")
+
+    def putconn(self, conn, close=False):
+        """
+        Function returns connection to the pool.
+        Uncommitted transaction is rolled back.
+        """
+        with self._cond:
+            self._in_use.discard(conn)
+            self._reserved += 1
+
+        try:
+            if not conn.closed and not close:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+        except psycopg2.Error:
+            close = True
+        finally:
+            with self._cond:
+                self._reserved -= 1
+                keep = not (conn.closed or close or self._closed or len(self._idle) >= self.maxconn)
+                if keep:
+                    self._idle.append(conn)
+                self._cond.notify()
+
+        if not keep and not conn.closed:
+            conn.close()
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._reserved
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager hands out pooled connection.
+        Transaction is committed when block succeeds
+        and rolled back when exception is raised.
+
+        Example:
+            In [1]: with pool.connection() as conn:
+                        bulk_insert_readings(conn, records)
+        """
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        else:
+            if not conn.closed:
+                conn.commit()
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        """
+        Function returns pool usage statistics.
+
+        Returns:
+            stats (dict):
+                size - open connections
+                idle - connections waiting in the pool
+                in_use - connections handed out
+                max_size - maximum number of connections
+                created - connections opened since pool creation
+                waits - number of getconn() calls which had to wait
+                wait_time - total seconds spent waiting
+                max_wait_time - longest single wait in seconds
+        """
+        with self._cond:
+            return {"size": self._size(),
+                    "idle": len(self._idle),
+                    "in_use": len(self._in_use),
+                    "max_size": self.maxconn,
+                    "created": self._created,
+                    "waits": self._waits,
+                    "wait_time": self._wait_time,
+                    "max_wait_time": self._max_wait_time}
+
+    def closeall(self):
+        """
+        Function closes all idle connections.
+        Connections in use are closed when returned,
+        getconn() raises PoolClosed from now on.
+        """
+        with self._cond:
+            for conn in self._idle:
+                if not conn.closed:
+                    conn.close()
+            self._idle = []
+            self._closed = True
+            self._cond.notify_all()
+
+
+def get_pool():
+    """
+    Function returns process wide connection pool
+    configured from environment. Pool is created
+    on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(minconn=int(os.environ.get("HAQS_DB_POOL_MIN", 1)),
+                                   maxconn=int(os.environ.get("HAQS_DB_POOL_MAX", 10)))
+        return _pool
+
+
+def connection(timeout=None):
+    """
+    Shortcut for get_pool().connection().
+
+    Example:
+        In [1]: with connection() as conn:
+                    sensors_df = return_sensors_df(conn)
+    """
+    return get_pool().connection(timeout)
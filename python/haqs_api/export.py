@@ -0,0 +1,205 @@
+"""
+GeoParquet export of readings.
+
+Readings are streamed from DataBase in chunks and written
+as GeoParquet dataset partitioned by parameter and month
+(hive layout: parameter=PM10/month=2018-10/part-....parquet).
+Station geometry is stored as WKB in geometry column.
+
+Exports are append-only: id of the last exported reading is kept
+in _export_state.json next to the data, next export writes only
+readings inserted since then. Ingestion transactions commit ids out
+of order, so export never goes past the highest id committed when no
+insert was in flight (see committed_last_id()), and rows still being
+inserted are exported next time.
+
+Example:
+    In [1]: export_readings_parquet(conn, 'parquet/readings')
+    Out[1]: 125341
+    In [2]: pm10_gdf = read_readings_parquet('parquet/readings', parameter='PM10',
+                                             start=datetime(2018, 10, 1),
+                                             columns=['sensor_id', 'ts', 'reading', 'geometry'])
+"""
+import json
+import os
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+
+from .readers import iter_query
+from .schema import GIOS_TIMEZONE
+
+STATE_FILE = "_export_state.json"
+PARTITIONING = ds.partitioning(pa.schema([("parameter", pa.string()),
+                                          ("month", pa.string())]),
+                               flavor="hive")
+
+GEO_METADATA = {
+    "version": "1.0.0",
+    "primary_column": "geometry",
+    "columns": {"geometry": {"encoding": "WKB", "geometry_types": ["Point"]}},
+}
+
+
+def _read_state(path):
+    try:
+        with open(os.path.join(path, STATE_FILE)) as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        return {"last_id": 0}
+
+
+def _write_state(path, state):
+    state_path = os.path.join(path, STATE_FILE)
+    with open(state_path + ".tmp", "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def committed_last_id(conn):
+    """
+    Function returns highest readings id which no later commit
+    can precede. SHARE lock waits until inserting transactions
+    finish (new ones wait for the lock), so every id below
+    returned one is already committed or rolled back.
+    Current transaction is committed, which releases the lock.
+    """
+    cur = conn.cursor()
+    cur.execute("LOCK TABLE readings IN SHARE MODE;")
+    cur.execute("SELECT coalesce(max(id), 0) FROM readings;")
+    last_id = cur.fetchone()[0]
+    conn.commit()
+    return last_id
+
+
+def _chunk_table(chunk):
+    chunk["ts"] = pd.to_datetime(chunk["ts"], utc=True)
+    chunk["month"] = chunk["ts"].dt.tz_convert(GIOS_TIMEZONE).dt.strftime("%Y-%m")
+    chunk["geometry"] = chunk["geometry"].map(bytes)
+    table = pa.Table.from_pandas(chunk, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"geo"] = json.dumps(GEO_METADATA).encode("utf-8")
+    return table.replace_schema_metadata(metadata)
+
+
+def export_readings_parquet(conn, path, chunksize=200000, incremental=True):
+    """
+    Function writes readings into partitioned GeoParquet dataset.
+
+    Args:
+        conn (psycopg2.connection):
+            connection object for DataBase session.
+
+        path (string):
+            dataset root directory
+
+        chunksize (int) - default 200000:
+            number of readings read and written at once
+
+        incremental (bool) - default True:
+            export only readings inserted since previous export,
+            when False all readings are exported again
+
+    Current transaction of conn is committed (see committed_last_id()).
+
+    Returns:
+        exported (int):
+            number of exported readings
+    """
+    os.makedirs(path, exist_ok=True)
+    state = _read_state(path) if incremental else {"last_id": 0}
+    run = int(time.time() * 1000)
+    committed_id = committed_last_id(conn)
+
+    sql =   """
+                SELECT readings.id, readings.sensor_id, sensors.station_id,
+                    sensors.sensor_parameter AS parameter, readings.ts, readings.reading,
+                    ST_AsBinary(stations.geom) AS geometry
+                FROM readings
+                INNER JOIN sensors on readings.sensor_id = sensors.sensor_id
+                INNER JOIN stations on sensors.station_id = stations.station_id
+                WHERE readings.id > %(last_id)s AND readings.id <= %(committed_id)s
+                ORDER BY readings.id;
+            """
+    params = {"last_id": state["last_id"], "committed_id": committed_id}
+    exported = 0
+    for number, chunk in enumerate(iter_query(conn, sql, params, chunksize)):
+        last_id = int(chunk["id"].max())
+        ds.write_dataset(_chunk_table(chunk.drop(columns="id")), path,
+                         format="parquet",
+                         partitioning=PARTITIONING,
+                         basename_template="part-{}-{}-{{i}}.parquet".format(run, number),
+                         existing_data_behavior="overwrite_or_ignore")
+        exported += len(chunk)
+        state["last_id"] = last_id
+        _write_state(path, state)
+
+    return exported
+
+
+def readings_dataset(path):
+    """
+    Function returns pyarrow dataset of exported readings.
+    Files are memory-mapped when read.
+    """
+    return ds.dataset(path, format="parquet", partitioning=PARTITIONING,
+                      filesystem=pafs.LocalFileSystem(use_mmap=True),
+                      exclude_invalid_files=True,
+                      ignore_prefixes=[".", "_"])
+
+
+def read_readings_parquet(path, columns=None, parameter=None, start=None, end=None,
+                          filter=None, geodataframe=True):
+    """
+    Function reads exported readings. Partitions not matching
+    parameter and time range are skipped and only requested
+    columns are read.
+
+    Args:
+        path (string):
+            dataset root directory
+
+        columns (list) - default None:
+            columns to read, all columns when None
+
+        parameter (string or list) - default None
+
+        start, end (datetime) - default None:
+            time range, end is exclusive
+
+        filter (pyarrow.dataset.Expression) - default None:
+            additional filter, i.e. ds.field('reading') > 50
+
+        geodataframe (bool) - default True:
+            return GeoDataFrame when geometry column is read
+
+    Returns:
+        readings_df (pd.DataFrame or gpd.GeoDataFrame)
+    """
+    expression = filter
+    conditions = []
+    if parameter is not None:
+        parameters = [parameter] if isinstance(parameter, str) else list(parameter)
+        conditions.append(ds.field("parameter").isin(parameters))
+    if start is not None:
+        start = pd.Timestamp(start, tz=GIOS_TIMEZONE) if pd.Timestamp(start).tz is None else pd.Timestamp(start)
+        conditions.append(ds.field("month") >= start.tz_convert(GIOS_TIMEZONE).strftime("%Y-%m"))
+        conditions.append(ds.field("ts") >= pa.scalar(start.tz_convert("UTC"), pa.timestamp("us", "UTC")))
+    if end is not None:
+        end = pd.Timestamp(end, tz=GIOS_TIMEZONE) if pd.Timestamp(end).tz is None else pd.Timestamp(end)
+        conditions.append(ds.field("month") <= end.tz_convert(GIOS_TIMEZONE).strftime("%Y-%m"))
+        conditions.append(ds.field("ts") < pa.scalar(end.tz_convert("UTC"), pa.timestamp("us", "UTC")))
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    table = readings_dataset(path).to_table(columns=columns, filter=expression)
+    readings_df = table.to_pandas()
+
+    if geodataframe and "geometry" in readings_df:
+        import geopandas as gpd
+        geometry = gpd.GeoSeries.from_wkb(readings_df.pop("geometry"), crs="EPSG:4326")
+        return gpd.GeoDataFrame(readings_df, geometry=geometry)
+    return readings_df
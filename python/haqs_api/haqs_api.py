@@ -1,21 +1,38 @@
-from datetime import datetime
+"""
+GIOŚ API helpers, DataBase functions and notebook visualizations.
+
+Geo and plotting dependencies (geopandas, folium, matplotlib, bokeh)
+are imported lazily, on first use of a function which needs them,
+so DataBase and HTTP functions can be used without loading them.
+"""
+import logging
+
 import requests
 import numpy as np
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-import folium
-from folium.plugins import HeatMap
-from fiona.crs import from_epsg
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import bokeh
-from bokeh import plotting
-from bokeh.models import GeoJSONDataSource, HoverTool
-from bokeh.plotting import figure, show, ColumnDataSource
-from bokeh.tile_providers import CARTODBPOSITRON, STAMEN_TERRAIN, STAMEN_TONER
 import psycopg2
 
+from . import http_cache, metrics
+from ._lazy import lazy_import
+from .db import dsn_from_env, savepoint
+from .harvester import latest_value, sensors_frame, stations_frame
+from .schema import GIOS_TIMEZONE, LATEST_READINGS_VIEW_SQL, READINGS_TABLE_SQL
+
+pd = lazy_import("pandas")
+gpd = lazy_import("geopandas")
+folium = lazy_import("folium")
+folium_plugins = lazy_import("folium.plugins")
+mpl = lazy_import("matplotlib")
+plt = lazy_import("matplotlib.pyplot")
+bokeh = lazy_import("bokeh")
+plotting = lazy_import("bokeh.plotting")
+
+logger = logging.getLogger(__name__)
+
+# Bokeh tile providers, resolved by maps.tile_provider() when map is created
+CARTODBPOSITRON = "CARTODBPOSITRON"
+STAMEN_TERRAIN = "STAMEN_TERRAIN"
+STAMEN_TONER = "STAMEN_TONER"
+
 NoneType = type(None)
 
 stations_request = "http://api.gios.gov.pl/pjp-api/rest/station/findAll"
@@ -23,6 +40,15 @@ sensors_request = "http://api.gios.gov.pl/pjp-api/rest/station/sensors/"  # {sta
 data_request = "http://api.gios.gov.pl/pjp-api/rest/data/getData/"  # {sensorId} needed
 aq_index_request = "http://api.gios.gov.pl/pjp-api/rest/aqindex/getIndex/"  # {stationId} needed
 
+# FastMarkerCluster callback, row is [latitude, longitude, station_name]
+STATION_MARKER_CALLBACK = """
+    function (row) {
+        var marker = L.marker(new L.LatLng(row[0], row[1]));
+        marker.bindPopup(row[2]);
+        return marker;
+    };
+"""
+
 
 def get_stations():
     """
@@ -55,7 +81,7 @@ def get_stations():
                                     'provinceName': 'DOLNOŚLĄSKIE'}},
                 'addressStreet': 'ul. Bartnicza'}
     """
-    return requests.get(stations_request).json()
+    return http_cache.get_json(stations_request)
 
 
 def create_stations_gdf(stations_json, map=False):
@@ -91,41 +117,14 @@ def create_stations_gdf(stations_json, map=False):
                 3   52            POINT (16.180513 51.204503)
                 4	109	          POINT (16.269677 50.768729)
     """
-    stations_dict = {}
-    station_ids = []
-    station_name = []
-    station_lon = []
-    station_lat = []
-    station_geometries = []
-
-    if map:
-        for station in stations_json:
-
-            station_ids.append(station["id"])
-            station_name.append(station["stationName"])
-            station_lon.append(float(station["gegrLon"]))
-            station_lat.append(float(station["gegrLat"]))
-            station_geometries.append(Point(float(station["gegrLon"]),
-                                            float(station["gegrLat"])))
+    stations_df = stations_frame(stations_json)
+    geometry = gpd.points_from_xy(stations_df["longitude"], stations_df["latitude"],
+                                  crs="EPSG:4326")
 
-        stations_dict["station_id"] = station_ids
-        stations_dict["station_name"] = station_name
-        stations_dict["latitude"] = station_lat
-        stations_dict["longitude"] = station_lon
-        stations_dict["geometry"] = station_geometries
+    if not map:
+        stations_df = stations_df[["station_id"]]
 
-    else:
-        for station in stations_json:
-
-            station_ids.append(station["id"])
-            station_geometries.append(Point(float(station["gegrLon"]),
-                                            float(station["gegrLat"])))
-
-        stations_dict["station_id"] = station_ids
-        stations_dict["geometry"] = station_geometries
-
-    stations_df = gpd.GeoDataFrame(stations_dict)
-    stations_df.crs = from_epsg(4326)
+    stations_df = gpd.GeoDataFrame(stations_df, geometry=geometry)
 
     return stations_df
 
@@ -148,16 +147,13 @@ def create_stations_map(stations_json):
         In [1]: stations_json = get_stations()
                 create_stations_map(stations_json)
     """
-    stations_map = folium.Map([52, 19], zoom_start=6, tiles='Stamen Terrain')
+    stations_map = folium.Map([52, 19], zoom_start=6, tiles='OpenStreetMap')
 
     stations_df = create_stations_gdf(stations_json, map=True)
 
-    locations = stations_df[["latitude", "longitude"]]
-    locations_list = locations.values.tolist()
-
-    for point in range(len(stations_df)):
-        folium.Marker(locations_list[point],
-                      popup=stations_df['station_name'][point]).add_to(stations_map)
+    # all markers are created client side by one cluster layer
+    locations_list = stations_df[["latitude", "longitude", "station_name"]].values.tolist()
+    folium_plugins.FastMarkerCluster(locations_list, callback=STATION_MARKER_CALLBACK).add_to(stations_map)
 
     """FIRST VERSION (without pin description)"""
     # points = folium.features.GeoJson(stations_df.to_json())
@@ -174,6 +170,8 @@ def create_sensors_df(stations_json):
     Notice:
         Function has been deprecated since PostgreSQL
         Database was added to the project.
+        Stations are requested one after another,
+        use harvester.Harvester for concurrent requests.
 
     Args:
         stations_json (list):
@@ -196,29 +194,10 @@ def create_sensors_df(stations_json):
                 3	117	        14395	    PM10
                 4	117	        658	        C6H6
     """
-    sensors_dict = {}
-    stations_ids = []
-    sensors_ids = []
-    sensors_param = []
-
-    for station in stations_json:
-
-        station_id = station["id"]
-        sensors = requests.get(sensors_request + str(station_id)).json()
-
-        for sensor in sensors:
-
-            stations_ids.append(sensor["stationId"])
-            sensors_ids.append(sensor["id"])
-            sensors_param.append(sensor["param"]["paramCode"])
+    sensors_jsons = [http_cache.get_json(sensors_request + str(station["id"]))
+                     for station in stations_json]
 
-    sensors_dict["station_id"] = stations_ids
-    sensors_dict["sensor_id"] = sensors_ids
-    sensors_dict["parameter"] = sensors_param
-
-    sensors_df = pd.DataFrame(sensors_dict)
-
-    return sensors_df
+    return sensors_frame(sensors_jsons)
 
 
 def get_available_parameters(sensors_df):
@@ -262,23 +241,21 @@ def request_sensor_data(row):
             if requested data has proper format
             function returns float value of readings
         np.NaN:
-            function returns np.NaN when reading is
-            unavailable or when unexpected error occurs
+            function returns np.NaN when request failed or reading
+            is unavailable, reason is logged and counted in
+            metrics.MISSING_READINGS
 
     Example:
         In [1]: sensors_df['value'] = sensors_df.apply(request_sensor_data, axis=1)
     """
     sensor_id = row["sensor_id"]
-    reading_json = requests.get(data_request + str(sensor_id)).json()
-    count = 0
     try:
-        reading_value = reading_json["values"][count]["value"]
-        while isinstance(reading_value, NoneType):  # if fails try to get next reading
-            reading_value = reading_json["values"][count]["value"]
-            count += 1
-        return reading_value
-    except:
-        return np.NaN
+        reading_json = http_cache.get_json(data_request + str(sensor_id))
+    except (requests.RequestException, ValueError) as e:
+        logger.warning("sensor %s request failed: %s", sensor_id, e,
+                       extra={"sensor_id": sensor_id, "reason": metrics.failure_reason(e)})
+        reading_json = None
+    return latest_value(reading_json)
 
 
 def get_latest_sensors_readings(sensors_df):
@@ -286,6 +263,10 @@ def get_latest_sensors_readings(sensors_df):
     Function gets readings for each row in sensors_df DataFrame.
     Function modifies DataFrame inplace.
 
+    Notice:
+        Sensors are requested one after another,
+        use harvester.Harvester for concurrent requests.
+
     Args:
         sensors_df (pd.DataFrame):
             pandas DataFrame with all available sensors.
@@ -350,7 +331,7 @@ def get_param_df(stations_df, sensors_df, parameter):
     param_df = sensors_df[sensors_df["parameter"] == "{}".format(parameter)]
     param_df = gpd.GeoDataFrame(pd.merge(param_df, stations_df, on='station_id'))
     param_df.dropna(inplace=True)
-    param_df.crs = from_epsg(4326)
+    param_df.crs = "EPSG:4326"
 
     return param_df
 
@@ -366,42 +347,25 @@ def show_readings_map(param_df, tile=CARTODBPOSITRON):
             available air monitoring stations
             and its latests readings.
 
-        tile (bokeh.tile_providers) - default CARTODBPOSITRON:
+        tile (string or bokeh.tile_providers) - default CARTODBPOSITRON:
             one of available Bokeh tile providers
             [CARTODBPOSITRON, STAMEN_TERRAIN, STAMEN_TONER]
 
     Example:
         In [1]: params_df = get_param_df(stations_df, sensors_df, 'PM10')
                 show_readings_map(params_df)
-    """
-    # conversion to World Mercator needed
-    param_df = param_df.to_crs(epsg=3395)
-
-    # normalize data column
-    param_df["value"] = (param_df['value']-param_df['value'].mean())/param_df['value'].std()
-    param_df["value"] = (param_df['value']-param_df['value'].min())/(param_df['value'].max()-param_df['value'].min())
-
-    plotting.output_notebook()
-
-    # reduce differences between readings
-    size = param_df["value"] * 50
-    # get data resolution
-    radii = np.array(size)
-    # create colors palette
-    colors = ["#%02x%02x%02x" % (int(r), int(g), int(b)) for r, g, b, _ in 255*mpl.cm.RdYlGn(1-mpl.colors.Normalize()(radii))]
 
-    p = plotting.figure(toolbar_location="left",
-                        plot_width=900,
-                        plot_height=700,
-                        x_axis_type="mercator",
-                        y_axis_type="mercator")
-
-    p.circle(param_df['geometry'].x, param_df['geometry'].y, size=size,
-             fill_color=colors, fill_alpha=0.8, line_color=None)
+    Returns:
+        readings_map (maps.ReadingsMap):
+            map which can be updated with new readings
+            or saved with save_html() and save_png()
+    """
+    from .maps import ReadingsMap
 
-    p.add_tile(tile)
+    readings_map = ReadingsMap(param_df, tile=tile).update(param_df)
+    readings_map.show()
 
-    plotting.show(p)
+    return readings_map
 
 
 """POSTGRESQL PART"""
@@ -411,7 +375,14 @@ def connect_with_db():
     """
     Function connects with PostgreSQL DataBase
     and returns connection object if connection
-    was succesfully established
+    was succesfully established.
+    Connection settings are read from environment,
+    see db.dsn_from_env().
+
+    Notice:
+        Function opens new connection each time it is called,
+        jobs running repeatedly should use db.connection()
+        which hands out pooled connections.
 
     Returns:
         conn (psycopg2.connection):
@@ -421,11 +392,13 @@ def connect_with_db():
         In [1]: conn = connect_with_db()
     """
     try:
-        conn = psycopg2.connect("dbname='haqs' user='postgres' host='localhost' password='postgres'")
+        with metrics.track_sql("connect"):
+            conn = psycopg2.connect(dsn_from_env())
         print("Successfully connected with DataBase!")
         return conn
     except Exception as e:
-        print(e)
+        logger.error("unable to connect to the DataBase: %s", e,
+                     extra={"reason": metrics.failure_reason(e)})
         print("Unable to connect to the DataBase!")
 
 
@@ -473,24 +446,20 @@ def execute_sql(conn, sql, *args):
     Function helps to deal with DataBase errors
     which occurs during sql statements execution.
     It rolls back to savepoint created before
-    statement run.
+    statement run. Failed statements are logged and counted
+    in metrics, their time is recorded in metrics.SQL_SECONDS.
     """
-    cur = conn.cursor()
-    cur.execute('SAVEPOINT sp1;')  # create database savepoint
-    # print("SAVEPOINT created!")
+    statement = metrics.statement_of(sql)
     try:
-        cur.execute(sql, tuple(args))
-        conn.commit()
-        # print("SQL was successfully executed!")
+        with metrics.track_sql(statement):
+            with savepoint(conn) as cur:
+                cur.execute(sql, tuple(args))
+            conn.commit()
     except Exception as e:
-        print(e)
-        cur.execute('ROLLBACK TO SAVEPOINT sp1;')  # rollback to savepoint
-        # print("Rollback to SAVEPOINT!")
-    """
-    else:
-        cur.execute('RELEASE SAVEPOINT sp1;')  # release savepoint
-        print("SAVEPOINT released!")
-    """
+        if not isinstance(e, AttributeError):  # conn is NoneType object
+            metrics.ROLLBACKS.inc(statement)
+        logger.error("%s failed: %s", statement, e,
+                     extra={"statement": statement, "reason": metrics.failure_reason(e)})
 
 
 def show_database_tables(conn):
@@ -523,35 +492,30 @@ def db_insert_station(conn, *args):
 
 
 def show_insertions(conn, table="stations"):
+    """
+    Returns all rows of table.
+    See readers.iter_insertions() for streaming version.
+    """
     sql = "SELECT * FROM public.{};".format(table)
 
-    cur = conn.cursor()
-    cur.execute('SAVEPOINT sp1;')  # create database savepoint
-    # print("SAVEPOINT created!")
     try:
-        cur.execute(sql)
+        with savepoint(conn) as cur:
+            cur.execute(sql)
+            columns = [desc[0] for desc in cur.description]
+            df = pd.DataFrame(cur.fetchall(), columns=columns)
         conn.commit()
-        # print("SQL was successfully executed!")
-        columns = [desc[0] for desc in cur.description]
-        df = pd.DataFrame(cur.fetchall(), columns=columns)
         return df
     except Exception as e:
-        print(e)
-        cur.execute('ROLLBACK TO SAVEPOINT sp1;')  # rollback to savepoint
-        # print("Rollback to SAVEPOINT!")
-    """
-    else:
-        cur.execute('RELEASE SAVEPOINT sp1;')  # release savepoint
-        print("SAVEPOINT released!")
-    """
+        logger.error("query failed: %s", e, extra={"reason": metrics.failure_reason(e)})
 
 
 def return_stations_gdf(conn):
     sql = "SELECT * FROM public.stations;"
     try:
-        return gpd.read_postgis(sql, conn, geom_col='geom')
+        with metrics.track_sql(metrics.statement_of(sql)):
+            return gpd.read_postgis(sql, conn, geom_col='geom')
     except Exception as e:
-        print(e)
+        logger.error("query failed: %s", e, extra={"reason": metrics.failure_reason(e)})
 
 
 def create_sensors_table(conn):
@@ -578,6 +542,10 @@ def db_insert_sensor(conn, *args):
 
 
 def return_sensors_df(conn):
+    """
+    Returns whole sensors table.
+    See readers.iter_sensors_df() for streaming version.
+    """
     sql = "SELECT * FROM public.sensors"
     sensors_df = pd.read_sql_query(sql, con=conn)
     return sensors_df
@@ -590,22 +558,28 @@ def return_sensors_gdf(conn):
                 WHERE sensors.station_id = stations.station_id;
             """
     try:
-        return gpd.read_postgis(sql, conn, geom_col='geom')
+        with metrics.track_sql(metrics.statement_of(sql)):
+            return gpd.read_postgis(sql, conn, geom_col='geom')
     except Exception as e:
-        print(e)
+        logger.error("query failed: %s", e, extra={"reason": metrics.failure_reason(e)})
 
 
 def create_readings_table(conn):
-    sql =   """
-                CREATE TABLE public.readings
-                (
-                    id INTEGER PRIMARY KEY,
-                    sensor_id INTEGER REFERENCES sensors (sensor_id),
-                    date VARCHAR(19) NOT NULL,
-                    reading FLOAT(4)
-                );
-            """
-    execute_sql(conn, sql)
+    """
+    Function creates readings table in current schema version.
+    Existing tables in older schema can be upgraded with
+    schema.migrate_readings(conn).
+    """
+    execute_sql(conn, READINGS_TABLE_SQL)
+
+
+def create_latest_readings_view(conn):
+    """
+    Function creates latest_readings materialized view
+    with most recent non-null reading of each sensor.
+    View is refreshed by ingest.bulk_insert_readings().
+    """
+    execute_sql(conn, LATEST_READINGS_VIEW_SQL)
 
 
 def return_sensors_ids(conn):
@@ -616,64 +590,87 @@ def return_sensors_ids(conn):
     return sensors_ids
 
 
-def db_insert_sensor_readings(conn, *args):
+def db_insert_sensor_readings(conn, sensor_id, date, reading, *args):
     """
-    Function inserts multiple readings for sensor
+    Function inserts reading for sensor,
+    reading is skipped if it already exists.
+    Date is GIOŚ local time string i.e. '2018-10-14 15:00:00'.
+
+    Notice:
+        Every reading is inserted and committed separately,
+        use ingest.bulk_insert_readings() for many readings.
+        Additional args are ignored, they were required
+        by previous version of the function.
     """
     sql =   """
-                INSERT INTO readings (sensor_id, date, reading)
-                SELECT %s, %s, %s
-                WHERE
-                    NOT EXISTS
-                    (
-                        SELECT * FROM readings WHERE date = %s AND sensor_id = %s
-                    )
+                INSERT INTO readings (sensor_id, ts, reading)
+                VALUES (%s, %s::timestamp AT TIME ZONE %s, %s)
+                ON CONFLICT (sensor_id, ts) DO NOTHING;
             """
-    execute_sql(conn, sql, *args)
+    execute_sql(conn, sql, sensor_id, date, GIOS_TIMEZONE, reading)
 
 
 def return_readings_df(conn):
+    """
+    Returns whole readings table.
+
+    Notice:
+        Whole table is loaded into memory,
+        use readers.iter_readings_df() for large tables.
+    """
     sql = "SELECT * FROM public.readings"
     readings_df = pd.read_sql_query(sql, con=conn)
     return readings_df
 
 
 def return_readings_gdf(conn, limit=100):
+    """
+    Returns latest readings of all sensors.
+    Each sensor contributes at most limit readings
+    read from (sensor_id, ts) index.
+    """
     sql =   """
-                SELECT readings.sensor_id, readings.date, readings.reading,
+                SELECT readings.sensor_id, readings.ts, readings.reading,
                     sensors.sensor_parameter, sensors.station_id, stations.geom
-                FROM readings
-                INNER JOIN sensors on readings.sensor_id = sensors.sensor_id
+                FROM sensors
                 INNER JOIN stations on sensors.station_id = stations.station_id
-                ORDER BY date DESC
-                LIMIT {};
-            """.format(limit)
+                CROSS JOIN LATERAL
+                (
+                    SELECT sensor_id, ts, reading FROM readings
+                    WHERE readings.sensor_id = sensors.sensor_id
+                    ORDER BY ts DESC
+                    LIMIT %(limit)s
+                ) readings
+                ORDER BY ts DESC
+                LIMIT %(limit)s;
+            """
     try:
-        return gpd.read_postgis(sql, conn, geom_col='geom')
+        with metrics.track_sql(metrics.statement_of(sql)):
+            return gpd.read_postgis(sql, conn, geom_col='geom', params={'limit': limit})
     except Exception as e:
-        print(e)
+        logger.error("query failed: %s", e, extra={"reason": metrics.failure_reason(e)})
 
 
-def return_parameter_gdf(conn, parameter='PM10'):
+def return_parameter_gdf(conn, parameter='PM10', max_age_hours=None):
     """
     Available parameters:
         NO2, O3, CO, PM2.5, PM10, C6H6, SO2
-    Returns readings from last hour
+    Returns latest reading of each sensor measuring parameter,
+    read from latest_readings view.
+    Readings older than max_age_hours are skipped.
     """
-    # create string used for query
-    now = datetime.now().strftime("%Y-%m-%d {}:00:00".format(int(datetime.now().strftime("%H"))-1))
     sql =   """
-                SELECT readings.sensor_id, readings.date, readings.reading,
-                    sensors.sensor_parameter, sensors.station_id, stations.geom
-                FROM readings
-                INNER JOIN sensors on readings.sensor_id = sensors.sensor_id
-                INNER JOIN stations on sensors.station_id = stations.station_id
-                WHERE sensors.sensor_parameter = '{}'
-                    AND readings.date = '{}'
-                ORDER BY date DESC
+                SELECT sensor_id, ts, reading, sensor_parameter, station_id, geom
+                FROM latest_readings
+                WHERE sensor_parameter = %(parameter)s
+                    AND (%(max_age_hours)s::float IS NULL
+                         OR ts >= now() - %(max_age_hours)s::float * interval '1 hour')
+                ORDER BY ts DESC
                 ;
-            """.format(parameter, now)
+            """
+    params = {'parameter': parameter, 'max_age_hours': max_age_hours}
     try:
-        return gpd.read_postgis(sql, conn, geom_col='geom')
+        with metrics.track_sql(metrics.statement_of(sql)):
+            return gpd.read_postgis(sql, conn, geom_col='geom', params=params)
     except Exception as e:
-        print(e)
+        logger.error("query failed: %s", e, extra={"reason": metrics.failure_reason(e)})
@@ -0,0 +1,266 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import http_cache, metrics
+from ._lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+logger = logging.getLogger(__name__)
+
+NoneType = type(None)
+
+GIOS_API_URL = "http://api.gios.gov.pl/pjp-api/rest/"
+
+stations_path = "station/findAll"
+sensors_path = "station/sensors/{}"  # {stationId} needed
+data_path = "data/getData/{}"  # {sensorId} needed
+aq_index_path = "aqindex/getIndex/{}"  # {stationId} needed
+
+
+def latest_value(reading_json):
+    """
+    Function returns first available (not None) value
+    from GIOŚ getData payload. Values are ordered from
+    the newest to the oldest one.
+
+    Args:
+        reading_json (dict):
+            GIOŚ getData payload
+
+    Returns:
+        reading_value (float):
+            latest available reading
+        np.NaN:
+            when payload is missing or has no values,
+            reason is counted in metrics.MISSING_READINGS
+    """
+    if reading_json is None:
+        metrics.MISSING_READINGS.inc("request_failed")
+        return np.nan
+    try:
+        for row in reading_json["values"]:
+            if not isinstance(row["value"], NoneType):
+                return row["value"]
+    except (KeyError, TypeError):
+        metrics.MISSING_READINGS.inc("invalid_payload")
+        return np.nan
+    metrics.MISSING_READINGS.inc("no_value")
+    return np.nan
+
+
+def stations_frame(stations_json):
+    """
+    Function parses GIOŚ findAll payload into DataFrame
+    with station_id, station_name, latitude and longitude columns.
+    Coordinates are converted column-wise, not per station.
+
+    Args:
+        stations_json (list):
+            list of GIOŚ air quality stations
+            represented as dictionaries
+
+    Returns:
+        stations_df (pd.DataFrame)
+    """
+    stations_df = pd.DataFrame.from_records(stations_json,
+                                            columns=["id", "stationName", "gegrLat", "gegrLon"])
+    stations_df.columns = ["station_id", "station_name", "latitude", "longitude"]
+    stations_df[["latitude", "longitude"]] = stations_df[["latitude", "longitude"]].astype(float)
+
+    return stations_df
+
+
+def sensors_frame(sensors_jsons):
+    """
+    Function parses GIOŚ sensors payloads (one list per station)
+    into DataFrame with station_id, sensor_id and parameter columns.
+    Missing payloads (None) are skipped.
+
+    Args:
+        sensors_jsons (list):
+            list of GIOŚ station/sensors payloads
+
+    Returns:
+        sensors_df (pd.DataFrame)
+    """
+    records = [(sensor["stationId"], sensor["id"], sensor["param"]["paramCode"])
+               for sensors in sensors_jsons
+               for sensor in sensors or []]
+
+    return pd.DataFrame.from_records(records, columns=["station_id", "sensor_id", "parameter"])
+
+
+class Harvester(object):
+    """
+    Concurrent client for GIOŚ API.
+
+    Requests are executed by bounded thread pool and share
+    one HTTP session, so connections to the API host are kept
+    alive and reused between requests. Failed requests
+    (connection errors and 429/5xx responses) are retried
+    with exponential backoff.
+
+    Args:
+        base_url (string) - default GIOS_API_URL:
+            root of the API, can point to local stub server
+
+        max_workers (int) - default 16:
+            maximum number of concurrent requests
+
+        timeout (float) - default 10:
+            per request timeout in seconds
+
+        retries (int) - default 3:
+            number of retries for failed request
+
+        backoff_factor (float) - default 0.5:
+            backoff factor, sleep between retries
+            equals backoff_factor * 2 ** (retry - 1)
+
+        cache (http_cache.ResponseCache) - default None:
+            response cache, http_cache default cache
+            (if enabled) is used when None
+
+    Example:
+        In [1]: with Harvester(max_workers=32) as harvester:
+                    stations_json = harvester.get_stations()
+                    sensors_df = harvester.create_sensors_df(stations_json)
+                    sensors_df = harvester.get_latest_sensors_readings(sensors_df)
+    """
+
+    def __init__(self, base_url=GIOS_API_URL, max_workers=16, timeout=10,
+                 retries=3, backoff_factor=0.5, cache=None):
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.cache = cache if cache is not None else http_cache.get_default_cache()
+
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=max_workers,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Function waits for pending requests
+        and closes HTTP connections.
+        """
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def get_json(self, path):
+        """
+        Function requests given API path
+        and returns decoded JSON response.
+        """
+        url = self.base_url + path
+        if self.cache is not None:
+            return self.cache.get_json(url, self.session, self.timeout)
+        response = http_cache.fetch(url, self.session, timeout=self.timeout)
+        response.raise_for_status()
+        with metrics.track_serialization("json"):
+            return response.json()
+
+    def _get_json_or_none(self, path):
+        try:
+            return self.get_json(path)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("request %s failed: %s", path, e,
+                           extra={"path": path, "reason": metrics.failure_reason(e)})
+            return None
+
+    def get_many(self, paths):
+        """
+        Function requests all paths concurrently.
+        Responses are returned in the same order as paths,
+        None is returned for requests which failed.
+        """
+        return list(self._executor.map(self._get_json_or_none, paths))
+
+    def get_stations(self):
+        """
+        Function returns list of dictionaries
+        with requested air quality stations.
+        Equivalent of haqs_api.get_stations().
+        """
+        return self.get_json(stations_path)
+
+    def get_sensors(self, station_ids):
+        """
+        Function returns list of sensors JSON
+        for each of requested stations.
+        """
+        return self.get_many([sensors_path.format(station_id)
+                              for station_id in station_ids])
+
+    def get_sensors_data(self, sensor_ids):
+        """
+        Function returns list of getData JSON
+        for each of requested sensors.
+        """
+        return self.get_many([data_path.format(sensor_id)
+                              for sensor_id in sensor_ids])
+
+    def get_aq_indexes(self, station_ids):
+        """
+        Function returns list of getIndex JSON
+        for each of requested stations.
+        """
+        return self.get_many([aq_index_path.format(station_id)
+                              for station_id in station_ids])
+
+    def create_sensors_df(self, stations_json):
+        """
+        Function returns DataFrame of sensors requested from GIOS API.
+        Equivalent of haqs_api.create_sensors_df(stations_json).
+
+        Args:
+            stations_json (list):
+                list of GIOŚ air quality stations
+                represented as dictionaries
+
+        Returns:
+            sensors_df (pd.DataFrame):
+                pandas DataFrame with station_id,
+                sensor_id and parameter columns
+        """
+        station_ids = [station["id"] for station in stations_json]
+
+        return sensors_frame(self.get_sensors(station_ids))
+
+    def get_latest_sensors_readings(self, sensors_df):
+        """
+        Function gets latest reading for each row in sensors_df DataFrame.
+        Equivalent of haqs_api.get_latest_sensors_readings(sensors_df),
+        function modifies DataFrame inplace.
+
+        Args:
+            sensors_df (pd.DataFrame):
+                pandas DataFrame with all available sensors.
+
+        Returns:
+            sensors_df (pd.DataFrame)
+        """
+        payloads = self.get_sensors_data(sensors_df["sensor_id"].tolist())
+        sensors_df["value"] = [latest_value(payload) for payload in payloads]
+
+        return sensors_df
@@ -0,0 +1,127 @@
+"""
+Binary batch format of home station readings.
+
+Instead of one text message per metric per second, home station
+aggregates its samples and publishes one message per interval
+to '<device_id>/haqs/batch' topic. All numbers are little-endian.
+
+Header (12 bytes):
+    magic      2s   b'HQ'
+    version    B    1
+    mask       B    bit i set when CHANNELS[i] is present
+    timestamp  I    RTC time of first sample, seconds since epoch (UTC)
+    interval   H    interval length in seconds
+    samples    H    number of samples in interval
+
+Followed by min, mean and max (3 x float32, 12 bytes) of each
+present channel, in CHANNELS order. Batch with all channels
+takes 84 bytes.
+
+Reference C encoder lives in
+sketches/Home-Air-Quality-Station-MQTT-NodeRED/haqs_batch.h.
+
+Example:
+    In [1]: payload = encode_batch(1539550800, {'pm10': (20.0, 24.5, 31.0)},
+                                   interval=60, samples=60)
+            decode_batch(payload)
+    Out[1]: {'timestamp': 1539550800, 'interval': 60, 'samples': 60,
+             'metrics': {'pm10': (20.0, 24.5, 31.0)}}
+"""
+import math
+import struct
+
+MAGIC = b"HQ"
+VERSION = 1
+BATCH_TOPIC = "haqs/batch"
+
+# channel order, bit i of mask stands for CHANNELS[i]
+CHANNELS = ("temperature", "humidity", "pressure", "pm1", "pm2_5", "pm10")
+
+HEADER = struct.Struct("<2sBBIHH")
+CHANNEL = struct.Struct("<fff")
+
+
+class BatchError(ValueError):
+    pass
+
+
+def encode_batch(timestamp, metrics, interval, samples):
+    """
+    Function returns binary batch payload.
+
+    Args:
+        timestamp (int):
+            time of first sample, seconds since epoch
+
+        metrics (dict):
+            metric -> (min, mean, max), metrics missing
+            in CHANNELS are not encoded
+
+        interval (int):
+            interval length in seconds
+
+        samples (int):
+            number of samples in interval
+    """
+    mask = 0
+    body = []
+    for bit, channel in enumerate(CHANNELS):
+        if channel in metrics:
+            mask |= 1 << bit
+            body.append(CHANNEL.pack(*metrics[channel]))
+    return HEADER.pack(MAGIC, VERSION, mask, int(timestamp), interval, samples) + b"".join(body)
+
+
+def decode_batch(payload):
+    """
+    Function decodes binary batch payload,
+    BatchError is raised for malformed payloads.
+
+    Returns:
+        batch (dict):
+            timestamp, interval, samples and
+            metrics (metric -> (min, mean, max))
+    """
+    if len(payload) < HEADER.size:
+        raise BatchError("payload too short: {} bytes".format(len(payload)))
+    magic, version, mask, timestamp, interval, samples = HEADER.unpack_from(payload)
+    if magic != MAGIC or version != VERSION:
+        raise BatchError("unsupported payload: magic {!r}, version {}".format(magic, version))
+
+    if mask >> len(CHANNELS):
+        raise BatchError("unknown channels in mask {:#04x}".format(mask))
+
+    channels = [channel for bit, channel in enumerate(CHANNELS) if mask & (1 << bit)]
+    if len(payload) != HEADER.size + CHANNEL.size * len(channels):
+        raise BatchError("payload length {} does not match mask {:#04x}".format(len(payload), mask))
+
+    values = CHANNEL.iter_unpack(payload[HEADER.size:])
+    return {"timestamp": timestamp,
+            "interval": interval,
+            "samples": samples,
+            "metrics": dict(zip(channels, values))}
+
+
+def summarize(samples):
+    """
+    Function returns metric -> (min, mean, max) of samples.
+    Python counterpart of device side aggregation,
+    None and NaN values are skipped.
+
+    Args:
+        samples (list):
+            list of dictionaries metric -> value
+
+    Example:
+        In [1]: summarize([{'pm10': 20}, {'pm10': 31, 'pm1': None}])
+        Out[1]: {'pm10': (20.0, 25.5, 31.0)}
+    """
+    stats = {}
+    for sample in samples:
+        for metric, value in sample.items():
+            if value is None or math.isnan(value):
+                continue
+            low, total, high, count = stats.get(metric, (value, 0.0, value, 0))
+            stats[metric] = (min(low, value), total + value, max(high, value), count + 1)
+    return {metric: (float(low), total / count, float(high))
+            for metric, (low, total, high, count) in stats.items()}
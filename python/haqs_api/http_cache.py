@@ -0,0 +1,264 @@
+"""
+Persistent cache of GIOŚ API responses.
+
+Responses are stored (zlib compressed) in SQLite database
+with per-endpoint time to live. Expired responses are revalidated
+with If-None-Match / If-Modified-Since when server sent ETag or
+Last-Modified header. Least recently used responses are evicted
+when cache grows over max_size bytes.
+
+Cache is disabled by default, it is enabled by enable() or by
+HAQS_HTTP_CACHE environment variable pointing to cache file.
+
+Example:
+    In [1]: from haqs_api import http_cache
+            http_cache.enable()
+            stations_json = haqs_api.get_stations()  # miss
+            stations_json = haqs_api.get_stations()  # hit
+            http_cache.get_default_cache().stats()
+    Out[1]: {'hits': 1, 'misses': 1, 'revalidated': 0, 'evictions': 0,
+             'entries': 1, 'size': 10412}
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import requests
+
+from . import metrics
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "haqs_api", "http_cache.sqlite")
+
+# (url fragment, time to live in seconds), first match wins,
+# readings expire before daemon.MIN_RETRY, so retried sensors are fetched again
+DEFAULT_TTLS = (
+    ("station/findAll", 24 * 3600),
+    ("station/sensors/", 24 * 3600),
+    ("data/getData/", 60),
+    ("aqindex/getIndex/", 10 * 60),
+)
+DEFAULT_TTL = 10 * 60
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+class ResponseCache(object):
+    """
+    SQLite backed HTTP response cache.
+
+    Args:
+        path (string) - default DEFAULT_PATH:
+            cache file, ':memory:' keeps cache in memory
+
+        max_size (int) - default 200 MB:
+            maximum size of stored (compressed) responses in bytes
+
+        ttls (tuple) - default DEFAULT_TTLS:
+            (url fragment, seconds) pairs
+
+        default_ttl (int) - default DEFAULT_TTL:
+            time to live of urls not matching any of ttls
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_size=200 * 1024 * 1024,
+                 ttls=DEFAULT_TTLS, default_ttl=DEFAULT_TTL):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.counters = {"hits": 0, "misses": 0, "revalidated": 0, "evictions": 0}
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""
+                            CREATE TABLE IF NOT EXISTS responses
+                            (
+                                url TEXT PRIMARY KEY,
+                                body BLOB NOT NULL,
+                                etag TEXT,
+                                last_modified TEXT,
+                                expires_at REAL NOT NULL,
+                                accessed_at REAL NOT NULL,
+                                size INTEGER NOT NULL
+                            );
+                         """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);")
+        self._db.commit()
+
+    def ttl(self, url):
+        for fragment, seconds in self.ttls:
+            if fragment in url:
+                return seconds
+        return self.default_ttl
+
+    def _lookup(self, url):
+        with self._lock:
+            return self._db.execute("""
+                                        SELECT body, etag, last_modified, expires_at
+                                        FROM responses WHERE url = ?;
+                                    """, (url,)).fetchone()
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _touch(self, url, expires_at=None):
+        now = time.time()
+        with self._lock:
+            if expires_at is None:
+                self._db.execute("UPDATE responses SET accessed_at = ? WHERE url = ?;", (now, url))
+            else:
+                self._db.execute("UPDATE responses SET accessed_at = ?, expires_at = ? WHERE url = ?;",
+                                 (now, expires_at, url))
+            self._db.commit()
+
+    def _store(self, url, content, etag, last_modified):
+        body = zlib.compress(content)
+        now = time.time()
+        with self._lock:
+            self._db.execute("""
+                                INSERT OR REPLACE INTO responses
+                                (url, body, etag, last_modified, expires_at, accessed_at, size)
+                                VALUES (?, ?, ?, ?, ?, ?, ?);
+                             """, (url, body, etag, last_modified, now + self.ttl(url), now, len(body)))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute("SELECT coalesce(sum(size), 0) FROM responses;").fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self._db.execute("SELECT url, size FROM responses ORDER BY accessed_at;").fetchall()
+        for url, size in rows:
+            if total <= self.max_size:
+                break
+            self._db.execute("DELETE FROM responses WHERE url = ?;", (url,))
+            total -= size
+            self.counters["evictions"] += 1  # called with self._lock held
+
+    def get(self, url, session=None, timeout=None):
+        """
+        Function returns response body (bytes) of url,
+        from cache when possible.
+
+        Args:
+            url (string)
+
+            session (requests.Session) - default None:
+                session used for requests, module level
+                requests.get is used when None
+
+            timeout (float) - default None:
+                request timeout in seconds
+        """
+        http = session or requests
+        row = self._lookup(url)
+        headers = {}
+
+        if row is not None:
+            body, etag, last_modified, expires_at = row
+            if expires_at > time.time():
+                self._touch(url)
+                self._count("hits")
+                return zlib.decompress(body)
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        response = fetch(url, http, headers=headers, timeout=timeout)
+        if response.status_code == 304 and row is not None:
+            self._touch(url, time.time() + self.ttl(url))
+            self._count("revalidated")
+            return zlib.decompress(row[0])
+
+        response.raise_for_status()
+        self._count("misses")
+        self._store(url, response.content, response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"))
+        return response.content
+
+    def get_json(self, url, session=None, timeout=None):
+        body = self.get(url, session, timeout)
+        with metrics.track_serialization("json"):
+            return json.loads(body.decode("utf-8"))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses;")
+            self._db.commit()
+
+    def stats(self):
+        """
+        Function returns cache counters together with
+        number of entries and size of stored responses.
+        """
+        with self._lock:
+            entries, size = self._db.execute(
+                "SELECT count(*), coalesce(sum(size), 0) FROM responses;").fetchone()
+        stats = dict(self.counters)
+        stats.update({"entries": entries, "size": size})
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def fetch(url, session=None, **kwargs):
+    """
+    Function requests url with session (or requests module),
+    request time and failures are recorded in metrics.
+    """
+    with metrics.track_http(url):
+        response = (session or requests).get(url, **kwargs)
+    metrics.http_status(url, response.status_code)
+    return response
+
+
+def enable(path=None, **kwargs):
+    """
+    Function enables default cache used by haqs_api functions.
+    Path defaults to HAQS_HTTP_CACHE variable or DEFAULT_PATH.
+    """
+    global _default_cache
+    with _default_lock:
+        _default_cache = ResponseCache(path or os.environ.get("HAQS_HTTP_CACHE") or DEFAULT_PATH,
+                                       **kwargs)
+        return _default_cache
+
+
+def disable():
+    global _default_cache
+    with _default_lock:
+        if _default_cache is not None:
+            _default_cache.close()
+        _default_cache = None
+
+
+def get_default_cache():
+    """
+    Function returns default cache, None when cache is disabled.
+    """
+    if _default_cache is None and os.environ.get("HAQS_HTTP_CACHE"):
+        enable()
+    return _default_cache
+
+
+def get_json(url, session=None, timeout=None):
+    """
+    Function returns decoded JSON response of url,
+    through default cache when it is enabled.
+    """
+    cache = get_default_cache()
+    if cache is not None:
+        return cache.get_json(url, session, timeout)
+    response = fetch(url, session, timeout=timeout)
+    with metrics.track_serialization("json"):
+        return response.json()
@@ -0,0 +1,235 @@
+"""
+Bulk ingestion of sensor readings.
+
+Readings are streamed into temporary staging table with
+COPY FROM STDIN and merged into readings table with single
+set-based INSERT ... ON CONFLICT DO NOTHING per batch.
+Dates are GIOŚ local time strings, they are converted
+to readings.ts during the merge.
+
+Newly inserted rows of current batch are kept in ingested_readings
+temporary table until commit, so they can be checked by anomaly
+detection and rollups can be updated for touched buckets only.
+
+Time of every ingestion step (staging, merge, anomaly detection,
+rollups and AQ index update) and rolled back batches are recorded
+in metrics module.
+"""
+import io
+import math
+
+from . import metrics
+from .anomaly import anomaly_exists, detect_anomalies as _detect_anomalies
+from .aq_index import aq_index_exists, update_aq_index
+from .rollups import rollups_exist, update_rollups as _update_rollups
+from .schema import GIOS_TIMEZONE
+
+NoneType = type(None)
+
+
+def create_staging_table(conn):
+    """
+    Function creates session scoped staging tables.
+    Rows are removed automatically on each commit.
+    """
+    sql =   """
+                CREATE TEMP TABLE IF NOT EXISTS readings_staging
+                (
+                    sensor_id INTEGER,
+                    date VARCHAR(19),
+                    reading FLOAT(4)
+                )
+                ON COMMIT DELETE ROWS;
+                CREATE TEMP TABLE IF NOT EXISTS ingested_readings
+                (
+                    sensor_id INTEGER,
+                    ts TIMESTAMPTZ,
+                    reading REAL
+                )
+                ON COMMIT DELETE ROWS;
+            """
+    cur = conn.cursor()
+    cur.execute(sql)
+
+
+def records_from_payload(sensor_id, data_json):
+    """
+    Function converts GIOŚ getData payload
+    into (sensor_id, date, reading) records.
+
+    Args:
+        sensor_id (int)
+
+        data_json (dict):
+            GIOŚ getData payload
+
+    Returns:
+        records (list):
+            list of (sensor_id, date, reading) tuples
+
+    Example:
+        In [1]: data_json = requests.get(data_request + str(sensor_id)).json()
+                records = records_from_payload(sensor_id, data_json)
+                records[:2]
+        Out[1]: [(642, '2018-10-14 15:00:00', 24.1671),
+                 (642, '2018-10-14 14:00:00', 26.5432)]
+    """
+    return [(sensor_id, row["date"], row["value"])
+            for row in (data_json or {}).get("values", [])]
+
+
+def _iter_records(readings):
+    if hasattr(readings, "itertuples"):  # pandas DataFrame
+        return readings[["sensor_id", "date", "reading"]].itertuples(index=False, name=None)
+    return iter(readings)
+
+
+def _is_null(value):
+    return isinstance(value, NoneType) or (isinstance(value, float) and math.isnan(value))
+
+
+def _copy_batch(cur, batch):
+    buffer = io.StringIO()
+    with metrics.track_serialization("tsv"):
+        for sensor_id, date, reading in batch:
+            buffer.write("{}\t{}\t{!r}\n".format(int(sensor_id), date, float(reading)))
+    buffer.seek(0)
+    cur.copy_expert("COPY readings_staging (sensor_id, date, reading) FROM STDIN", buffer)
+
+
+def _merge_batch(cur):
+    sql =   """
+                WITH inserted AS
+                (
+                    INSERT INTO public.readings (sensor_id, ts, reading)
+                    SELECT DISTINCT ON (sensor_id, ts) sensor_id, ts, reading
+                    FROM
+                    (
+                        SELECT sensor_id, date::timestamp AT TIME ZONE %s AS ts, reading
+                        FROM readings_staging
+                    ) staging
+                    ORDER BY sensor_id, ts
+                    ON CONFLICT (sensor_id, ts) DO NOTHING
+                    RETURNING sensor_id, ts, reading
+                )
+                INSERT INTO ingested_readings (sensor_id, ts, reading)
+                SELECT sensor_id, ts, reading FROM inserted;
+            """
+    cur.execute(sql, (GIOS_TIMEZONE,))
+    return cur.rowcount
+
+
+def refresh_latest_readings(conn):
+    """
+    Function refreshes latest_readings materialized view
+    without blocking its readers. Nothing is done when
+    view has not been created.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('public.latest_readings') IS NOT NULL;")
+    if cur.fetchone()[0]:
+        with metrics.track_sql("refresh:latest_readings"):
+            cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY public.latest_readings;")
+    conn.commit()
+
+
+def bulk_insert_readings(conn, readings, batch_size=50000, refresh_latest=True,
+                         update_rollups=True, detect_anomalies=True):
+    """
+    Function inserts readings in batches.
+    Each batch is copied into staging table, merged
+    into readings table and committed once.
+    Readings which already exist in DataBase and readings
+    without value are skipped.
+
+    Args:
+        conn (psycopg2.connection):
+            connection object for DataBase session.
+
+        readings (pd.DataFrame or iterable):
+            DataFrame with sensor_id, date and reading columns
+            or iterable of (sensor_id, date, reading) records
+
+        batch_size (int) - default 50000:
+            number of records committed at once
+
+        refresh_latest (bool) - default True:
+            refresh latest_readings view when new readings were inserted
+
+        update_rollups (bool) - default True:
+            update rollups.GRAINS tables for buckets touched
+            by each batch, when the tables exist, and
+            aq_index tables (which are computed from hourly rollups)
+
+        detect_anomalies (bool) - default True:
+            check inserted readings with anomaly.detect_anomalies()
+            before rollups are updated, when anomaly tables exist
+
+    Returns:
+        inserted (int):
+            number of inserted readings
+
+        skipped (int):
+            number of duplicated or empty readings
+
+    Example:
+        In [1]: records = []
+                for sensor_id in sensors_ids:
+                    data_json = requests.get(data_request + str(sensor_id)).json()
+                    records.extend(records_from_payload(sensor_id, data_json))
+                bulk_insert_readings(conn, records)
+        Out[1]: (3412, 588)
+    """
+    inserted = 0
+    skipped = 0
+    batch = []
+    with_rollups = update_rollups and rollups_exist(conn)
+    with_aq_index = with_rollups and aq_index_exists(conn)
+    with_anomaly = detect_anomalies and anomaly_exists(conn)
+
+    def flush():
+        cur = conn.cursor()
+        try:
+            create_staging_table(conn)
+            with metrics.track_sql("copy:readings_staging"):
+                _copy_batch(cur, batch)
+            with metrics.track_sql("insert:readings"):
+                count = _merge_batch(cur)
+            if count and with_anomaly:
+                with metrics.track_sql("ingest:anomaly"):
+                    flagged = _detect_anomalies(conn)
+                metrics.FLAGGED_READINGS.observe(flagged)
+            if count and with_rollups:
+                with metrics.track_sql("ingest:rollups"):
+                    _update_rollups(conn)
+            if count and with_aq_index:
+                with metrics.track_sql("ingest:aq_index"):
+                    update_aq_index(conn)
+            with metrics.track_sql("commit"):
+                conn.commit()
+        except Exception:
+            metrics.ROLLBACKS.inc("ingest")
+            conn.rollback()
+            raise
+        return count
+
+    for record in _iter_records(readings):
+        if _is_null(record[2]):
+            skipped += 1
+            continue
+        batch.append(record)
+        if len(batch) >= batch_size:
+            count = flush()
+            inserted += count
+            skipped += len(batch) - count
+            batch = []
+
+    if batch:
+        count = flush()
+        inserted += count
+        skipped += len(batch) - count
+
+    if inserted and refresh_latest:
+        refresh_latest_readings(conn)
+
+    return inserted, skipped
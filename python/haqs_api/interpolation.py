@@ -0,0 +1,496 @@
+"""
+Gridded interpolation of station readings.
+
+Readings of one parameter are interpolated on regular grid in
+Poland CS92 (EPSG:2180, metres) with inverse distance weighting
+or local ordinary kriging over k nearest stations (KD-tree).
+
+Both methods estimate each cell as weighted sum of station values,
+and weights depend only on station and cell positions. Weights are
+computed once per grid and set of stations (sparse cells x stations
+matrix), kept in memory and optionally on disk, so each new hour
+only needs one sparse matrix - vector product. Stations without
+reading in given hour (NaN value) do not invalidate weights of all
+stations: IDW weights of missing stations are dropped and rows are
+renormalised, kriging weights are solved again only for cells which
+have missing station among their neighbours.
+
+interpolate_parameters() keeps Interpolator of each parameter in
+long-lived worker process, so its weights stay in memory between hours.
+
+Example:
+    In [1]: grid = Grid(resolution=1000)
+            surfaces = interpolate_parameters(
+                {parameter: parameter_points(conn, parameter)
+                 for parameter in ['PM10', 'PM2.5', 'NO2']},
+                grid, method='idw', cache_dir='weights')
+            save_geotiff('pm10.tif', surfaces['PM10'], grid)
+"""
+import atexit
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+GRID_CRS = "EPSG:2180"
+# xmin, ymin, xmax, ymax of Poland in EPSG:2180
+POLAND_BOUNDS = (140000.0, 120000.0, 890000.0, 800000.0)
+
+
+class Grid(object):
+    """
+    Regular grid, rows go from north to south (raster order).
+
+    Args:
+        bounds (tuple) - default POLAND_BOUNDS:
+            xmin, ymin, xmax, ymax in metres
+
+        resolution (float) - default 1000:
+            cell size in metres
+    """
+
+    def __init__(self, bounds=POLAND_BOUNDS, resolution=1000.0):
+        self.bounds = tuple(float(value) for value in bounds)
+        self.resolution = float(resolution)
+        xmin, ymin, xmax, ymax = self.bounds
+        self.width = int(np.ceil((xmax - xmin) / self.resolution))
+        self.height = int(np.ceil((ymax - ymin) / self.resolution))
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    @property
+    def key(self):
+        return "{}_{}_{}_{}_{}".format(*(self.bounds + (self.resolution,)))
+
+    @property
+    def transform(self):
+        """
+        GDAL geotransform of grid.
+        """
+        xmin, _, _, ymax = self.bounds
+        return (xmin, self.resolution, 0.0, ymax, 0.0, -self.resolution)
+
+    def cell_centers(self):
+        """
+        Function returns (height * width, 2) array of cell centres.
+        """
+        xmin, _, _, ymax = self.bounds
+        x = xmin + (np.arange(self.width) + 0.5) * self.resolution
+        y = ymax - (np.arange(self.height) + 0.5) * self.resolution
+        xx, yy = np.meshgrid(x, y)
+        return np.column_stack([xx.ravel(), yy.ravel()])
+
+
+def _neighbours(stations_xy, cells_xy, k, max_distance):
+    k = min(k, len(stations_xy))
+    distances, indices = cKDTree(stations_xy).query(cells_xy, k=k,
+                                                    distance_upper_bound=max_distance)
+    if k == 1:
+        distances, indices = distances[:, None], indices[:, None]
+    return distances, indices
+
+
+def _weights_matrix(weights, indices, n_stations):
+    valid = indices < n_stations
+    rows = np.repeat(np.arange(len(indices)), indices.shape[1])[valid.ravel()]
+    return sparse.csr_matrix((weights[valid], (rows, indices[valid])),
+                             shape=(len(indices), n_stations))
+
+
+def _entries(matrix):
+    coo = matrix.tocoo()
+    return coo.row.astype(np.int64), coo.col.astype(np.int64), coo.data
+
+
+def idw_weights(stations_xy, cells_xy, k=8, power=2, max_distance=50000.0):
+    """
+    Function returns sparse (cells x stations) matrix
+    of inverse distance weights. Rows of cells without
+    stations within max_distance are empty.
+    """
+    distances, indices = _neighbours(stations_xy, cells_xy, k, max_distance)
+    valid = indices < len(stations_xy)
+    weights = np.zeros_like(distances)
+    weights[valid] = 1.0 / np.maximum(distances[valid], 1e-6) ** power
+    weights /= np.maximum(weights.sum(axis=1, keepdims=True), 1e-300)
+    return _weights_matrix(weights, indices, len(stations_xy))
+
+
+def exponential_variogram(h, range_=50000.0, sill=1.0, nugget=0.0):
+    gamma = nugget + (sill - nugget) * (1.0 - np.exp(-3.0 * h / range_))
+    return np.where(h > 0, gamma, 0.0)
+
+
+def kriging_weights(stations_xy, cells_xy, k=8, range_=50000.0, sill=1.0, nugget=0.0,
+                    max_distance=50000.0, chunk_size=100000):
+    """
+    Function returns sparse (cells x stations) matrix of local
+    ordinary kriging weights with exponential variogram.
+    Kriging systems of all cells are solved in vectorized batches.
+    """
+    stations_xy = np.asarray(stations_xy, dtype=float)
+    distances, indices = _neighbours(stations_xy, cells_xy, k, max_distance)
+    n_stations = len(stations_xy)
+    n_cells, k = indices.shape
+    weights = np.zeros((n_cells, k))
+
+    # neighbours missing within max_distance get zero weight
+    # (identity row in kriging system), cells without neighbours stay empty
+    found = indices < n_stations
+    solvable = np.nonzero(found.any(axis=1))[0]
+    for start in range(0, len(solvable), chunk_size):
+        rows = solvable[start:start + chunk_size]
+        valid = found[rows]
+        neighbours = stations_xy[np.where(valid, indices[rows], 0)]  # (m, k, 2)
+        pairwise = np.linalg.norm(neighbours[:, :, None, :] - neighbours[:, None, :, :], axis=-1)
+        pair_valid = valid[:, :, None] & valid[:, None, :]
+
+        system = np.zeros((len(rows), k + 1, k + 1))
+        system[:, :k, :k] = np.where(pair_valid, exponential_variogram(pairwise, range_, sill, nugget), 0.0)
+        # duplicated station positions would make system singular
+        system[:, :k, :k] += np.eye(k) * np.where(valid, 1e-9 * sill, 1.0)[:, :, None]
+        system[:, :k, k] = valid
+        system[:, k, :k] = valid
+        target = np.zeros((len(rows), k + 1))
+        target[:, :k] = np.where(valid, exponential_variogram(np.where(valid, distances[rows], 0.0),
+                                                               range_, sill, nugget), 0.0)
+        target[:, k] = 1.0
+
+        weights[rows] = np.linalg.solve(system, target[..., None])[:, :k, 0]
+
+    return _weights_matrix(weights, indices, n_stations)
+
+
+WEIGHT_FUNCTIONS = {"idw": idw_weights, "kriging": kriging_weights}
+
+
+class Interpolator(object):
+    """
+    Interpolator with cache of weights matrices.
+
+    Args:
+        grid (Grid)
+
+        method (string) - default 'idw':
+            'idw' or 'kriging'
+
+        cache_dir (string) - default None:
+            directory where weights are stored (.npz),
+            shared by processes and kept between runs
+
+        cache_size (int) - default 32:
+            number of weights matrices kept in memory
+
+        **params:
+            arguments of idw_weights() or kriging_weights()
+            (k, power, range_, sill, nugget, max_distance)
+
+    Example:
+        In [1]: interpolator = Interpolator(Grid(), method='kriging', range_=40000)
+                surface = interpolator.interpolate(*parameter_points(conn, 'PM10'))
+    """
+
+    def __init__(self, grid, method="idw", cache_dir=None, cache_size=32, **params):
+        if method not in WEIGHT_FUNCTIONS:
+            raise ValueError("unknown method {!r}, use one of {}".format(method, sorted(WEIGHT_FUNCTIONS)))
+        self.grid = grid
+        self.method = method
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.params = params
+        self._cache = OrderedDict()
+        self._cells = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, station_ids, stations_xy):
+        digest = hashlib.sha1()
+        digest.update(json.dumps([self.grid.key, self.method, sorted(self.params.items())]).encode("utf-8"))
+        digest.update(np.asarray(station_ids, dtype=np.int64).tobytes())
+        digest.update(np.round(np.asarray(stations_xy, dtype=float), 1).tobytes())
+        return digest.hexdigest()
+
+    def _cached(self, key):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        return None
+
+    def _remember(self, key, matrix):
+        self._cache[key] = matrix
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return matrix
+
+    def _cells_xy(self):
+        if self._cells is None:
+            self._cells = self.grid.cell_centers()
+        return self._cells
+
+    def weights(self, station_ids, stations_xy):
+        """
+        Function returns cached weights matrix of stations,
+        matrix is computed when it is not cached yet.
+        """
+        key = self._key(station_ids, stations_xy)
+        matrix = self._cached(key)
+        if matrix is not None:
+            return matrix
+
+        path = os.path.join(self.cache_dir, key + ".npz") if self.cache_dir else None
+        if path and os.path.exists(path):
+            matrix = sparse.load_npz(path)
+        else:
+            matrix = WEIGHT_FUNCTIONS[self.method](np.asarray(stations_xy, dtype=float),
+                                                   self._cells_xy(), **self.params)
+            if path:
+                tmp_path = "{}.{}.tmp.npz".format(path, os.getpid())
+                sparse.save_npz(tmp_path, matrix)
+                os.replace(tmp_path, path)
+        return self._remember(key, matrix)
+
+    def _rebuild_rows(self, rows, stations_xy, available):
+        """
+        Function returns (rows, columns, weights) entries of
+        cells rows computed from available stations only.
+        """
+        if not len(rows) or not available.any():
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([])
+        columns = np.nonzero(available)[0]
+        sub_rows, sub_columns, data = _entries(WEIGHT_FUNCTIONS[self.method](
+            stations_xy[available], self._cells_xy()[rows], **self.params))
+        return rows[sub_rows], columns[sub_columns], data
+
+    def subset_weights(self, station_ids, stations_xy, available):
+        """
+        Function returns weights matrix (columns of all stations)
+        which uses only available stations, derived from
+        cached weights of all stations:
+            idw     - weights of missing stations are dropped and
+                      rows renormalised, only cells left without
+                      stations are computed again
+            kriging - cells with missing station among
+                      neighbours are computed again
+
+        Args:
+            station_ids (array)
+
+            stations_xy (array)
+
+            available (array):
+                boolean mask of stations with reading
+        """
+        matrix = self.weights(station_ids, stations_xy)
+        if available.all():
+            return matrix
+
+        key = "{}-{}".format(self._key(station_ids, stations_xy),
+                             hashlib.sha1(np.packbits(available).tobytes()).hexdigest())
+        subset = self._cached(key)
+        if subset is not None:
+            return subset
+
+        rows, columns, data = _entries(matrix)
+        kept = available[columns]
+        if self.method == "idw":
+            totals = np.bincount(rows[kept], weights=data[kept], minlength=matrix.shape[0])
+            rebuilt = np.nonzero((totals == 0) & (np.diff(matrix.indptr) > 0))[0]
+            rows, columns, data = rows[kept], columns[kept], data[kept] / totals[rows[kept]]
+        else:
+            affected = np.zeros(matrix.shape[0], dtype=bool)
+            affected[rows[~kept]] = True
+            rebuilt = np.nonzero(affected)[0]
+            unchanged = ~affected[rows]
+            rows, columns, data = rows[unchanged], columns[unchanged], data[unchanged]
+
+        new_rows, new_columns, new_data = self._rebuild_rows(rebuilt, np.asarray(stations_xy, dtype=float),
+                                                             available)
+        subset = sparse.csr_matrix((np.concatenate([data, new_data]),
+                                    (np.concatenate([rows, new_rows]),
+                                     np.concatenate([columns, new_columns]))),
+                                   shape=matrix.shape)
+        return self._remember(key, subset)
+
+    def interpolate(self, station_ids, stations_xy, values):
+        """
+        Function returns (height, width) array of estimates,
+        NaN marks cells without stations within max_distance.
+        Stations with NaN value are left out, weights
+        are derived from weights of all given stations,
+        so stations should be passed even without reading.
+        """
+        station_ids = np.asarray(station_ids)
+        stations_xy = np.asarray(stations_xy, dtype=float)
+        values = np.asarray(values, dtype=float)
+
+        order = np.argsort(station_ids, kind="mergesort")
+        station_ids, stations_xy, values = station_ids[order], stations_xy[order], values[order]
+        available = np.isfinite(values)
+        if not available.any():
+            return np.full(self.grid.shape, np.nan)
+
+        matrix = self.subset_weights(station_ids, stations_xy, available)
+        surface = matrix.dot(np.where(available, values, 0.0))
+        surface[np.diff(matrix.indptr) == 0] = np.nan
+        return surface.reshape(self.grid.shape)
+
+
+# Interpolators of current (worker) process, kept between calls
+_interpolators = {}
+# max_workers -> _Workers kept between calls of interpolate_parameters()
+_workers = {}
+
+
+def _interpolator(grid, method, cache_dir, params, parameter):
+    key = (parameter, grid.key, method, cache_dir, json.dumps(sorted(params.items())))
+    if key not in _interpolators:
+        _interpolators[key] = Interpolator(grid, method, cache_dir, **params)
+    return _interpolators[key]
+
+
+def _interpolate_job(args):
+    grid, method, cache_dir, params, parameter, points = args
+    return _interpolator(grid, method, cache_dir, params, parameter).interpolate(*points)
+
+
+class _Workers(object):
+    """
+    Single process executors, parameter is always sent to
+    the same process, so its Interpolator stays in memory.
+    """
+
+    def __init__(self, max_workers):
+        self.executors = [ProcessPoolExecutor(max_workers=1)
+                          for _ in range(max_workers or os.cpu_count() or 1)]
+        self.assigned = {}
+
+    def submit(self, job):
+        parameter = job[4]
+        if parameter not in self.assigned:
+            self.assigned[parameter] = len(self.assigned) % len(self.executors)
+        return self.executors[self.assigned[parameter]].submit(_interpolate_job, job)
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown()
+
+
+def shutdown_workers():
+    """
+    Function stops worker processes of interpolate_parameters().
+    """
+    while _workers:
+        _workers.popitem()[1].shutdown()
+
+
+atexit.register(shutdown_workers)
+
+
+def interpolate_parameters(points, grid, method="idw", cache_dir=None, max_workers=None,
+                           **params):
+    """
+    Function interpolates several parameters in parallel processes.
+
+    Args:
+        points (dict):
+            parameter -> (station_ids, stations_xy, values),
+            i.e. output of parameter_points()
+
+        grid (Grid)
+
+        method (string) - default 'idw'
+
+        cache_dir (string) - default None:
+            weights cache shared by worker processes
+
+        max_workers (int) - default None:
+            number of processes, parameters are interpolated
+            in current process when 1. Processes are kept
+            until shutdown_workers() is called (or exit)
+
+    Returns:
+        surfaces (dict):
+            parameter -> (height, width) array
+    """
+    jobs = [(grid, method, cache_dir, params, parameter, points[parameter]) for parameter in points]
+    if max_workers == 1 or len(jobs) < 2:
+        return dict(zip(points, map(_interpolate_job, jobs)))
+    if max_workers not in _workers:
+        _workers[max_workers] = _Workers(max_workers)
+    try:
+        futures = [_workers[max_workers].submit(job) for job in jobs]
+        return dict(zip(points, [future.result() for future in futures]))
+    except BrokenProcessPool:
+        _workers.pop(max_workers).shutdown()
+        raise
+
+
+def parameter_points(conn, parameter, max_age_hours=3):
+    """
+    Function returns (station_ids, stations_xy, values) of
+    latest readings of parameter, coordinates in GRID_CRS.
+    Stations with readings older than max_age_hours are
+    returned with NaN value, so set of stations (and its
+    cached weights) does not change from hour to hour.
+    """
+    sql =   """
+                SELECT station_id, ST_X(xy), ST_Y(xy), reading
+                FROM
+                (
+                    SELECT station_id, ST_Transform(geom, 2180) AS xy,
+                        CASE WHEN ts >= now() - %(max_age_hours)s * interval '1 hour'
+                            THEN reading END AS reading
+                    FROM latest_readings
+                    WHERE sensor_parameter = %(parameter)s
+                ) latest
+                ORDER BY station_id;
+            """
+    cur = conn.cursor()
+    cur.execute(sql, {"parameter": parameter, "max_age_hours": max_age_hours})
+    rows = np.array(cur.fetchall(), dtype=float).reshape(-1, 4)
+    return rows[:, 0].astype(np.int64), rows[:, 1:3], rows[:, 3]
+
+
+def gdf_points(gdf, value_column="reading", id_column="station_id"):
+    """
+    Function returns (station_ids, stations_xy, values) of GeoDataFrame,
+    i.e. output of haqs_api.return_parameter_gdf().
+    """
+    projected = gdf.to_crs(GRID_CRS) if gdf.crs is not None else gdf
+    xy = np.column_stack([projected.geometry.x.values, projected.geometry.y.values])
+    return gdf[id_column].values, xy, gdf[value_column].values.astype(float)
+
+
+def save_geotiff(path, surface, grid, crs=GRID_CRS):
+    """
+    Function saves surface as single band float32 GeoTIFF,
+    rasterio is required.
+    """
+    import rasterio
+    from rasterio.transform import Affine
+
+    profile = {"driver": "GTiff", "width": grid.width, "height": grid.height, "count": 1,
+               "dtype": "float32", "crs": crs, "nodata": np.nan, "compress": "deflate",
+               "transform": Affine.from_gdal(*grid.transform)}
+    with rasterio.open(path, "w", **profile) as raster:
+        raster.write(surface.astype(np.float32), 1)
+    return path
+
+
+def save_npy(path, surface, grid):
+    """
+    Function saves surface as .npy file and grid
+    definition in .json file next to it.
+    """
+    np.save(path, surface.astype(np.float32))
+    with open(os.path.splitext(path)[0] + ".json", "w") as grid_file:
+        json.dump({"crs": GRID_CRS, "transform": grid.transform, "shape": grid.shape}, grid_file)
+    return path
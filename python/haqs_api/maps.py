@@ -0,0 +1,179 @@
+"""
+Bokeh map of latest readings.
+
+Station coordinates are projected to Web Mercator once, when
+ReadingsMap is created. Readings are later written into the same
+ColumnDataSource, so the plot (notebook or Bokeh server) is updated
+in place. Circle colours are looked up in precomputed RdYlGn table.
+
+Maps can be saved as standalone HTML or PNG files, which allows
+headless generation of maps for all parameters.
+
+Example:
+    In [1]: readings_map = ReadingsMap(stations_df)
+            for parameter in get_available_parameters(sensors_df):
+                param_df = get_param_df(stations_df, sensors_df, parameter)
+                readings_map.update(param_df)
+                readings_map.save_html('maps/{}.html'.format(parameter), title=parameter)
+"""
+import numpy as np
+import pandas as pd
+from bokeh import plotting
+from bokeh.io import export_png
+from bokeh.models import ColumnDataSource
+from bokeh.resources import CDN
+
+EARTH_RADIUS = 6378137.0
+MAX_SIZE = 50
+LUT_SIZE = 256
+
+_color_lut = None
+
+
+def web_mercator(lon, lat):
+    """
+    Function returns Web Mercator (EPSG:3857) x and y
+    arrays of WGS84 longitudes and latitudes.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def color_lut():
+    """
+    Function returns array of LUT_SIZE hex colours, from green
+    (lowest reading) to red (highest reading).
+    """
+    global _color_lut
+    if _color_lut is None:
+        import matplotlib as mpl
+
+        rgb = (255 * mpl.cm.RdYlGn(np.linspace(1, 0, LUT_SIZE))[:, :3]).astype(int)
+        _color_lut = np.array(["#%02x%02x%02x" % tuple(color) for color in rgb])
+    return _color_lut
+
+
+def tile_provider(tile):
+    """
+    Function returns Bokeh tile provider of its name,
+    i.e. 'CARTODBPOSITRON'. Bokeh 3 resolves names itself.
+    """
+    if not isinstance(tile, str):
+        return tile
+    try:
+        from bokeh import tile_providers
+    except ImportError:
+        return tile
+    return getattr(tile_providers, tile)
+
+
+def scale_values(values):
+    """
+    Function scales values into [0, 1] range, NaN is kept.
+    """
+    values = np.asarray(values, dtype=float)
+    low, high = np.nanmin(values), np.nanmax(values)
+    if not high > low:
+        return np.where(np.isnan(values), np.nan, 0.0)
+    return (values - low) / (high - low)
+
+
+def _coordinates(stations_df):
+    if "longitude" in stations_df and "latitude" in stations_df:
+        return stations_df["longitude"].values, stations_df["latitude"].values
+    geometry = stations_df["geometry"].to_crs(epsg=4326) \
+        if stations_df.crs is not None else stations_df["geometry"]
+    return geometry.x.values, geometry.y.values
+
+
+class ReadingsMap(object):
+    """
+    Bokeh map with one circle per station. Circle size
+    and colour represent latest reading of the station.
+
+    Args:
+        stations_df (gpd.GeoDataFrame or pd.DataFrame):
+            stations with station_id and geometry
+            or longitude/latitude columns
+
+        tile (string or bokeh.tile_providers) - default None:
+            one of available Bokeh tile providers or its name
+            [CARTODBPOSITRON, STAMEN_TERRAIN, STAMEN_TONER]
+
+        width, height (int) - default 900, 700:
+            plot size in pixels
+
+    Example:
+        In [1]: readings_map = ReadingsMap(stations_df, tile=CARTODBPOSITRON)
+                readings_map.update(get_param_df(stations_df, sensors_df, 'PM10'))
+                readings_map.show()
+    """
+
+    def __init__(self, stations_df, tile=None, width=900, height=700):
+        stations_df = stations_df.drop_duplicates("station_id")
+        self.station_ids = pd.Index(stations_df["station_id"].values)
+        x, y = web_mercator(*_coordinates(stations_df))
+
+        self.source = ColumnDataSource(data={"station_id": self.station_ids.values,
+                                             "x": x,
+                                             "y": y,
+                                             "value": np.full(len(x), np.nan),
+                                             "size": np.zeros(len(x)),
+                                             "color": [color_lut()[0]] * len(x)})
+
+        self.figure = plotting.figure(toolbar_location="left",
+                                      width=width,
+                                      height=height,
+                                      x_axis_type="mercator",
+                                      y_axis_type="mercator")
+        self.figure.scatter("x", "y", marker="circle", size="size", fill_color="color",
+                            source=self.source, fill_alpha=0.8, line_color=None)
+        if tile is not None:
+            self.figure.add_tile(tile_provider(tile))
+
+    def update(self, param_df):
+        """
+        Function writes readings into map data source.
+        Stations missing in param_df are hidden.
+
+        Args:
+            param_df (pd.DataFrame):
+                station_id and value columns,
+                i.e. output of get_param_df()
+        """
+        values = np.full(len(self.station_ids), np.nan)
+        positions = self.station_ids.get_indexer(param_df["station_id"].values)
+        found = positions >= 0
+        values[positions[found]] = param_df["value"].values[found]
+
+        scaled = scale_values(values)
+        missing = np.isnan(scaled)
+        scaled[missing] = 0
+        lut_index = np.rint(scaled * (LUT_SIZE - 1)).astype(int)
+
+        self.source.data.update({"value": values,
+                                 "size": np.where(missing, 0, scaled * MAX_SIZE),
+                                 "color": color_lut()[lut_index].tolist()})
+        return self
+
+    def show(self):
+        plotting.output_notebook()
+        plotting.show(self.figure)
+
+    def save_html(self, path, title="Air quality readings"):
+        """
+        Function saves map as standalone HTML file.
+        """
+        plotting.save(self.figure, filename=path, resources=CDN, title=title)
+        return path
+
+    def save_png(self, path):
+        """
+        Function saves map as PNG file, selenium with headless
+        Chrome (chromedriver) or Firefox (geckodriver) is required.
+        """
+        export_png(self.figure, filename=path)
+        return path
@@ -0,0 +1,285 @@
+"""
+Timers and counters of HTTP requests, SQL statements and serialization.
+
+Every metric keeps in-process totals (count, sum and max per labels),
+which are logged by command line tools (see summary() and
+JsonFormatter), and is exported to Prometheus when prometheus_client
+is installed. prometheus_client is imported on first observation,
+so it does not slow down startup of ingestion.
+
+Requests and statements slower than HAQS_SLOW_HTTP_SECONDS (default 2)
+and HAQS_SLOW_SQL_SECONDS (default 1) are logged as warnings with
+url / statement and duration fields.
+
+Example:
+    In [1]: with track_sql("select:readings"):
+                cur.execute("SELECT count(*) FROM readings;")
+            summary()["haqs_sql_seconds"]
+    Out[1]: {'select:readings': {'count': 1, 'sum': 0.412, 'max': 0.412}}
+
+    $ python -m haqs_api --log-format json run --metrics-port 9108
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SLOW_HTTP_SECONDS = float(os.environ.get("HAQS_SLOW_HTTP_SECONDS", 2.0))
+SLOW_SQL_SECONDS = float(os.environ.get("HAQS_SLOW_SQL_SECONDS", 1.0))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# GIOŚ API path fragment -> endpoint label
+ENDPOINTS = (("station/findAll", "stations"),
+             ("station/sensors/", "sensors"),
+             ("data/getData/", "data"),
+             ("aqindex/getIndex/", "aq_index"))
+
+_TARGET_RE = re.compile(r"\b(?:into|from|update|table|view|index)\s+(?:if\s+(?:not\s+)?exists\s+)?"
+                        r"(?:concurrently\s+)?(?:public\.)?(\w+)", re.IGNORECASE)
+_prometheus_lock = threading.Lock()
+
+
+class Metric(object):
+    """
+    Counter or histogram with fixed label names.
+
+    Args:
+        kind (string):
+            'counter' or 'histogram'
+
+        name (string):
+            Prometheus metric name
+
+        documentation (string)
+
+        labelnames (tuple)
+    """
+
+    def __init__(self, kind, name, documentation, labelnames=()):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+        self._exported = None
+
+    def _export(self):
+        with _prometheus_lock:
+            if self._exported is None:
+                try:
+                    import prometheus_client
+                except ImportError:  # metrics are only kept in process
+                    self._exported = False
+                    return False
+                if self.kind == "counter":
+                    self._exported = prometheus_client.Counter(self.name, self.documentation,
+                                                               self.labelnames)
+                else:
+                    self._exported = prometheus_client.Histogram(self.name, self.documentation,
+                                                                 self.labelnames,
+                                                                 buckets=LATENCY_BUCKETS)
+        return self._exported
+
+    def observe(self, value, *labels):
+        """
+        Function adds value (counter increment or
+        histogram observation) for labels.
+        """
+        with self._lock:
+            count, total, highest = self.values.get(labels, (0, 0.0, value))
+            self.values[labels] = (count + 1, total + value, max(highest, value))
+        exported = self._exported if self._exported is not None else self._export()
+        if exported:
+            child = exported.labels(*labels) if labels else exported
+            if self.kind == "counter":
+                child.inc(value)
+            else:
+                child.observe(value)
+
+    def inc(self, *labels):
+        self.observe(1, *labels)
+
+    def summary(self):
+        with self._lock:
+            values = dict(self.values)
+        result = {}
+        for labels, (count, total, highest) in values.items():
+            key = ",".join(str(label) for label in labels) or "total"
+            if self.kind == "counter":
+                result[key] = total
+            else:
+                result[key] = {"count": count, "sum": round(total, 6), "max": round(highest, 6)}
+        return result
+
+
+HTTP_SECONDS = Metric("histogram", "haqs_http_request_seconds",
+                      "GIOŚ API request latency in seconds", ("endpoint",))
+HTTP_FAILURES = Metric("counter", "haqs_http_failures_total",
+                       "Failed GIOŚ API requests", ("endpoint", "reason"))
+SQL_SECONDS = Metric("histogram", "haqs_sql_seconds",
+                     "SQL statement latency in seconds", ("statement",))
+SQL_FAILURES = Metric("counter", "haqs_sql_failures_total",
+                      "Failed SQL statements", ("statement", "reason"))
+ROLLBACKS = Metric("counter", "haqs_sql_rollbacks_total",
+                   "Rolled back transactions and savepoints", ("statement",))
+MISSING_READINGS = Metric("counter", "haqs_missing_readings_total",
+                          "Sensors without latest reading", ("reason",))
+SERIALIZATION_SECONDS = Metric("histogram", "haqs_serialization_seconds",
+                               "Serialization time in seconds", ("format",))
+FLAGGED_READINGS = Metric("counter", "haqs_flagged_readings_total",
+                          "Flags written by anomaly detection")
+
+METRICS = (HTTP_SECONDS, HTTP_FAILURES, SQL_SECONDS, SQL_FAILURES, ROLLBACKS,
+           MISSING_READINGS, SERIALIZATION_SECONDS, FLAGGED_READINGS)
+
+
+def endpoint_of(url):
+    for fragment, endpoint in ENDPOINTS:
+        if fragment in url:
+            return endpoint
+    return "other"
+
+
+def statement_of(sql):
+    """
+    Function returns low cardinality label of SQL statement,
+    its first keyword and first table.
+
+    Example:
+        In [1]: statement_of("INSERT INTO public.readings (sensor_id, ts) VALUES (%s, %s)")
+        Out[1]: 'insert:readings'
+    """
+    words = sql.split(None, 1)
+    if not words:
+        return "empty"
+    target = _TARGET_RE.search(sql)
+    if target is None:
+        return words[0].lower()
+    return "{}:{}".format(words[0].lower(), target.group(1).lower())
+
+
+def failure_reason(exception):
+    """
+    Function returns failure label of exception,
+    i.e. 'http_503', 'ReadTimeout' or 'UniqueViolation'.
+    """
+    response = getattr(exception, "response", None)
+    if response is not None and getattr(response, "status_code", None):
+        return "http_{}".format(response.status_code)
+    return type(exception).__name__
+
+
+@contextmanager
+def _timed(seconds, failures, labels, slow, event, **fields):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        failures.inc(*(labels + (failure_reason(e),)))
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        seconds.observe(duration, *labels)
+        if duration > slow:
+            fields.update(event=event, duration=round(duration, 6))
+            logger.warning("slow %s %s: %.3fs", event, labels[0], duration, extra=fields)
+
+
+def track_http(url):
+    """
+    Context manager times GIOŚ API request of url,
+    exceptions are counted as failures.
+    """
+    return _timed(HTTP_SECONDS, HTTP_FAILURES, (endpoint_of(url),),
+                  SLOW_HTTP_SECONDS, "http_request", url=url)
+
+
+def http_status(url, status_code):
+    """
+    Function counts response with error status as failure.
+    """
+    if status_code >= 400:
+        HTTP_FAILURES.inc(endpoint_of(url), "http_{}".format(status_code))
+
+
+def track_sql(statement):
+    """
+    Context manager times SQL statement,
+    exceptions are counted as failures.
+    """
+    return _timed(SQL_SECONDS, SQL_FAILURES, (statement,),
+                  SLOW_SQL_SECONDS, "sql", statement=statement)
+
+
+@contextmanager
+def track_serialization(format):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SERIALIZATION_SECONDS.observe(time.perf_counter() - start, format)
+
+
+def summary():
+    """
+    Function returns in-process totals of all metrics,
+    metrics without observations are skipped.
+    """
+    return {metric.name: metric.summary() for metric in METRICS if metric.values}
+
+
+def start_http_server(port, addr="0.0.0.0"):
+    """
+    Function serves Prometheus metrics on port
+    in background thread, prometheus_client is required.
+    """
+    import prometheus_client
+
+    for metric in METRICS:
+        metric._export()
+    prometheus_client.start_http_server(port, addr)
+
+
+# attributes of every LogRecord, other attributes come from extra
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Logging formatter writing one JSON document per record,
+    fields passed in extra are included.
+    """
+
+    def format(self, record):
+        document = {"ts": datetime.utcfromtimestamp(record.created).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                    "level": record.levelname,
+                    "logger": record.name,
+                    "message": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                document[key] = value
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+
+def configure_logging(level="INFO", format="text"):
+    """
+    Function configures root logger, format is 'text' or 'json'.
+    """
+    handler = logging.StreamHandler()
+    if format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
@@ -0,0 +1,431 @@
+"""
+MQTT ingestion bridge for home stations.
+
+ESP32 stations (see sketches directory) publish one message
+per metric, i.e. 'bme280/temp' or 'pms7003/pm2pt5'. Topics can be
+prefixed with device name ('kitchen/bme280/temp'), messages without
+device name are assigned to default_device.
+Binary batches (see home_protocol module) published to
+'<device>/haqs/batch' are stored as mean, min and max readings
+('pm10', 'pm10_min', 'pm10_max') timestamped with device RTC time.
+
+Messages are parsed in MQTT network thread and put on bounded
+in-memory queue. Writer thread drains the queue into batches
+(flushed when batch_size readings were collected or flush_interval
+has passed), each batch is first written to spool directory
+(write-ahead buffer) and then copied into home_readings table with
+COPY FROM STDIN. Spool file is removed after commit, so batches
+are not lost when DataBase is slow or unavailable - they are
+replayed in order as soon as DataBase accepts writes again.
+When the queue is full (writer can not keep up) messages are
+written straight to spool files. Segment which DataBase rejects
+(psycopg2.DataError, or max_attempts failures in a row other than
+lost connection) is renamed to '.dead' file, so it does not block
+newer segments.
+
+Example:
+    In [1]: bridge = MqttBridge('localhost', default_device='living-room')
+            bridge.start()
+            ...
+            bridge.stats()
+    Out[1]: {'received': 36000, 'ignored': 0, 'spilled': 0, 'written': 36000,
+             'failures': 0, 'dead': 0, 'queued': 0, 'pending_segments': 0,
+             'dead_segments': 0}
+"""
+import io
+import itertools
+import logging
+import math
+import os
+import queue
+import threading
+import time
+
+import psycopg2
+
+from .db import connection
+from .home_protocol import BATCH_TOPIC, BatchError, decode_batch
+from .schema import HOME_READINGS_TABLE_SQL
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_DIR = os.path.join(os.path.expanduser("~"), ".cache", "haqs_api", "mqtt_spool")
+
+# (sensor, channel) topic suffix -> metric
+TOPIC_METRICS = {
+    "bme280/temp": "temperature",
+    "bme280/humid": "humidity",
+    "bme280/pressure": "pressure",
+    "pms7003/pm1pt": "pm1",
+    "pms7003/pm2pt5": "pm2_5",
+    "pms7003/pm10pt": "pm10",
+    BATCH_TOPIC: "batch",
+}
+
+DEFAULT_TOPICS = ("bme280/+", "pms7003/+", "+/bme280/+", "+/pms7003/+",
+                  BATCH_TOPIC, "+/" + BATCH_TOPIC)
+
+# largest finite value of home_readings.value (REAL) column
+REAL_MAX = 3.4028234663852886e+38
+DEAD_SUFFIX = ".dead"
+
+_segment_ids = itertools.count()
+
+
+def create_home_tables(conn):
+    cur = conn.cursor()
+    cur.execute(HOME_READINGS_TABLE_SQL)
+    conn.commit()
+
+
+def parse_topic(topic, default_device="home"):
+    """
+    Function returns (device_id, metric) of topic,
+    None for topics which are not home station readings.
+
+    Example:
+        In [1]: parse_topic('kitchen/pms7003/pm2pt5')
+        Out[1]: ('kitchen', 'pm2_5')
+    """
+    parts = topic.split("/")
+    if len(parts) < 2:
+        return None
+    metric = TOPIC_METRICS.get(parts[-2] + "/" + parts[-1])
+    if metric is None:
+        return None
+    device_id = parts[-3] if len(parts) > 2 else default_device
+    if not device_id or len(device_id) > 64 or not device_id.isprintable():
+        return None
+    # tab separates and backslash escapes columns of COPY text format
+    if "\t" in device_id or "\\" in device_id:
+        return None
+    return device_id, metric
+
+
+def valid_value(value):
+    """
+    Function returns True when value can be stored in REAL column.
+    """
+    return math.isfinite(value) and abs(value) <= REAL_MAX
+
+
+def write_rows(conn, data):
+    """
+    Function copies TSV rows (device_id, metric, epoch seconds, value)
+    into home_readings table. Devices are registered in home_devices
+    and duplicated readings are skipped. Changes are committed.
+
+    Returns:
+        inserted (int)
+    """
+    cur = conn.cursor()
+    cur.execute("""
+                    CREATE TEMP TABLE IF NOT EXISTS home_readings_staging
+                    (
+                        device_id VARCHAR(64),
+                        metric VARCHAR(32),
+                        ts DOUBLE PRECISION,
+                        value REAL
+                    )
+                    ON COMMIT DELETE ROWS;
+                """)
+    cur.copy_expert("COPY home_readings_staging (device_id, metric, ts, value) FROM STDIN",
+                    io.StringIO(data))
+    cur.execute("""
+                    INSERT INTO public.home_devices (device_id, first_seen, last_seen)
+                    SELECT device_id, to_timestamp(min(ts)), to_timestamp(max(ts))
+                    FROM home_readings_staging
+                    GROUP BY device_id
+                    ON CONFLICT (device_id) DO UPDATE
+                    SET last_seen = greatest(home_devices.last_seen, EXCLUDED.last_seen);
+                """)
+    cur.execute("""
+                    INSERT INTO public.home_readings (device_id, metric, ts, value)
+                    SELECT DISTINCT ON (device_id, metric, ts)
+                        device_id, metric, to_timestamp(ts), value
+                    FROM home_readings_staging
+                    ORDER BY device_id, metric, ts
+                    ON CONFLICT (device_id, metric, ts) DO NOTHING;
+                """)
+    inserted = cur.rowcount
+    conn.commit()
+    return inserted
+
+
+def _mqtt_client(client_id):
+    import paho.mqtt.client as mqtt
+
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id)
+    return mqtt.Client(client_id=client_id)
+
+
+class MqttBridge(object):
+    """
+    MQTT subscriber writing home station readings to DataBase.
+
+    Args:
+        host (string) - default 'localhost':
+            MQTT broker host
+
+        port (int) - default 1883
+
+        topics (tuple) - default DEFAULT_TOPICS:
+            subscribed topic filters
+
+        default_device (string) - default 'home':
+            device_id of messages published without device prefix
+
+        batch_size (int) - default 5000:
+            maximum number of readings written at once
+
+        flush_interval (float) - default 1.0:
+            maximum number of seconds reading waits in memory
+
+        queue_size (int) - default 100000:
+            maximum number of readings kept in memory
+
+        spool_dir (string) - default DEFAULT_SPOOL_DIR:
+            directory of write-ahead buffer
+
+        username, password (string) - default None:
+            MQTT credentials
+
+        client_id (string) - default None
+
+        max_attempts (int) - default 5:
+            failed writes of spool segment (other than lost
+            DataBase connection) after which it is moved aside
+    """
+
+    def __init__(self, host="localhost", port=1883, topics=DEFAULT_TOPICS,
+                 default_device="home", batch_size=5000, flush_interval=1.0,
+                 queue_size=100000, spool_dir=DEFAULT_SPOOL_DIR,
+                 username=None, password=None, client_id=None, max_attempts=5):
+        self.host = host
+        self.port = port
+        self.topics = topics
+        self.default_device = default_device
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_dir = spool_dir
+        self.username = username
+        self.password = password
+        self.client_id = client_id
+        self.max_attempts = max_attempts
+
+        os.makedirs(spool_dir, exist_ok=True)
+        self.counters = {"received": 0, "ignored": 0, "spilled": 0,
+                         "written": 0, "failures": 0, "dead": 0}
+        self._attempts = {}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._spill_lock = threading.Lock()
+        self._overflowed = []
+        self._stopping = threading.Event()
+        self._retry_at = 0
+        self._writer = None
+        self._client = None
+
+    def handle(self, topic, payload, ts=None):
+        """
+        Function parses single message and queues its reading.
+        Returns False when message was ignored.
+        """
+        parsed = parse_topic(topic, self.default_device)
+        if parsed is None:
+            self._count("ignored")
+            return False
+        if parsed[1] == "batch":
+            return self.handle_batch(parsed[0], payload, ts)
+        try:
+            value = float(payload)
+        except ValueError:
+            value = math.nan
+        if not valid_value(value):
+            self._count("ignored")
+            return False
+        self._count("received")
+        line = "{}\t{}\t{!r}\t{!r}\n".format(parsed[0], parsed[1],
+                                            time.time() if ts is None else ts, value)
+        self._put(line)
+        return True
+
+    def handle_batch(self, device_id, payload, ts=None):
+        """
+        Function decodes binary batch and queues its readings.
+        Receive time is used when device has no RTC time (timestamp 0).
+        """
+        try:
+            batch = decode_batch(payload)
+        except BatchError as e:
+            logger.warning("%s: %s", device_id, e)
+            self._count("ignored")
+            return False
+        ts = batch["timestamp"] or (time.time() if ts is None else ts)
+        for metric, (low, mean, high) in batch["metrics"].items():
+            for name, value in ((metric, mean), (metric + "_min", low), (metric + "_max", high)):
+                if valid_value(value):
+                    self._put("{}\t{}\t{!r}\t{!r}\n".format(device_id, name, ts, value))
+        self._count("received")
+        return True
+
+    def _count(self, counter, n=1):
+        # counters are updated by MQTT network and writer threads
+        with self._spill_lock:
+            self.counters[counter] += n
+            return self.counters[counter]
+
+    def _put(self, line):
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self._overflow(line)
+
+    def _overflow(self, line):
+        with self._spill_lock:
+            self._overflowed.append(line)
+            self.counters["spilled"] += 1  # self._spill_lock is held
+            if len(self._overflowed) < self.batch_size:
+                return
+            lines, self._overflowed = self._overflowed, []
+        self._write_segment(lines)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            client.subscribe([(topic, 0) for topic in self.topics])
+            logger.info("connected to %s:%s", self.host, self.port)
+        else:
+            logger.error("MQTT connection refused, code %s", rc)
+
+    def _on_message(self, client, userdata, message):
+        self.handle(message.topic, message.payload)
+
+    def _segment_path(self):
+        name = "{:017d}-{:06d}.tsv".format(int(time.time() * 1e6), next(_segment_ids) % 1000000)
+        return os.path.join(self.spool_dir, name)
+
+    def _write_segment(self, lines):
+        with self._spill_lock:
+            path = self._segment_path()
+            with open(path + ".tmp", "w") as segment:
+                segment.writelines(lines)
+            os.replace(path + ".tmp", path)
+
+    def pending_segments(self):
+        return sorted(name for name in os.listdir(self.spool_dir) if name.endswith(".tsv"))
+
+    def dead_segments(self):
+        return sorted(name for name in os.listdir(self.spool_dir) if name.endswith(DEAD_SUFFIX))
+
+    def _bury(self, name):
+        path = os.path.join(self.spool_dir, name)
+        os.replace(path, path[:-len(".tsv")] + DEAD_SUFFIX)
+        self._attempts.pop(name, None)
+        self._count("dead")
+
+    def _drain(self):
+        lines = []
+        deadline = time.time() + self.flush_interval
+        while len(lines) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                lines.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return lines
+
+    def replay(self):
+        """
+        Function writes pending spool segments to DataBase,
+        oldest first. Segments are removed after commit.
+        Rejected segments are moved aside (see _bury), replay
+        stops at first other failure and returns False.
+        """
+        if time.time() < self._retry_at:
+            return False
+        for name in self.pending_segments():
+            path = os.path.join(self.spool_dir, name)
+            with open(path) as segment:
+                data = segment.read()
+            try:
+                with connection() as conn:
+                    write_rows(conn, data)
+            except psycopg2.DataError:
+                logger.exception("%s rejected, moved to %s", name, DEAD_SUFFIX)
+                self._bury(name)
+                continue
+            except Exception as e:
+                failures = self._count("failures")
+                # lost connection says nothing about the segment itself
+                if not isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                    self._attempts[name] = self._attempts.get(name, 0) + 1
+                    if self._attempts[name] >= self.max_attempts:
+                        logger.exception("writing %s failed %d times, moved to %s",
+                                         name, self._attempts[name], DEAD_SUFFIX)
+                        self._bury(name)
+                        continue
+                self._retry_at = time.time() + min(30, self.flush_interval * 2 ** min(failures, 5))
+                logger.exception("writing %s failed, will retry", name)
+                return False
+            os.remove(path)
+            self._attempts.pop(name, None)
+            self._count("written", data.count("\n"))
+        return True
+
+    def flush(self):
+        """
+        Function writes queued readings to spool
+        and from spool to DataBase.
+        """
+        lines = self._drain()
+        with self._spill_lock:
+            overflowed, self._overflowed = self._overflowed, []
+        for batch in (lines, overflowed):
+            if batch:
+                self._write_segment(batch)
+        return self.replay()
+
+    def _run_writer(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            self.flush()
+        self.replay()
+
+    def start(self):
+        """
+        Function connects to broker and starts
+        MQTT network and writer threads.
+        """
+        self._stopping.clear()
+        self._writer = threading.Thread(target=self._run_writer, name="haqs-mqtt-writer",
+                                        daemon=True)
+        self._writer.start()
+
+        self._client = _mqtt_client(self.client_id)
+        if self.username:
+            self._client.username_pw_set(self.username, self.password)
+        self._client.on_connect = self._on_connect
+        self._client.on_message = self._on_message
+        self._client.connect_async(self.host, self.port)
+        self._client.loop_start()
+
+    def stop(self):
+        """
+        Function disconnects from broker and writes remaining readings.
+        Readings which could not be written stay in spool directory.
+        """
+        if self._client is not None:
+            self._client.disconnect()
+            self._client.loop_stop()
+        self._stopping.set()
+        if self._writer is not None:
+            self._writer.join()
+
+    def stats(self):
+        with self._spill_lock:
+            stats = dict(self.counters)
+        stats["queued"] = self._queue.qsize()
+        stats["pending_segments"] = len(self.pending_segments())
+        stats["dead_segments"] = len(self.dead_segments())
+        return stats
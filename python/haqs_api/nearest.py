@@ -0,0 +1,238 @@
+"""
+Nearest GIOŚ sensors of a location ("air quality at my location").
+
+In DataBase k nearest sensors of each parameter are found with
+KNN (<->) ordering over geography GiST index of latest_readings
+view, so each parameter is answered by one index scan which stops
+after k rows. Home station can be used instead of coordinates,
+its location is read from home_devices table.
+
+For hot lookups NearestIndex keeps latest readings in memory,
+sensors of each parameter are indexed by KD-tree built on unit
+sphere (ECEF) coordinates, where chord length is monotonic with
+great-circle distance. Index is reloaded when it is older than
+max_age seconds (latest_readings changes once per ingestion).
+
+Example:
+    In [1]: with connection() as conn:
+                nearest_sensors(conn, 52.23, 21.01, k=2, parameters=['PM10'])
+    Out[1]: [{'parameter': 'PM10', 'sensor_id': 3575, 'station_id': 530,
+              'distance': 1204.6, 'ts': ..., 'reading': 31.2}, ...]
+
+    In [2]: index = NearestIndex()
+            index.query(52.23, 21.01, k=2, parameters=['PM10'])
+"""
+import threading
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .db import connection
+
+EARTH_RADIUS = 6371008.8
+
+NEAREST_SQL = """
+    WITH location AS
+    (
+        SELECT {point}::geography AS geog
+    )
+    SELECT parameters.parameter, nearest.sensor_id, nearest.station_id,
+        ST_Distance(nearest.geog, location.geog), nearest.ts, nearest.reading
+    FROM location
+    CROSS JOIN unnest(%(parameters)s::varchar[]) AS parameters (parameter)
+    CROSS JOIN LATERAL
+    (
+        SELECT sensor_id, station_id, ts, reading, geom::geography AS geog
+        FROM latest_readings
+        WHERE sensor_parameter = parameters.parameter
+        ORDER BY geom::geography <-> location.geog
+        LIMIT %(k)s
+    ) nearest
+    ORDER BY parameters.parameter, 4;
+"""
+
+POINT_SQL = "ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326)"
+DEVICE_POINT_SQL = "(SELECT geom FROM public.home_devices WHERE device_id = %(device_id)s)"
+
+COLUMNS = ("parameter", "sensor_id", "station_id", "distance", "ts", "reading")
+
+
+def unit_vectors(lat, lon):
+    """
+    Function returns (n, 3) array of unit sphere
+    coordinates of latitudes and longitudes (degrees).
+    """
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+def chord_to_meters(chord):
+    """
+    Function returns great-circle distance in meters
+    of chord length on unit sphere.
+    """
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(np.asarray(chord) / 2, 1.0))
+
+
+def return_parameters(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT DISTINCT sensor_parameter FROM latest_readings ORDER BY 1;")
+    return [row[0] for row in cur.fetchall()]
+
+
+def set_device_location(conn, device_id, lat, lon):
+    """
+    Function stores location of home station, which
+    allows nearest_sensors(conn, device_id=...) lookups.
+    """
+    cur = conn.cursor()
+    cur.execute("""
+                    UPDATE public.home_devices
+                    SET geom = ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326)
+                    WHERE device_id = %(device_id)s;
+                """, {"device_id": device_id, "lat": lat, "lon": lon})
+    updated = cur.rowcount
+    conn.commit()
+    return updated
+
+
+def nearest_sensors(conn, lat=None, lon=None, k=3, parameters=None, device_id=None):
+    """
+    Function returns k nearest sensors of each parameter
+    with their latest readings, nearest first.
+
+    Args:
+        conn (psycopg2.connection)
+
+        lat, lon (float) - default None:
+            location in WGS84 degrees
+
+        k (int) - default 3:
+            number of sensors per parameter
+
+        parameters (list) - default None:
+            GIOŚ parameters, i.e. ['PM10', 'PM2.5'],
+            all parameters of latest_readings when None
+
+        device_id (string) - default None:
+            home station used as location instead of lat, lon
+
+    Returns:
+        sensors (list):
+            dictionaries with parameter, sensor_id, station_id,
+            distance (meters), ts and reading
+    """
+    if device_id is not None:
+        point = DEVICE_POINT_SQL
+    elif lat is not None and lon is not None:
+        point = POINT_SQL
+    else:
+        raise ValueError("lat and lon or device_id is required")
+    if parameters is None:
+        parameters = return_parameters(conn)
+
+    cur = conn.cursor()
+    cur.execute(NEAREST_SQL.format(point=point),
+                {"lat": lat, "lon": lon, "device_id": device_id,
+                 "parameters": list(parameters), "k": k})
+    return [dict(zip(COLUMNS, row)) for row in cur.fetchall()]
+
+
+class NearestIndex(object):
+    """
+    In-memory nearest sensor index of latest readings.
+
+    Args:
+        max_age (float) - default 300:
+            number of seconds after which index is reloaded
+            from latest_readings, on first query when None
+            is passed as connection
+
+        max_reading_age_hours (float) - default None:
+            readings older than that are not indexed
+    """
+
+    def __init__(self, max_age=300, max_reading_age_hours=None):
+        self.max_age = max_age
+        self.max_reading_age_hours = max_reading_age_hours
+        self.loaded_at = None
+        self.parameters = {}
+        self._lock = threading.Lock()
+
+    def load(self, conn):
+        """
+        Function (re)builds index from latest_readings view.
+        """
+        cur = conn.cursor()
+        cur.execute("""
+                        SELECT sensor_parameter, sensor_id, station_id,
+                            ST_Y(geom), ST_X(geom), ts, reading
+                        FROM latest_readings
+                        WHERE %(max_age_hours)s::float IS NULL
+                            OR ts >= now() - %(max_age_hours)s::float * interval '1 hour'
+                        ORDER BY sensor_parameter, sensor_id;
+                    """, {"max_age_hours": self.max_reading_age_hours})
+        self.build(cur.fetchall())
+
+    def build(self, rows):
+        """
+        Function builds index of rows
+        (parameter, sensor_id, station_id, lat, lon, ts, reading).
+        """
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(row[0], []).append(row[1:])
+        parameters = {}
+        for parameter, sensors in grouped.items():
+            sensor_ids, station_ids, lat, lon, ts, readings = zip(*sensors)
+            parameters[parameter] = {"tree": cKDTree(unit_vectors(lat, lon)),
+                                     "sensor_id": sensor_ids,
+                                     "station_id": station_ids,
+                                     "ts": ts,
+                                     "reading": readings}
+        with self._lock:
+            self.parameters = parameters
+            self.loaded_at = time.time()
+
+    def is_stale(self):
+        return self.loaded_at is None or time.time() - self.loaded_at > self.max_age
+
+    def refresh(self, conn=None):
+        """
+        Function reloads stale index, connection
+        is taken from pool when conn is None.
+        """
+        if not self.is_stale():
+            return False
+        if conn is None:
+            with connection() as conn:
+                self.load(conn)
+        else:
+            self.load(conn)
+        return True
+
+    def query(self, lat, lon, k=3, parameters=None, conn=None):
+        """
+        Function returns k nearest sensors of each parameter,
+        in the same format as nearest_sensors().
+        """
+        self.refresh(conn)
+        indexed = self.parameters
+        point = unit_vectors(lat, lon)[0]
+        nearest = []
+        for parameter in sorted(indexed) if parameters is None else parameters:
+            sensors = indexed.get(parameter)
+            if sensors is None:
+                continue
+            chords, positions = sensors["tree"].query(point, k=min(k, sensors["tree"].n))
+            for chord, position in zip(np.atleast_1d(chords), np.atleast_1d(positions)):
+                nearest.append({"parameter": parameter,
+                                "sensor_id": sensors["sensor_id"][position],
+                                "station_id": sensors["station_id"][position],
+                                "distance": float(chord_to_meters(chord)),
+                                "ts": sensors["ts"][position],
+                                "reading": sensors["reading"][position]})
+        return nearest
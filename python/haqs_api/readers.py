@@ -0,0 +1,174 @@
+"""
+Streaming readers for large tables.
+
+Rows are read through server-side (named) cursors and yielded
+as DataFrame chunks, so memory use depends on chunksize and not
+on table size. Time range, parameter and station filters are
+pushed down to SQL.
+
+Example:
+    In [1]: for chunk in iter_readings_df(conn, chunksize=100000,
+                                          parameter='PM10',
+                                          start=datetime(2018, 1, 1)):
+                process(chunk)
+"""
+import itertools
+
+from ._lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+_cursor_ids = itertools.count()
+
+
+def _as_list(value):
+    if value is None or isinstance(value, (list, tuple, set)):
+        return value
+    return [value]
+
+
+def readings_filters(start=None, end=None, parameter=None, station_id=None,
+                     sensor_id=None):
+    """
+    Function returns SQL WHERE clause and its params
+    for readings joined with sensors table.
+
+    Args:
+        start, end (datetime) - default None:
+            time range, end is exclusive
+
+        parameter (string or list) - default None
+
+        station_id (int or list) - default None
+
+        sensor_id (int or list) - default None
+
+    Returns:
+        where (string), params (dict)
+    """
+    conditions = []
+    params = {}
+    if start is not None:
+        conditions.append("readings.ts >= %(start)s")
+        params["start"] = start
+    if end is not None:
+        conditions.append("readings.ts < %(end)s")
+        params["end"] = end
+    if parameter is not None:
+        conditions.append("sensors.sensor_parameter = ANY(%(parameters)s)")
+        params["parameters"] = list(_as_list(parameter))
+    if station_id is not None:
+        conditions.append("sensors.station_id = ANY(%(station_ids)s)")
+        params["station_ids"] = list(_as_list(station_id))
+    if sensor_id is not None:
+        conditions.append("readings.sensor_id = ANY(%(sensor_ids)s)")
+        params["sensor_ids"] = list(_as_list(sensor_id))
+
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    return where, params
+
+
+def iter_query(conn, sql, params=None, chunksize=50000):
+    """
+    Function executes query with server-side cursor
+    and yields results as DataFrame chunks.
+
+    Args:
+        conn (psycopg2.connection):
+            connection object for DataBase session.
+
+        sql (string)
+
+        params (dict or tuple) - default None
+
+        chunksize (int) - default 50000:
+            number of rows in each chunk
+    """
+    cur = conn.cursor(name="haqs_stream_{}".format(next(_cursor_ids)))
+    cur.itersize = chunksize
+    try:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if not rows:
+                break
+            columns = [desc[0] for desc in cur.description]
+            yield pd.DataFrame(rows, columns=columns)
+    finally:
+        cur.close()
+
+
+def iter_readings_df(conn, chunksize=50000, start=None, end=None,
+                     parameter=None, station_id=None, sensor_id=None):
+    """
+    Function yields readings as DataFrame chunks
+    ordered by sensor and time.
+    Streaming version of haqs_api.return_readings_df(),
+    see readings_filters() for filter arguments.
+
+    Example:
+        In [1]: readings_df = pd.concat(iter_readings_df(conn, parameter='NO2',
+                                                         station_id=[114, 117]))
+    """
+    where, params = readings_filters(start, end, parameter, station_id, sensor_id)
+    sql =   """
+                SELECT readings.id, readings.sensor_id, readings.ts, readings.reading
+                FROM readings
+                INNER JOIN sensors on readings.sensor_id = sensors.sensor_id
+                {}
+                ORDER BY readings.sensor_id, readings.ts;
+            """.format(where)
+    return iter_query(conn, sql, params, chunksize)
+
+
+def iter_readings_gdf(conn, chunksize=50000, start=None, end=None,
+                      parameter=None, station_id=None, sensor_id=None):
+    """
+    Function yields readings with sensor parameter and station
+    geometry as GeoDataFrame chunks ordered by sensor and time.
+    Streaming version of haqs_api.return_readings_gdf(),
+    see readings_filters() for filter arguments.
+    """
+    import geopandas as gpd
+
+    where, params = readings_filters(start, end, parameter, station_id, sensor_id)
+    sql =   """
+                SELECT readings.sensor_id, readings.ts, readings.reading,
+                    sensors.sensor_parameter, sensors.station_id,
+                    ST_AsBinary(stations.geom) AS geom
+                FROM readings
+                INNER JOIN sensors on readings.sensor_id = sensors.sensor_id
+                INNER JOIN stations on sensors.station_id = stations.station_id
+                {}
+                ORDER BY readings.sensor_id, readings.ts;
+            """.format(where)
+    for chunk in iter_query(conn, sql, params, chunksize):
+        geometry = gpd.GeoSeries.from_wkb(chunk.pop("geom").map(bytes), crs="EPSG:4326")
+        yield gpd.GeoDataFrame(chunk, geometry=geometry)
+
+
+def iter_sensors_df(conn, chunksize=50000, parameter=None, station_id=None):
+    """
+    Function yields sensors as DataFrame chunks.
+    Streaming version of haqs_api.return_sensors_df().
+    """
+    conditions = []
+    params = {}
+    if parameter is not None:
+        conditions.append("sensor_parameter = ANY(%(parameters)s)")
+        params["parameters"] = list(_as_list(parameter))
+    if station_id is not None:
+        conditions.append("station_id = ANY(%(station_ids)s)")
+        params["station_ids"] = list(_as_list(station_id))
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    sql = "SELECT * FROM public.sensors {} ORDER BY sensor_id;".format(where)
+    return iter_query(conn, sql, params, chunksize)
+
+
+def iter_insertions(conn, table="stations", chunksize=50000):
+    """
+    Function yields all rows of table as DataFrame chunks.
+    Streaming version of haqs_api.show_insertions().
+    """
+    sql = "SELECT * FROM public.{};".format(table)
+    return iter_query(conn, sql, None, chunksize)
@@ -0,0 +1,363 @@
+"""
+Hourly, daily and monthly aggregates of readings.
+
+Rollup tables keep mean, min, max, count and 95th percentile
+of readings per sensor (readings_hourly, readings_daily,
+readings_monthly) and per parameter (parameter_readings_hourly,
+parameter_readings_daily, parameter_readings_monthly).
+Buckets start at local (GIOS_TIMEZONE) hour, day and month.
+
+Rollups are updated by ingest.bulk_insert_readings(): only buckets
+touched by inserted readings are recomputed, in the same
+transaction as the insert. Hourly and daily buckets are aggregated
+from readings, monthly buckets from daily rollups, so exact monthly
+p95 (which needs all readings of the month) is left to
+refresh_monthly_p95(), run once a day by the daemon. Existing history
+can be aggregated with rebuild_rollups(). Readings flagged by anomaly
+module are left out when reading_flags table exists.
+
+Example:
+    In [1]: create_rollup_tables(conn)
+            rebuild_rollups(conn)
+    In [2]: return_rollup_df(conn, datetime(2018, 1, 1), datetime(2019, 1, 1),
+                             parameter='PM10', max_points=400)
+"""
+from datetime import timedelta
+
+from ._lazy import lazy_import
+from .anomaly import flags_exist
+from .schema import GIOS_TIMEZONE, UNFLAGGED_SQL
+
+pd = lazy_import("pandas")
+
+# (grain, per sensor table, per parameter table, bucket width)
+GRAINS = (
+    ("month", "readings_monthly", "parameter_readings_monthly", timedelta(days=28)),
+    ("day", "readings_daily", "parameter_readings_daily", timedelta(days=1)),
+    ("hour", "readings_hourly", "parameter_readings_hourly", timedelta(hours=1)),
+)
+
+ROLLUP_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS public.{table}
+    (
+        {key} {key_type} NOT NULL,
+        bucket TIMESTAMPTZ NOT NULL,
+        mean REAL,
+        min REAL,
+        max REAL,
+        count INTEGER NOT NULL,
+        p95 REAL,
+        PRIMARY KEY ({key}, bucket)
+    );
+"""
+
+AGGREGATES_SQL = """
+    avg(readings.reading), min(readings.reading), max(readings.reading),
+    count(readings.reading),
+    percentile_cont(0.95) WITHIN GROUP (ORDER BY readings.reading)
+"""
+
+DAILY_AGGREGATES_SQL = """
+    sum(daily.mean * daily.count) / sum(daily.count), min(daily.min), max(daily.max),
+    sum(daily.count), NULL::real
+"""
+
+UPSERT_SQL = """
+    ON CONFLICT ({key}, bucket) DO UPDATE
+    SET mean = EXCLUDED.mean, min = EXCLUDED.min, max = EXCLUDED.max,
+        count = EXCLUDED.count, p95 = EXCLUDED.p95;
+"""
+
+# monthly p95 is kept until refresh_monthly_p95()
+MONTHLY_UPSERT_SQL = """
+    ON CONFLICT ({key}, bucket) DO UPDATE
+    SET mean = EXCLUDED.mean, min = EXCLUDED.min, max = EXCLUDED.max,
+        count = EXCLUDED.count;
+"""
+
+# distinct (key, local bucket) of touched readings
+TOUCHED_SQL = {
+    "sensor_id": """
+        SELECT DISTINCT sensor_id, {bucket} AS local_bucket
+        FROM {touched}
+    """,
+    "sensor_parameter": """
+        SELECT DISTINCT sensors.sensor_parameter, {bucket} AS local_bucket
+        FROM {touched}
+        INNER JOIN sensors on sensors.sensor_id = {touched}.sensor_id
+    """,
+}
+
+# (from, condition) of rows aggregated into touched bucket
+BUCKET_ROWS_SQL = {
+    ("readings", "sensor_id"): (
+        "readings",
+        """readings.sensor_id = touched.sensor_id
+            AND readings.ts >= {start} AND readings.ts < {end}
+            AND readings.reading IS NOT NULL {unflagged}"""),
+    ("readings", "sensor_parameter"): (
+        "sensors INNER JOIN readings ON readings.sensor_id = sensors.sensor_id",
+        """sensors.sensor_parameter = touched.sensor_parameter
+            AND readings.ts >= {start} AND readings.ts < {end}
+            AND readings.reading IS NOT NULL {unflagged}"""),
+    ("daily", "sensor_id"): (
+        "public.readings_daily daily",
+        """daily.sensor_id = touched.sensor_id
+            AND daily.bucket >= {start} AND daily.bucket < {end}"""),
+    ("daily", "sensor_parameter"): (
+        "public.parameter_readings_daily daily",
+        """daily.sensor_parameter = touched.sensor_parameter
+            AND daily.bucket >= {start} AND daily.bucket < {end}"""),
+}
+
+
+def _local_bucket(grain, column="readings.ts"):
+    return "date_trunc('{}', {} AT TIME ZONE '{}')".format(grain, column, GIOS_TIMEZONE)
+
+
+def _unflagged(conn):
+    return "AND " + UNFLAGGED_SQL.strip() if flags_exist(conn) else ""
+
+
+def create_rollup_tables(conn):
+    """
+    Function creates rollup tables for all grains.
+    """
+    cur = conn.cursor()
+    for _, sensor_table, parameter_table, _ in GRAINS:
+        cur.execute(ROLLUP_TABLE_SQL.format(table=sensor_table, key="sensor_id",
+                                            key_type="INTEGER"))
+        cur.execute(ROLLUP_TABLE_SQL.format(table=parameter_table, key="sensor_parameter",
+                                            key_type="VARCHAR(10)"))
+    conn.commit()
+
+
+def rollups_exist(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('public.readings_hourly') IS NOT NULL;")
+    return cur.fetchone()[0]
+
+
+def update_rollups(conn, touched_table="ingested_readings"):
+    """
+    Function recomputes rollup buckets which contain readings
+    listed in touched_table (sensor_id, ts) and deletes touched
+    buckets left without (not flagged) readings. Monthly buckets
+    are aggregated from daily rollups and keep their p95.
+    Changes are not committed, function is called inside
+    ingestion transaction.
+    """
+    cur = conn.cursor()
+    unflagged = _unflagged(conn)
+    tz = GIOS_TIMEZONE
+    # months are aggregated from already updated days
+    for grain, sensor_table, parameter_table, _ in reversed(GRAINS):
+        source = "daily" if grain == "month" else "readings"
+        for key, table in (("sensor_id", sensor_table), ("sensor_parameter", parameter_table)):
+            touched = TOUCHED_SQL[key].format(
+                touched=touched_table,
+                bucket=_local_bucket(grain, "{}.ts".format(touched_table)))
+            rows, condition = BUCKET_ROWS_SQL[(source, key)]
+            condition = condition.format(
+                start="touched.local_bucket AT TIME ZONE '{}'".format(tz),
+                end="(touched.local_bucket + interval '1 {}') AT TIME ZONE '{}'".format(grain, tz),
+                unflagged=unflagged)
+
+            cur.execute("""
+                INSERT INTO public.{table} ({key}, bucket, mean, min, max, count, p95)
+                SELECT touched.{key}, touched.local_bucket AT TIME ZONE '{tz}', {aggregates}
+                FROM ({touched}) touched, {rows}
+                WHERE {condition}
+                GROUP BY touched.{key}, touched.local_bucket
+                {upsert}
+            """.format(table=table, key=key, tz=tz, touched=touched, rows=rows,
+                       condition=condition,
+                       aggregates=DAILY_AGGREGATES_SQL if source == "daily" else AGGREGATES_SQL,
+                       upsert=(MONTHLY_UPSERT_SQL if source == "daily" else UPSERT_SQL).format(key=key)))
+
+            cur.execute("""
+                DELETE FROM public.{table} stored
+                USING ({touched}) touched
+                WHERE stored.{key} = touched.{key}
+                    AND stored.bucket = touched.local_bucket AT TIME ZONE '{tz}'
+                    AND NOT EXISTS (SELECT 1 FROM {rows} WHERE {condition});
+            """.format(table=table, key=key, tz=tz, touched=touched, rows=rows,
+                       condition=condition))
+
+
+def refresh_monthly_p95(conn, start=None):
+    """
+    Function recomputes exact p95 of monthly rollups from
+    month of start (previous month by default) onwards
+    and commits them. update_rollups() does not update it.
+    """
+    cur = conn.cursor()
+    unflagged = _unflagged(conn)
+    bucket = _local_bucket("month")
+    since = """
+        date_trunc('month', coalesce(%(start)s::timestamptz, now() - interval '1 month')
+                   AT TIME ZONE '{tz}') AT TIME ZONE '{tz}'
+    """.format(tz=GIOS_TIMEZONE)
+    for key, table, join in (
+            ("sensor_id", "readings_monthly", ""),
+            ("sensor_parameter", "parameter_readings_monthly",
+             "INNER JOIN sensors on sensors.sensor_id = readings.sensor_id")):
+        cur.execute("""
+            UPDATE public.{table} stored
+            SET p95 = exact.p95
+            FROM
+            (
+                SELECT {column} AS rollup_key, {bucket} AT TIME ZONE '{tz}' AS bucket,
+                    percentile_cont(0.95) WITHIN GROUP (ORDER BY readings.reading) AS p95
+                FROM readings
+                {join}
+                WHERE readings.reading IS NOT NULL
+                    AND readings.ts >= {since}
+                    {unflagged}
+                GROUP BY {column}, {bucket}
+            ) exact
+            WHERE stored.{key} = exact.rollup_key AND stored.bucket = exact.bucket;
+        """.format(table=table, key=key, join=join, bucket=bucket, tz=GIOS_TIMEZONE,
+                   since=since, unflagged=unflagged,
+                   column="readings.sensor_id" if key == "sensor_id" else "sensors.sensor_parameter"),
+            {"start": start})
+    conn.commit()
+
+
+def rebuild_rollups(conn, start=None, end=None):
+    """
+    Function aggregates all readings between start and end
+    (whole history by default) and commits rollups.
+    """
+    cur = conn.cursor()
+    unflagged = _unflagged(conn)
+    for grain, sensor_table, parameter_table, _ in GRAINS:
+        bucket = _local_bucket(grain)
+        where = """
+            WHERE readings.reading IS NOT NULL
+                AND (%(start)s::timestamptz IS NULL OR readings.ts >= %(start)s::timestamptz)
+                AND (%(end)s::timestamptz IS NULL OR readings.ts < %(end)s::timestamptz)
+                {unflagged}
+        """.format(unflagged=unflagged)
+        cur.execute("""
+            INSERT INTO public.{table} (sensor_id, bucket, mean, min, max, count, p95)
+            SELECT readings.sensor_id, {bucket} AT TIME ZONE '{tz}', {aggregates}
+            FROM readings
+            {where}
+            GROUP BY readings.sensor_id, {bucket}
+            {upsert}
+        """.format(table=sensor_table, bucket=bucket, tz=GIOS_TIMEZONE,
+                   aggregates=AGGREGATES_SQL, where=where,
+                   upsert=UPSERT_SQL.format(key="sensor_id")),
+            {"start": start, "end": end})
+        cur.execute("""
+            INSERT INTO public.{table} (sensor_parameter, bucket, mean, min, max, count, p95)
+            SELECT sensors.sensor_parameter, {bucket} AT TIME ZONE '{tz}', {aggregates}
+            FROM readings
+            INNER JOIN sensors on sensors.sensor_id = readings.sensor_id
+            {where}
+            GROUP BY sensors.sensor_parameter, {bucket}
+            {upsert}
+        """.format(table=parameter_table, bucket=bucket, tz=GIOS_TIMEZONE,
+                   aggregates=AGGREGATES_SQL, where=where,
+                   upsert=UPSERT_SQL.format(key="sensor_parameter")),
+            {"start": start, "end": end})
+        conn.commit()
+
+
+def choose_rollup(resolution):
+    """
+    Function returns finest grain which buckets are at least as
+    wide as requested resolution (coarsest grain when resolution
+    is wider than all of them), so range / resolution points are
+    not exceeded. None is returned when resolution is finer than
+    one hour and raw readings are needed.
+
+    Example:
+        In [1]: choose_rollup(timedelta(days=3))
+        Out[1]: 'month'
+    """
+    if resolution < GRAINS[-1][3]:
+        return None
+    for grain, _, _, width in reversed(GRAINS):
+        if width >= resolution:
+            return grain
+    return GRAINS[0][0]
+
+
+def return_rollup_df(conn, start, end, resolution=None, sensor_id=None,
+                     parameter=None, max_points=1000):
+    """
+    Function returns aggregated readings of sensor or parameter
+    read from finest rollup not finer than requested resolution.
+
+    Args:
+        conn (psycopg2.connection):
+            connection object for DataBase session.
+
+        start, end (datetime):
+            requested time range, end is exclusive
+
+        resolution (timedelta) - default None:
+            requested distance between points, when None
+            it is derived from range and max_points
+            (so at most max_points buckets are returned)
+
+        sensor_id (int) - default None:
+            sensor to aggregate
+
+        parameter (string) - default None:
+            parameter to aggregate across all sensors,
+            used when sensor_id is None
+
+        max_points (int) - default 1000
+
+    Returns:
+        rollup_df (pd.DataFrame):
+            bucket, mean, min, max, count and p95 columns,
+            raw (not flagged) readings are returned (count = 1)
+            when resolution is finer than one hour
+
+    Example:
+        In [1]: return_rollup_df(conn, datetime(2018, 1, 1), datetime(2019, 1, 1),
+                                 sensor_id=642, max_points=12).head(2)
+        Out[1]:     bucket                     mean     min    max    count  p95
+                0   2017-12-31 23:00:00+00:00  31.4    12.3   61.2   744    52.1
+                1   2018-01-31 23:00:00+00:00  35.0    10.8   90.4   672    66.7
+    """
+    if sensor_id is None and parameter is None:
+        raise ValueError("sensor_id or parameter is required")
+    if resolution is None:
+        resolution = (end - start) / max(max_points, 1)
+    grain = choose_rollup(resolution)
+
+    params = {"start": start, "end": end,
+              "key": sensor_id if sensor_id is not None else parameter}
+
+    if grain is None:
+        sql = """
+            SELECT readings.ts AS bucket, readings.reading AS mean,
+                readings.reading AS min, readings.reading AS max,
+                1 AS count, readings.reading AS p95
+            FROM readings
+            {join}
+            WHERE {key} = %(key)s
+                AND readings.ts >= %(start)s AND readings.ts < %(end)s
+                AND readings.reading IS NOT NULL {unflagged}
+            ORDER BY readings.ts;
+        """.format(unflagged=_unflagged(conn),
+                   join="" if sensor_id is not None else
+                   "INNER JOIN sensors on sensors.sensor_id = readings.sensor_id",
+                   key="readings.sensor_id" if sensor_id is not None else "sensors.sensor_parameter")
+    else:
+        _, sensor_table, parameter_table, _ = [g for g in GRAINS if g[0] == grain][0]
+        sql = """
+            SELECT bucket, mean, min, max, count, p95
+            FROM public.{table}
+            WHERE {key} = %(key)s
+                AND bucket >= %(start)s AND bucket < %(end)s
+            ORDER BY bucket;
+        """.format(table=sensor_table if sensor_id is not None else parameter_table,
+                   key="sensor_id" if sensor_id is not None else "sensor_parameter")
+
+    return pd.read_sql_query(sql, con=conn, params=params)
@@ -0,0 +1,308 @@
+"""
+Readings table schema and migration tool.
+
+Schema versions:
+    1 - readings (id, sensor_id, date VARCHAR(19), reading FLOAT(4)),
+        no index on (sensor_id, date)
+    2 - readings (id, sensor_id, ts TIMESTAMPTZ, reading REAL),
+        unique (sensor_id, ts) index and BRIN index on ts
+
+home_devices and home_readings tables keep readings of home
+stations received over MQTT (see mqtt_bridge module), optional
+device location is used by nearest module.
+
+latest_readings materialized view keeps one row per sensor
+with its most recent non-null reading which was not flagged
+(see anomaly module), it is refreshed by
+ingest.refresh_latest_readings() after each ingestion.
+Its geography GiST index serves nearest sensor (KNN) queries.
+
+GIOŚ publishes dates as local time strings, they are converted
+to TIMESTAMPTZ using GIOS_TIMEZONE.
+
+Migration from version 1 renames old table to readings_v1
+and copies its rows in chunks. Progress is committed after each
+chunk, so migration can be stopped and started again.
+
+Example:
+    $ python -m haqs_api.schema --chunk-size 100000
+"""
+import argparse
+
+SCHEMA_VERSION = 2
+
+GIOS_TIMEZONE = "Europe/Warsaw"
+
+READINGS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS public.readings
+    (
+        id BIGSERIAL PRIMARY KEY,
+        sensor_id INTEGER NOT NULL REFERENCES sensors (sensor_id),
+        ts TIMESTAMPTZ NOT NULL,
+        reading REAL,
+        CONSTRAINT readings_sensor_id_ts_key UNIQUE (sensor_id, ts)
+    );
+    CREATE INDEX IF NOT EXISTS readings_ts_brin
+    ON public.readings USING BRIN (ts);
+"""
+
+READING_FLAGS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS public.reading_flags
+    (
+        sensor_id INTEGER NOT NULL,
+        ts TIMESTAMPTZ NOT NULL,
+        flag VARCHAR(16) NOT NULL,
+        value REAL,
+        expected REAL,
+        flagged_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (sensor_id, ts, flag)
+    );
+"""
+
+# condition on readings row, true when the reading was not flagged
+UNFLAGGED_SQL = """
+    NOT EXISTS (SELECT 1 FROM public.reading_flags
+                WHERE reading_flags.sensor_id = readings.sensor_id
+                    AND reading_flags.ts = readings.ts)
+"""
+
+LATEST_READINGS_VIEW_SQL = READING_FLAGS_TABLE_SQL + """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS public.latest_readings AS
+    SELECT sensors.sensor_id, sensors.sensor_parameter, sensors.station_id,
+        latest.ts, latest.reading, stations.geom
+    FROM sensors
+    INNER JOIN stations on sensors.station_id = stations.station_id
+    CROSS JOIN LATERAL
+    (
+        SELECT ts, reading FROM readings
+        WHERE readings.sensor_id = sensors.sensor_id
+            AND readings.reading IS NOT NULL
+            AND {unflagged}
+        ORDER BY ts DESC
+        LIMIT 1
+    ) latest;
+    CREATE UNIQUE INDEX IF NOT EXISTS latest_readings_sensor_id_key
+    ON public.latest_readings (sensor_id);
+    CREATE INDEX IF NOT EXISTS latest_readings_sensor_parameter_idx
+    ON public.latest_readings (sensor_parameter);
+    CREATE INDEX IF NOT EXISTS latest_readings_geom_gist
+    ON public.latest_readings USING GIST (geom);
+    CREATE INDEX IF NOT EXISTS latest_readings_geog_gist
+    ON public.latest_readings USING GIST ((geom::geography));
+""".format(unflagged=UNFLAGGED_SQL.strip())
+
+HOME_READINGS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS public.home_devices
+    (
+        device_id VARCHAR(64) PRIMARY KEY,
+        first_seen TIMESTAMPTZ NOT NULL,
+        last_seen TIMESTAMPTZ NOT NULL
+    );
+    ALTER TABLE public.home_devices
+    ADD COLUMN IF NOT EXISTS geom geometry(Point, 4326);
+    CREATE TABLE IF NOT EXISTS public.home_readings
+    (
+        device_id VARCHAR(64) NOT NULL REFERENCES home_devices (device_id),
+        metric VARCHAR(32) NOT NULL,
+        ts TIMESTAMPTZ NOT NULL,
+        value REAL,
+        PRIMARY KEY (device_id, metric, ts)
+    );
+    CREATE INDEX IF NOT EXISTS home_readings_ts_brin
+    ON public.home_readings USING BRIN (ts);
+"""
+
+
+def _table_columns(cur, table):
+    cur.execute("""
+                    SELECT column_name FROM information_schema.columns
+                    WHERE table_schema = 'public' AND table_name = %s;
+                """, (table,))
+    return {row[0] for row in cur.fetchall()}
+
+
+def create_schema_version_table(conn):
+    cur = conn.cursor()
+    cur.execute("""
+                    CREATE TABLE IF NOT EXISTS public.schema_version
+                    (
+                        version INTEGER PRIMARY KEY,
+                        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    );
+                    CREATE TABLE IF NOT EXISTS public.schema_migration_progress
+                    (
+                        name VARCHAR(50) PRIMARY KEY,
+                        last_id BIGINT NOT NULL
+                    );
+                """)
+    conn.commit()
+
+
+def get_schema_version(conn):
+    """
+    Function returns schema version of readings table.
+
+    Returns:
+        version (int):
+            0 when readings table does not exist
+    """
+    cur = conn.cursor()
+    columns = _table_columns(cur, "readings")
+    if not columns:
+        return 0
+    if "date" in columns:
+        return 1
+    if _table_columns(cur, "readings_v1"):
+        # migration to version 2 may have not been finished yet
+        cur.execute("SELECT coalesce(max(id), 0) FROM public.readings_v1;")
+        max_id = cur.fetchone()[0]
+        last_id = 0
+        if _table_columns(cur, "schema_migration_progress"):
+            cur.execute("""
+                            SELECT last_id FROM public.schema_migration_progress
+                            WHERE name = 'readings_v1';
+                        """)
+            row = cur.fetchone()
+            last_id = row[0] if row else 0
+        if last_id < max_id:
+            return 1
+    return SCHEMA_VERSION
+
+
+def _rename_v1_table(cur):
+    cur.execute("ALTER TABLE public.readings RENAME TO readings_v1;")
+    # free index names (readings_pkey etc.) for new table
+    cur.execute("""
+                    SELECT indexname FROM pg_indexes
+                    WHERE schemaname = 'public' AND tablename = 'readings_v1'
+                        AND indexname NOT LIKE 'readings_v1%%';
+                """)
+    for (index_name,) in cur.fetchall():
+        cur.execute('ALTER INDEX public."{}" RENAME TO "{}";'.format(
+            index_name, index_name.replace("readings", "readings_v1", 1)[:63]))
+
+
+def _copy_v1_chunk(cur, last_id, chunk_size):
+    sql =   """
+                WITH chunk AS
+                (
+                    SELECT id, sensor_id, date, reading
+                    FROM public.readings_v1
+                    WHERE id > %s
+                    ORDER BY id
+                    LIMIT %s
+                ),
+                inserted AS
+                (
+                    INSERT INTO public.readings (sensor_id, ts, reading)
+                    SELECT sensor_id, date::timestamp AT TIME ZONE %s, reading
+                    FROM chunk
+                    WHERE sensor_id IS NOT NULL
+                    ON CONFLICT (sensor_id, ts) DO NOTHING
+                )
+                SELECT max(id), count(*) FROM chunk;
+            """
+    cur.execute(sql, (last_id, chunk_size, GIOS_TIMEZONE))
+    return cur.fetchone()
+
+
+def migrate_readings(conn, chunk_size=50000, drop_old=False, verbose=True):
+    """
+    Function migrates readings table to current schema version.
+    It is safe to run it multiple times, already migrated
+    rows are not copied again.
+
+    Args:
+        conn (psycopg2.connection):
+            connection object for DataBase session.
+
+        chunk_size (int) - default 50000:
+            number of rows copied and committed at once
+
+        drop_old (bool) - default False:
+            drop readings_v1 table after successful migration
+
+        verbose (bool) - default True:
+            print migration progress
+
+    Returns:
+        copied (int):
+            number of version 1 rows processed in this run
+
+    Example:
+        In [1]: migrate_readings(conn, chunk_size=100000)
+    """
+    create_schema_version_table(conn)
+    cur = conn.cursor()
+    copied = 0
+
+    try:
+        if "date" in _table_columns(cur, "readings"):
+            _rename_v1_table(cur)
+        cur.execute(READINGS_TABLE_SQL)
+        conn.commit()
+
+        if _table_columns(cur, "readings_v1"):
+            cur.execute("""
+                            INSERT INTO public.schema_migration_progress (name, last_id)
+                            VALUES ('readings_v1', 0)
+                            ON CONFLICT (name) DO NOTHING;
+                            SELECT last_id FROM public.schema_migration_progress
+                            WHERE name = 'readings_v1';
+                        """)
+            last_id = cur.fetchone()[0]
+            conn.commit()
+
+            while True:
+                max_id, count = _copy_v1_chunk(cur, last_id, chunk_size)
+                if not count:
+                    break
+                last_id = max_id
+                copied += count
+                cur.execute("""
+                                UPDATE public.schema_migration_progress SET last_id = %s
+                                WHERE name = 'readings_v1';
+                            """, (last_id,))
+                conn.commit()
+                if verbose:
+                    print("Migrated {} rows (last id: {})".format(copied, last_id))
+
+            if drop_old:
+                cur.execute("DROP TABLE public.readings_v1;")
+
+        cur.execute(LATEST_READINGS_VIEW_SQL)
+        cur.execute("""
+                        INSERT INTO public.schema_version (version) VALUES (%s)
+                        ON CONFLICT (version) DO NOTHING;
+                    """, (SCHEMA_VERSION,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    if verbose:
+        print("Readings table is at schema version {}".format(SCHEMA_VERSION))
+    return copied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate readings table to schema version {}".format(SCHEMA_VERSION))
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    parser.add_argument("--drop-old", action="store_true",
+                        help="drop readings_v1 table after migration")
+    args = parser.parse_args(argv)
+
+    from .haqs_api import connect_with_db, close_db_connection
+
+    conn = connect_with_db()
+    if conn is None:
+        return 1
+    try:
+        migrate_readings(conn, chunk_size=args.chunk_size, drop_old=args.drop_old)
+    finally:
+        close_db_connection(conn)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
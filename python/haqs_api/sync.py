@@ -0,0 +1,148 @@
+"""
+Incremental synchronisation of sensor readings.
+
+For every sensor the latest stored reading timestamp
+(high-water mark) is read from (sensor_id, ts) index.
+Sensor payloads are downloaded concurrently and only values
+newer than the high-water mark are inserted, so each sync
+inserts new data only and gaps left by missed runs are
+filled from payload history (GIOŚ keeps last ~3 days).
+
+Values are compared as GIOŚ local time strings
+('YYYY-MM-DD HH:MM:SS'), which sort the same way as dates.
+"""
+from .harvester import Harvester
+from .ingest import bulk_insert_readings
+from .schema import GIOS_TIMEZONE
+
+NoneType = type(None)
+
+
+def get_high_water_marks(conn, lookback_hours=0):
+    """
+    Function returns latest stored reading date for each sensor.
+
+    Args:
+        conn (psycopg2.connection):
+            connection object for DataBase session.
+
+        lookback_hours (int) - default 0:
+            high-water marks are moved back by given number of hours,
+            so values published late by GIOŚ are inserted as well
+
+    Returns:
+        marks (dict):
+            sensor_id -> GIOŚ local time string,
+            None for sensors without readings
+
+    Example:
+        In [1]: get_high_water_marks(conn)
+        Out[1]: {642: '2018-10-14 15:00:00', 644: None, ...}
+    """
+    sql =   """
+                SELECT sensors.sensor_id,
+                    to_char((latest.ts - %s * interval '1 hour') AT TIME ZONE %s,
+                            'YYYY-MM-DD HH24:MI:SS')
+                FROM sensors
+                LEFT JOIN LATERAL
+                (
+                    SELECT ts FROM readings
+                    WHERE readings.sensor_id = sensors.sensor_id
+                    ORDER BY ts DESC
+                    LIMIT 1
+                ) latest ON true;
+            """
+    cur = conn.cursor()
+    cur.execute(sql, (lookback_hours, GIOS_TIMEZONE))
+    return dict(cur.fetchall())
+
+
+def new_records(sensor_id, data_json, since=None):
+    """
+    Function returns (sensor_id, date, reading) records
+    with values newer than since date. Empty values are skipped.
+
+    Args:
+        sensor_id (int)
+
+        data_json (dict):
+            GIOŚ getData payload
+
+        since (string) - default None:
+            GIOŚ local time string, None returns all values
+    """
+    records = []
+    for row in (data_json or {}).get("values", []):
+        if isinstance(row["value"], NoneType):
+            continue
+        if since is not None and row["date"] <= since:
+            continue
+        records.append((sensor_id, row["date"], row["value"]))
+    return records
+
+
+def sync_readings(conn, harvester=None, sensor_ids=None, lookback_hours=3,
+                  batch_size=50000):
+    """
+    Function inserts readings published since last sync.
+
+    Args:
+        conn (psycopg2.connection):
+            connection object for DataBase session.
+
+        harvester (harvester.Harvester) - default None:
+            harvester used to download payloads,
+            new one with default settings is used when None
+
+        sensor_ids (list) - default None:
+            sensors to synchronise, all sensors when None
+
+        lookback_hours (int) - default 3:
+            values up to lookback_hours older than latest stored
+            reading are inserted when missing
+
+        batch_size (int) - default 50000:
+            see ingest.bulk_insert_readings()
+
+    Returns:
+        stats (dict):
+            sensors - number of synchronised sensors
+            failed - number of sensors which payload was not downloaded
+            new - number of candidate values found in payloads
+            inserted - number of inserted readings
+            skipped - number of readings which already existed
+
+    Example:
+        In [1]: with Harvester(max_workers=32) as harvester:
+                    sync_readings(conn, harvester)
+        Out[1]: {'sensors': 1012, 'failed': 0, 'new': 1187,
+                 'inserted': 1009, 'skipped': 178}
+    """
+    marks = get_high_water_marks(conn, lookback_hours)
+    if sensor_ids is None:
+        sensor_ids = list(marks)
+
+    own_harvester = harvester is None
+    if own_harvester:
+        harvester = Harvester()
+    try:
+        payloads = harvester.get_sensors_data(sensor_ids)
+    finally:
+        if own_harvester:
+            harvester.close()
+
+    records = []
+    failed = 0
+    for sensor_id, data_json in zip(sensor_ids, payloads):
+        if data_json is None:
+            failed += 1
+            continue
+        records.extend(new_records(sensor_id, data_json, marks.get(sensor_id)))
+
+    inserted, skipped = bulk_insert_readings(conn, records, batch_size=batch_size)
+
+    return {"sensors": len(sensor_ids),
+            "failed": failed,
+            "new": len(records),
+            "inserted": inserted,
+            "skipped": skipped}
@@ -0,0 +1,238 @@
+"""
+Local stub of GIOŚ API.
+
+Server answers findAll, sensors, getData and getIndex
+requests with synthetic data, so harvesting code can be
+exercised without touching api.gios.gov.pl. Responses carry
+ETag, conditional requests of unchanged payloads get 304.
+
+Example:
+    In [1]: with StubGiosServer.synthetic(n_stations=250) as server:
+                harvester = Harvester(base_url=server.url)
+                stations_json = harvester.get_stations()
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+PARAMETERS = {
+    "PM10": (3, "pył zawieszony PM10", 35.0),
+    "PM2.5": (69, "pył zawieszony PM2.5", 25.0),
+    "NO2": (6, "dwutlenek azotu", 30.0),
+    "O3": (5, "ozon", 60.0),
+    "SO2": (1, "dwutlenek siarki", 8.0),
+    "CO": (8, "tlenek węgla", 500.0),
+    "C6H6": (10, "benzen", 1.5),
+}
+
+# Poland bounding box
+LON_RANGE = (14.2, 24.1)
+LAT_RANGE = (49.0, 54.8)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # default backlog (5) drops connections of concurrent harvesters
+    request_queue_size = 128
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+
+    # keep-alive, same as GIOŚ API, headers and body are written
+    # separately so Nagle's algorithm would delay every response
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    routes = [
+        (re.compile(r"/station/findAll/?$"), "stations"),
+        (re.compile(r"/station/sensors/(\d+)/?$"), "sensors"),
+        (re.compile(r"/data/getData/(\d+)/?$"), "data"),
+        (re.compile(r"/aqindex/getIndex/(\d+)/?$"), "aq_index"),
+    ]
+
+    def do_GET(self):
+        stub = self.server.stub
+        path = self.path.split("?")[0]
+        if path.startswith(stub.prefix):
+            path = path[len(stub.prefix):]
+
+        with stub.lock:
+            stub.requests_count += 1
+            attempts = stub.attempts.get(path, 0) + 1
+            stub.attempts[path] = attempts
+
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        if attempts <= stub.flaky:
+            self._send(503, {"error": "Service Unavailable"})
+            return
+
+        for pattern, name in self.routes:
+            match = pattern.match(path)
+            if match:
+                body = stub.response(name, *[int(group) for group in match.groups()])
+                if body is not None:
+                    self._send(200, body)
+                    return
+        self._send(404, {"error": "Not Found"})
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        etag = '"{}"'.format(hashlib.sha1(payload).hexdigest()[:16])
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            with self.server.stub.lock:
+                self.server.stub.not_modified += 1
+            status, payload = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=UTF-8")
+        self.send_header("Content-Length", str(len(payload)))
+        if status in (200, 304):
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubGiosServer(object):
+    """
+    Stub GIOŚ API server running in background thread.
+
+    Args:
+        stations (list):
+            findAll payload
+
+        sensors (dict):
+            station_id -> sensors payload
+
+        data (dict):
+            sensor_id -> getData payload
+
+        latency (float) - default 0:
+            seconds each response is delayed,
+            useful to emulate remote API
+
+        flaky (int) - default 0:
+            number of first requests to each path
+            answered with 503, useful to test retries
+
+        host (string) - default '127.0.0.1'
+
+        port (int) - default 0:
+            0 selects random free port
+    """
+
+    prefix = "/pjp-api/rest"
+
+    def __init__(self, stations, sensors, data, latency=0, flaky=0,
+                 host="127.0.0.1", port=0):
+        self.stations = stations
+        self.sensors = sensors
+        self.data = data
+        self.latency = latency
+        self.flaky = flaky
+        self.lock = threading.Lock()
+        self.requests_count = 0
+        self.not_modified = 0
+        self.attempts = {}
+
+        self._server = _ThreadingHTTPServer((host, port), _StubHandler)
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}{}/".format(host, port, self.prefix)
+
+    @classmethod
+    def synthetic(cls, n_stations=250, sensors_per_station=4, n_hours=72,
+                  missing_rate=0.05, seed=0, now=None, **kwargs):
+        """
+        Function creates stub server with random stations,
+        sensors and hourly readings for last n_hours.
+        The newest readings are listed first, same as in GIOŚ API.
+        """
+        rnd = random.Random(seed)
+        now = (now or datetime.now()).replace(minute=0, second=0, microsecond=0)
+        codes = list(PARAMETERS)
+
+        stations, sensors, data = [], {}, {}
+        sensor_id = 1000
+        for station_id in range(1, n_stations + 1):
+            stations.append({
+                "id": station_id,
+                "stationName": "Station {}".format(station_id),
+                "gegrLat": "{:.6f}".format(rnd.uniform(*LAT_RANGE)),
+                "gegrLon": "{:.6f}".format(rnd.uniform(*LON_RANGE)),
+                "city": {"id": station_id,
+                         "name": "City {}".format(station_id),
+                         "commune": {"communeName": "City {}".format(station_id),
+                                     "districtName": "City {}".format(station_id),
+                                     "provinceName": "MAZOWIECKIE"}},
+                "addressStreet": None,
+            })
+            station_sensors = []
+            for code in rnd.sample(codes, min(sensors_per_station, len(codes))):
+                sensor_id += 1
+                id_param, name, level = PARAMETERS[code]
+                station_sensors.append({
+                    "id": sensor_id,
+                    "stationId": station_id,
+                    "param": {"paramName": name,
+                              "paramFormula": code,
+                              "paramCode": code,
+                              "idParam": id_param},
+                })
+                values = []
+                for hour in range(n_hours):
+                    date = now - timedelta(hours=hour)
+                    value = None
+                    if rnd.random() >= missing_rate:
+                        value = round(rnd.lognormvariate(0, 0.5) * level, 5)
+                    values.append({"date": date.strftime("%Y-%m-%d %H:%M:%S"),
+                                   "value": value})
+                data[sensor_id] = {"key": code, "values": values}
+            sensors[station_id] = station_sensors
+
+        return cls(stations, sensors, data, **kwargs)
+
+    def response(self, name, *ids):
+        if name == "stations":
+            return self.stations
+        if name == "sensors":
+            return self.sensors.get(ids[0])
+        if name == "data":
+            return self.data.get(ids[0])
+        if name == "aq_index":
+            if ids[0] not in self.sensors:
+                return None
+            return {"id": ids[0],
+                    "stCalcDate": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "stIndexLevel": {"id": 1, "indexLevelName": "Dobry"}}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,37 @@
+/*
+Encodes batch of synthetic samples with sketch encoder and writes
+payload to stdout, decoded by tests/test_home_protocol.py.
+Samples have to match roundtrip_samples() of the test.
+
+  $ cc -std=c99 -I ../sketches/Home-Air-Quality-Station-MQTT-NodeRED \
+       tests/c/haqs_batch_roundtrip.c -o roundtrip -lm
+*/
+
+#include <stdio.h>
+
+#include "haqs_batch.h"
+
+#define TIMESTAMP 1539550800
+#define INTERVAL 60
+
+int main(void)
+{
+  haqs_batch_t batch;
+  uint8_t payload[HAQS_BATCH_MAX_SIZE];
+
+  haqs_batch_reset(&batch, TIMESTAMP);
+  for (int i = 0; i < INTERVAL; i++)
+  {
+    haqs_batch_add(&batch, HAQS_TEMPERATURE, 20.0f + 0.25f * i);
+    haqs_batch_add(&batch, HAQS_HUMIDITY, 40.0f + i % 7);
+    haqs_batch_add(&batch, HAQS_PRESSURE, 1013.0f - 0.5f * (i % 4));
+    haqs_batch_add(&batch, HAQS_PM1, (float)(i % 5));
+    // every tenth PM2.5 sample is missing, PM10 is not measured
+    haqs_batch_add(&batch, HAQS_PM2_5, i % 10 == 0 ? NAN : 10.0f + 0.5f * i);
+    haqs_batch_sample(&batch);
+  }
+
+  size_t length = haqs_batch_encode(&batch, INTERVAL, payload);
+  fwrite(payload, 1, length, stdout);
+  return 0;
+}
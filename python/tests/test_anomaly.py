@@ -0,0 +1,70 @@
+"""
+Flat line detection of SensorState and batch check
+with fake cursor instead of DataBase.
+
+Example:
+    $ cd python && python -m pytest tests/test_anomaly.py
+"""
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from haqs_api import anomaly
+from haqs_api.anomaly import FLAT_COUNT, FLAT_FLOORS, SensorState, detect_anomalies
+
+START = datetime(2018, 10, 14)
+
+
+def hourly(values):
+    return [(START + timedelta(hours=hour), value) for hour, value in enumerate(values)]
+
+
+def flat_flags(state, readings, **kwargs):
+    flags = []
+    for ts, value in readings:
+        flags.extend(flag for flag, _ in state.check(ts, value, **kwargs) if flag == "flatline")
+    return flags
+
+
+class FlatlineTest(unittest.TestCase):
+
+    def test_repeated_value_above_floor(self):
+        flags = flat_flags(SensorState(), hourly([31.0] * (FLAT_COUNT + 1)),
+                           flat_floor=FLAT_FLOORS["PM10"])
+        self.assertEqual(flags, ["flatline", "flatline"])
+
+    def test_repeated_value_at_detection_limit(self):
+        cases = [("C6H6", 0.1), ("SO2", 2.0), ("CO", 200.0), ("PM2.5", 3.0), ("PM10", 0.0)]
+        for parameter, value in cases:
+            with self.subTest(parameter=parameter):
+                flags = flat_flags(SensorState(), hourly([value] * 24),
+                                   flat_floor=FLAT_FLOORS[parameter])
+                self.assertEqual(flags, [])
+
+    def test_interrupted_repetition(self):
+        values = [31.0] * (FLAT_COUNT - 1) + [32.0] + [31.0] * (FLAT_COUNT - 1)
+        self.assertEqual(flat_flags(SensorState(), hourly(values)), [])
+
+
+class DetectAnomaliesTest(unittest.TestCase):
+
+    def test_floor_of_parameter(self):
+        rows = [(sensor_id, ts, value, parameter, None, 0)
+                for sensor_id, parameter, value in ((642, "PM10", 31.0), (658, "C6H6", 0.5))
+                for ts, value in hourly([value] * FLAT_COUNT)]
+        cur = mock.Mock()
+        cur.fetchall.side_effect = [rows, []]
+        conn = mock.Mock(cursor=mock.Mock(return_value=cur))
+
+        with mock.patch.object(anomaly, "execute_values") as execute_values:
+            self.assertEqual(detect_anomalies(conn), 1)
+
+        batch_sql = cur.execute.call_args_list[0][0][0]
+        self.assertIn("NOT EXISTS (SELECT 1 FROM reading_flags", batch_sql)
+        flags = execute_values.call_args_list[0][0][2]
+        self.assertEqual([(sensor_id, flag) for sensor_id, _, flag, _, _ in flags],
+                         [(642, "flatline")])
+
+
+if __name__ == "__main__":
+    unittest.main()
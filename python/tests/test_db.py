@@ -0,0 +1,132 @@
+"""
+Connection pool locking with fake psycopg2 connections.
+
+Example:
+    $ cd python && python -m pytest tests/test_db.py
+"""
+import threading
+import time
+import unittest
+from unittest import mock
+
+import psycopg2
+from psycopg2 import extensions
+
+from haqs_api.db import ConnectionPool, PoolClosed, PoolTimeout
+
+
+class FakeConnection(object):
+
+    def __init__(self, rollback_delay=0.0):
+        self.closed = 0
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+        self.rollback_delay = rollback_delay
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        time.sleep(self.rollback_delay)
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def start_pool(self, connect, **kwargs):
+        patch = mock.patch.object(psycopg2, "connect", side_effect=connect)
+        patch.start()
+        self.addCleanup(patch.stop)
+        pool = ConnectionPool("dbname=test", **kwargs)
+        self.addCleanup(pool.closeall)
+        return pool
+
+    def in_thread(self, target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return thread
+
+    def test_slow_connect_does_not_block_idle_connections(self):
+        connected = threading.Event()
+        release = threading.Event()
+
+        opened = []
+
+        def connect(dsn):
+            opened.append(dsn)
+            if len(opened) > 1:
+                connected.set()
+                release.wait(5)
+            return FakeConnection()
+
+        pool = self.start_pool(connect, minconn=1, maxconn=2)
+        first = pool.getconn()
+        self.in_thread(pool.getconn)
+        self.assertTrue(connected.wait(5))
+
+        start = time.perf_counter()
+        pool.putconn(first)
+        self.assertIs(pool.getconn(timeout=1), first)
+        self.assertLess(time.perf_counter() - start, 0.5)
+        with self.assertRaises(PoolTimeout):
+            pool.getconn(timeout=0.1)
+        release.set()
+
+    def test_slow_rollback_does_not_block_pool(self):
+        pool = self.start_pool(lambda dsn: FakeConnection(rollback_delay=1.0), minconn=2, maxconn=2)
+        busy, free = pool.getconn(), pool.getconn()
+        busy.status = extensions.TRANSACTION_STATUS_INTRANS
+        pool.putconn(free)
+        self.in_thread(lambda: pool.putconn(busy))
+        time.sleep(0.1)
+
+        start = time.perf_counter()
+        self.assertIs(pool.getconn(timeout=2), free)
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertIs(pool.getconn(timeout=2), busy)
+        self.assertEqual(busy.status, extensions.TRANSACTION_STATUS_IDLE)
+
+    def test_failed_connect_gives_slot_back(self):
+        attempts = []
+
+        def connect(dsn):
+            attempts.append(dsn)
+            if len(attempts) == 1:
+                raise psycopg2.OperationalError("server unreachable")
+            return FakeConnection()
+
+        pool = self.start_pool(connect, minconn=0, maxconn=1)
+        with self.assertRaises(psycopg2.OperationalError):
+            pool.getconn(timeout=0.1)
+        pool.getconn(timeout=0.1)
+        self.assertEqual(pool.stats()["size"], 1)
+
+    def test_closed_pool_raises(self):
+        pool = self.start_pool(lambda dsn: FakeConnection(), minconn=1, maxconn=1)
+        conn = pool.getconn()
+        closed = []
+
+        def wait_for_connection():
+            try:
+                pool.getconn(timeout=5)
+            except PoolClosed:
+                closed.append(True)
+
+        thread = self.in_thread(wait_for_connection)
+        time.sleep(0.1)
+
+        pool.closeall()
+        thread.join(5)
+        self.assertEqual(closed, [True])
+        with self.assertRaises(PoolClosed):
+            pool.getconn()
+        pool.putconn(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()["size"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
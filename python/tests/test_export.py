@@ -0,0 +1,107 @@
+"""
+GeoParquet export layout and incremental state,
+readings are served by fake query instead of DataBase.
+
+Example:
+    $ cd python && python -m pytest tests/test_export.py
+"""
+import json
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import pandas as pd
+
+from haqs_api import export
+from haqs_api.export import STATE_FILE, export_readings_parquet, read_readings_parquet
+
+
+def point_wkb(lon, lat):
+    return memoryview(struct.pack("<BIdd", 1, 1, lon, lat))
+
+
+def readings_frame(rows):
+    return pd.DataFrame([(id_, sensor_id, 10, parameter, pd.Timestamp(ts, tz="UTC"), reading,
+                          point_wkb(17.03, 51.11))
+                         for id_, sensor_id, parameter, ts, reading in rows],
+                        columns=["id", "sensor_id", "station_id", "parameter", "ts",
+                                 "reading", "geometry"])
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.readings = readings_frame([
+            (1, 642, "PM10", "2018-10-14 13:00", 31.0),
+            (2, 643, "NO2", "2018-10-14 13:00", 12.5),
+            # 23:30 UTC is November in Warsaw
+            (3, 642, "PM10", "2018-10-31 23:30", 40.0),
+            (5, 642, "PM10", "2018-11-02 10:00", 22.0),
+        ])
+        self.queries = []
+
+    def iter_query(self, conn, sql, params, chunksize):
+        self.queries.append(params)
+        selected = self.readings[(self.readings["id"] > params["last_id"])
+                                 & (self.readings["id"] <= params["committed_id"])]
+        for start in range(0, len(selected), chunksize):
+            yield selected.iloc[start:start + chunksize].copy()
+
+    def export(self, committed_id, **kwargs):
+        conn = mock.Mock()
+        conn.cursor.return_value.fetchone.return_value = [committed_id]
+        with mock.patch.object(export, "iter_query", self.iter_query):
+            exported = export_readings_parquet(conn, self.path, chunksize=2, **kwargs)
+        conn.commit.assert_called()
+        return exported
+
+    def state(self):
+        with open(os.path.join(self.path, STATE_FILE)) as state_file:
+            return json.load(state_file)
+
+    def test_partition_layout(self):
+        self.assertEqual(self.export(committed_id=5), 4)
+
+        partitions = sorted(os.path.relpath(root, self.path)
+                            for root, _, files in os.walk(self.path)
+                            if any(name.endswith(".parquet") for name in files))
+        self.assertEqual(partitions, ["parameter=NO2/month=2018-10",
+                                      "parameter=PM10/month=2018-10",
+                                      "parameter=PM10/month=2018-11"])
+
+        readings_df = read_readings_parquet(self.path, parameter="PM10",
+                                            start=datetime(2018, 11, 1), geodataframe=False)
+        self.assertEqual(sorted(readings_df["reading"].tolist()), [22.0, 40.0])
+        self.assertEqual(set(readings_df["month"].astype(str)), {"2018-11"})
+
+    def test_state_roundtrip(self):
+        # id 4 is inserted by transaction in flight, so ids above 3 are not exported yet
+        self.assertEqual(self.export(committed_id=3), 3)
+        self.assertEqual(self.state(), {"last_id": 3})
+
+        self.readings = pd.concat([self.readings, readings_frame([
+            (4, 643, "NO2", "2018-11-01 09:00", 8.0)])])
+        self.assertEqual(self.export(committed_id=5), 2)
+        self.assertEqual(self.queries[-1], {"last_id": 3, "committed_id": 5})
+        self.assertEqual(self.state(), {"last_id": 5})
+
+        self.assertEqual(self.export(committed_id=5), 0)
+        self.assertEqual(sorted(read_readings_parquet(self.path, geodataframe=False)["reading"]),
+                         [8.0, 12.5, 22.0, 31.0, 40.0])
+
+    def test_full_export_ignores_state(self):
+        self.export(committed_id=5)
+        self.export(committed_id=5, incremental=False)
+
+        self.assertEqual(self.queries[-1]["last_id"], 0)
+        self.assertEqual(len(read_readings_parquet(self.path, geodataframe=False)), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
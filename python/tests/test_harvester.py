@@ -0,0 +1,97 @@
+"""
+Harvester against local stub of GIOŚ API.
+
+Example:
+    $ cd python && python -m pytest tests/test_harvester.py
+"""
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from haqs_api import haqs_api, http_cache
+from haqs_api.harvester import Harvester, latest_value
+from haqs_api.testing import StubGiosServer
+
+
+def legacy_urls(url):
+    """
+    Function returns patches pointing request URLs
+    of haqs_api module functions at stub server.
+    """
+    return [mock.patch.object(haqs_api, "sensors_request", url + "station/sensors/"),
+            mock.patch.object(haqs_api, "data_request", url + "data/getData/")]
+
+
+class HarvesterTest(unittest.TestCase):
+
+    def setUp(self):
+        http_cache.disable()
+        self.environ = mock.patch.dict("os.environ", {"HAQS_HTTP_CACHE": ""})
+        self.environ.start()
+        self.addCleanup(self.environ.stop)
+
+    def start_server(self, **kwargs):
+        server = StubGiosServer.synthetic(n_stations=20, sensors_per_station=4, n_hours=6,
+                                          seed=1, **kwargs).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def start_harvester(self, server, **kwargs):
+        harvester = Harvester(server.url, **kwargs)
+        self.addCleanup(harvester.close)
+        return harvester
+
+    def test_same_frames_as_serial_functions(self):
+        server = self.start_server()
+        harvester = self.start_harvester(server)
+
+        sensors_df = harvester.create_sensors_df(server.stations)
+        readings_df = harvester.get_latest_sensors_readings(sensors_df.copy())
+
+        patches = legacy_urls(server.url)
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        legacy_sensors_df = haqs_api.create_sensors_df(server.stations)
+        legacy_readings_df = haqs_api.get_latest_sensors_readings(legacy_sensors_df.copy())
+
+        self.assertEqual(len(sensors_df), 20 * 4)
+        self.assertTrue(sensors_df.equals(legacy_sensors_df))
+        self.assertTrue(readings_df.equals(legacy_readings_df))
+        self.assertFalse(readings_df["value"].isnull().all())
+
+    def test_retries_recover_from_failures(self):
+        server = self.start_server(flaky=2)
+        harvester = self.start_harvester(server, retries=3, backoff_factor=0)
+
+        sensors_df = harvester.create_sensors_df(server.stations)
+        readings_df = harvester.get_latest_sensors_readings(sensors_df)
+
+        self.assertEqual(len(sensors_df), 20 * 4)
+        expected = [latest_value(server.data[sensor_id]) for sensor_id in readings_df["sensor_id"]]
+        np.testing.assert_array_equal(readings_df["value"].values, expected)
+        self.assertEqual(set(server.attempts.values()), {3})
+
+    def test_failures_above_retries_are_missing(self):
+        server = self.start_server(flaky=2)
+        harvester = self.start_harvester(server, retries=1, backoff_factor=0)
+
+        self.assertEqual(harvester.get_sensors_data([1001, 1002]), [None, None])
+
+    def test_timeout_is_missing_reading(self):
+        server = self.start_server(latency=2.0)
+        harvester = self.start_harvester(server, timeout=0.2, retries=0)
+        sensors_df = haqs_api.pd.DataFrame({"station_id": [1, 1], "sensor_id": [1001, 1002],
+                                            "parameter": ["PM10", "NO2"]})
+
+        start = time.perf_counter()
+        readings_df = harvester.get_latest_sensors_readings(sensors_df)
+
+        self.assertLess(time.perf_counter() - start, 1.5)
+        self.assertTrue(readings_df["value"].isnull().all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+"""
+Binary batch format of home stations, Python and C encoder.
+
+Example:
+    $ cd python && python -m pytest tests/test_home_protocol.py
+"""
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from haqs_api.home_protocol import (CHANNELS, HEADER, BatchError, decode_batch,
+                                    encode_batch, summarize)
+from haqs_api.mqtt_bridge import MqttBridge
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SKETCH_DIR = os.path.join(TESTS_DIR, os.pardir, os.pardir, "sketches",
+                          "Home-Air-Quality-Station-MQTT-NodeRED")
+
+# values exactly representable as float32
+METRICS = {"temperature": (19.5, 21.25, 23.0), "humidity": (40.0, 42.5, 45.0),
+           "pressure": (1012.0, 1013.25, 1014.5), "pm1": (3.0, 4.5, 6.0),
+           "pm2_5": (8.0, 10.75, 14.0), "pm10": (12.0, 16.5, 21.0)}
+
+
+def roundtrip_samples():
+    """
+    Function returns samples encoded by tests/c/haqs_batch_roundtrip.c.
+    """
+    return [{"temperature": 20.0 + 0.25 * i,
+             "humidity": 40.0 + i % 7,
+             "pressure": 1013.0 - 0.5 * (i % 4),
+             "pm1": float(i % 5),
+             "pm2_5": math.nan if i % 10 == 0 else 10.0 + 0.5 * i}
+            for i in range(60)]
+
+
+class HomeProtocolTest(unittest.TestCase):
+
+    def test_roundtrip_all_channels(self):
+        payload = encode_batch(1539550800, METRICS, interval=60, samples=60)
+
+        self.assertEqual(len(payload), 84)
+        self.assertEqual(decode_batch(payload), {"timestamp": 1539550800, "interval": 60,
+                                                 "samples": 60, "metrics": METRICS})
+
+    def test_roundtrip_every_channel(self):
+        for channel in CHANNELS:
+            with self.subTest(channel=channel):
+                metrics = {channel: METRICS[channel]}
+                payload = encode_batch(1539550800, metrics, interval=10, samples=5)
+                self.assertEqual(decode_batch(payload)["metrics"], metrics)
+
+    def test_wrong_length_rejected(self):
+        payload = encode_batch(1539550800, METRICS, interval=60, samples=60)
+        for broken in (payload[:HEADER.size - 1], payload[:-1], payload + b"\x00"):
+            with self.subTest(length=len(broken)):
+                with self.assertRaises(BatchError):
+                    decode_batch(broken)
+
+    def test_bad_header_rejected(self):
+        payload = bytearray(encode_batch(1539550800, {"pm10": METRICS["pm10"]}, 60, 60))
+        for offset, byte in ((0, ord("X")), (2, 2), (3, 0x60), (3, 0x21)):
+            broken = bytearray(payload)
+            broken[offset] = byte
+            with self.subTest(offset=offset, byte=byte):
+                with self.assertRaises(BatchError):
+                    decode_batch(bytes(broken))
+
+    def test_summarize(self):
+        samples = [{"pm10": 20, "pm1": None}, {"pm10": 31, "pm1": math.nan},
+                   {"pm10": 25, "pm1": 4}]
+
+        self.assertEqual(summarize(samples), {"pm10": (20.0, 25.333333333333332, 31.0),
+                                              "pm1": (4.0, 4.0, 4.0)})
+        self.assertEqual(summarize([]), {})
+
+
+class HandleBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        self.bridge = MqttBridge(spool_dir=spool_dir, flush_interval=0.01)
+
+    def test_mean_min_max_rows(self):
+        payload = encode_batch(1539550800, {"pm10": (20.0, 24.5, 31.0)}, interval=60, samples=60)
+
+        self.assertTrue(self.bridge.handle("kitchen/haqs/batch", payload, ts=1539550900.0))
+        self.assertEqual(self.bridge._drain(), ["kitchen\tpm10\t1539550800\t24.5\n",
+                                                "kitchen\tpm10_min\t1539550800\t20.0\n",
+                                                "kitchen\tpm10_max\t1539550800\t31.0\n"])
+
+    def test_receive_time_without_rtc(self):
+        payload = encode_batch(0, {"humidity": (40.0, 41.0, 42.0)}, interval=60, samples=60)
+
+        self.assertTrue(self.bridge.handle("haqs/batch", payload, ts=1539550900.0))
+        self.assertEqual([line.split("\t")[:3] for line in self.bridge._drain()],
+                         [["home", name, "1539550900.0"]
+                          for name in ("humidity", "humidity_min", "humidity_max")])
+
+    def test_malformed_batch_ignored(self):
+        self.assertFalse(self.bridge.handle("kitchen/haqs/batch", b"HQ\x01"))
+        self.assertEqual(self.bridge.counters["ignored"], 1)
+        self.assertEqual(self.bridge._drain(), [])
+
+
+class EncoderRoundtripTest(unittest.TestCase):
+
+    def test_c_encoder(self):
+        compiler = shutil.which(os.environ.get("CC", "cc"))
+        if compiler is None:
+            self.skipTest("C compiler not found")
+        build_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, build_dir)
+        program = os.path.join(build_dir, "roundtrip")
+        subprocess.run([compiler, "-std=c99", "-Wall", "-Werror", "-I", SKETCH_DIR,
+                        os.path.join(TESTS_DIR, "c", "haqs_batch_roundtrip.c"),
+                        "-o", program, "-lm"], check=True)
+
+        batch = decode_batch(subprocess.run([program], stdout=subprocess.PIPE,
+                                            check=True).stdout)
+
+        self.assertEqual((batch["timestamp"], batch["interval"], batch["samples"]),
+                         (1539550800, 60, 60))
+        expected = summarize(roundtrip_samples())
+        self.assertEqual(sorted(batch["metrics"]), sorted(expected))
+        for metric, values in expected.items():
+            for value, expected_value in zip(batch["metrics"][metric], values):
+                self.assertTrue(math.isclose(value, expected_value, rel_tol=1e-6),
+                                "{}: {} != {}".format(metric, value, expected_value))
+
+
+if __name__ == "__main__":
+    unittest.main()
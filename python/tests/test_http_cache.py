@@ -0,0 +1,91 @@
+"""
+Response cache against local stub of GIOŚ API.
+
+Example:
+    $ cd python && python -m pytest tests/test_http_cache.py
+"""
+import unittest
+
+import requests
+
+from haqs_api.daemon import MIN_RETRY
+from haqs_api.http_cache import ResponseCache
+from haqs_api.testing import StubGiosServer
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubGiosServer.synthetic(n_stations=5, sensors_per_station=4, n_hours=24,
+                                               seed=1).start()
+        self.addCleanup(self.server.stop)
+        self.session = requests.Session()
+        self.addCleanup(self.session.close)
+
+    def start_cache(self, **kwargs):
+        cache = ResponseCache(":memory:", **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def get(self, cache, path):
+        return cache.get_json(self.server.url + path, self.session)
+
+    def test_hits_and_misses(self):
+        cache = self.start_cache()
+
+        first = self.get(cache, "station/findAll")
+        second = self.get(cache, "station/findAll")
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.requests_count, 1)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 1, 1))
+
+    def test_expired_response_is_revalidated(self):
+        cache = self.start_cache(ttls=(("data/getData/", 0),))
+
+        first = self.get(cache, "data/getData/1001")
+        second = self.get(cache, "data/getData/1001")
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.requests_count, 2)
+        self.assertEqual(self.server.not_modified, 1)
+        self.assertEqual(cache.stats()["revalidated"], 1)
+
+    def test_changed_response_replaces_expired_one(self):
+        cache = self.start_cache(ttls=(("data/getData/", 0),))
+        self.get(cache, "data/getData/1001")
+
+        self.server.data[1001] = {"key": "PM10",
+                                  "values": [{"date": "2018-10-14 14:00:00", "value": 12.0}]}
+        data_json = self.get(cache, "data/getData/1001")
+
+        self.assertEqual(data_json, self.server.data[1001])
+        self.assertEqual(self.server.not_modified, 0)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_readings_expire_before_daemon_retry(self):
+        cache = self.start_cache()
+        self.assertLess(cache.ttl(self.server.url + "data/getData/1001"), MIN_RETRY)
+
+    def test_least_recently_used_evicted(self):
+        cache = self.start_cache()
+        self.get(cache, "station/sensors/1")
+        self.get(cache, "station/sensors/2")
+        size = cache.stats()["size"]
+        cache.max_size = size + size // 4
+
+        self.get(cache, "station/sensors/1")
+        self.get(cache, "station/sensors/3")
+        stats = cache.stats()
+        self.assertEqual((stats["evictions"], stats["entries"]), (1, 2))
+
+        requests_count = self.server.requests_count
+        self.get(cache, "station/sensors/1")
+        self.assertEqual(self.server.requests_count, requests_count)
+        self.get(cache, "station/sensors/2")
+        self.assertEqual(self.server.requests_count, requests_count + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+Import time budget of ingestion command line.
+
+Core modules are imported in fresh interpreter, which must not load
+geo and plotting stacks and has to finish within IMPORT_BUDGET
+seconds (HAQS_IMPORT_BUDGET environment variable overrides it).
+
+Example:
+    $ cd python && python -m pytest tests
+"""
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_BUDGET = float(os.environ.get("HAQS_IMPORT_BUDGET", 0.5))
+
+CORE_MODULES = ("haqs_api.__main__", "haqs_api.daemon", "haqs_api.sync",
+                "haqs_api.ingest", "haqs_api.harvester", "haqs_api.db",
+                "haqs_api.readers")
+
+HEAVY_MODULES = ("pandas", "geopandas", "fiona", "shapely", "folium",
+                 "matplotlib", "bokeh", "scipy", "pyarrow")
+
+SCRIPT = """
+import importlib, json, sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    importlib.import_module(name)
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed,
+                  "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def import_in_subprocess(modules):
+    env = dict(os.environ, PYTHONPATH=PYTHON_DIR, PYTHONDONTWRITEBYTECODE="1")
+    script = SCRIPT.format(modules=tuple(modules), heavy=HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, "-c", script], env=env, cwd=PYTHON_DIR)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+class ImportBudgetTest(unittest.TestCase):
+
+    def test_core_does_not_load_extras(self):
+        result = import_in_subprocess(CORE_MODULES)
+        self.assertEqual(result["loaded"], [])
+
+    def test_haqs_api_defers_geo_and_plotting(self):
+        result = import_in_subprocess(["haqs_api.haqs_api"])
+        self.assertEqual(result["loaded"], [])
+
+    def test_core_import_time(self):
+        # first import warms up file system cache, second one is measured
+        import_in_subprocess(CORE_MODULES)
+        result = import_in_subprocess(CORE_MODULES)
+        self.assertLess(result["elapsed"], IMPORT_BUDGET,
+                        "core import took {:.3f}s".format(result["elapsed"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Weights of stations without reading derived from cached weights.
+
+Example:
+    $ cd python && python -m pytest tests/test_interpolation.py
+"""
+import unittest
+
+import numpy as np
+
+from haqs_api import interpolation
+from haqs_api.interpolation import Grid, Interpolator, interpolate_parameters
+
+
+def synthetic_points(n_stations=60, seed=0):
+    rng = np.random.default_rng(seed)
+    xy = np.column_stack([rng.uniform(140000, 890000, n_stations),
+                          rng.uniform(120000, 800000, n_stations)])
+    return np.arange(n_stations) + 100, xy, rng.uniform(5, 80, n_stations)
+
+
+class InterpolatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = Grid(resolution=10000)
+        self.station_ids, self.stations_xy, self.values = synthetic_points()
+        self.values[[3, 17, 40]] = np.nan
+        self.available = np.isfinite(self.values)
+
+    def interpolators(self, method, **params):
+        warm = Interpolator(self.grid, method, **params)
+        warm.interpolate(self.station_ids, self.stations_xy, np.ones(len(self.values)))
+        return warm, Interpolator(self.grid, method, **params)
+
+    def test_kriging_matches_rebuilt_weights(self):
+        warm, cold = self.interpolators("kriging")
+
+        surface = warm.interpolate(self.station_ids, self.stations_xy, self.values)
+        expected = cold.interpolate(self.station_ids[self.available],
+                                    self.stations_xy[self.available], self.values[self.available])
+
+        np.testing.assert_allclose(surface, expected, rtol=1e-9)
+
+    def test_idw_rows_renormalised(self):
+        warm, cold = self.interpolators("idw", k=4)
+
+        matrix = warm.subset_weights(self.station_ids, self.stations_xy, self.available)
+        full = warm.weights(self.station_ids, self.stations_xy)
+
+        self.assertEqual(matrix[:, ~self.available].nnz, 0)
+        rows = np.diff(matrix.indptr) > 0
+        np.testing.assert_allclose(np.asarray(matrix.sum(axis=1)).ravel()[rows], 1.0)
+        self.assertFalse((rows & (np.diff(full.indptr) == 0)).any())
+
+        untouched = np.asarray(full[:, ~self.available].sum(axis=1)).ravel() == 0
+        np.testing.assert_allclose(matrix[untouched].toarray(), full[untouched].toarray(), rtol=1e-12)
+
+    def test_all_missing(self):
+        surface = Interpolator(self.grid).interpolate(self.station_ids, self.stations_xy,
+                                                      np.full(len(self.values), np.nan))
+        self.assertTrue(np.isnan(surface).all())
+
+    def test_worker_processes_keep_interpolators(self):
+        self.addCleanup(interpolation.shutdown_workers)
+        points = {"PM10": (self.station_ids, self.stations_xy, self.values),
+                  "NO2": synthetic_points(seed=1)}
+
+        surfaces = interpolate_parameters(points, self.grid, max_workers=2)
+        again = interpolate_parameters(points, self.grid, max_workers=2)
+        local = interpolate_parameters(points, self.grid, max_workers=1)
+
+        self.assertEqual(len(interpolation._workers[2].assigned), 2)
+        for parameter in points:
+            np.testing.assert_array_equal(surfaces[parameter], again[parameter])
+            np.testing.assert_array_equal(surfaces[parameter], local[parameter])
+
+
+if __name__ == "__main__":
+    unittest.main()
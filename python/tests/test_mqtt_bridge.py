@@ -0,0 +1,236 @@
+"""
+MQTT bridge parsing, spooling and replay without broker and DataBase.
+
+Example:
+    $ cd python && python -m pytest tests/test_mqtt_bridge.py
+
+BrokerTest runs when MQTT broker is reachable at HAQS_MQTT_BROKER
+(default localhost:1883), i.e. local mosquitto, and is skipped otherwise.
+"""
+import contextlib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import psycopg2
+
+from haqs_api import mqtt_bridge
+from haqs_api.home_protocol import BATCH_TOPIC, encode_batch
+from haqs_api.mqtt_bridge import MqttBridge, parse_topic
+
+BROKER = os.environ.get("HAQS_MQTT_BROKER", "localhost:1883")
+
+
+@contextlib.contextmanager
+def no_connection():
+    yield None
+
+
+def broker_address():
+    host, _, port = BROKER.partition(":")
+    return host, int(port or 1883)
+
+
+def broker_reachable():
+    try:
+        import paho.mqtt.client  # noqa: F401
+        socket.create_connection(broker_address(), timeout=0.5).close()
+    except (ImportError, OSError):
+        return False
+    return True
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+class ParseTopicTest(unittest.TestCase):
+
+    def test_device_prefix(self):
+        self.assertEqual(parse_topic("kitchen/pms7003/pm2pt5"), ("kitchen", "pm2_5"))
+        self.assertEqual(parse_topic("home/kitchen/bme280/temp"), ("kitchen", "temperature"))
+
+    def test_default_device(self):
+        self.assertEqual(parse_topic("bme280/humid", "living-room"), ("living-room", "humidity"))
+
+    def test_unknown_metric(self):
+        self.assertIsNone(parse_topic("kitchen/bme280/light"))
+        self.assertIsNone(parse_topic("bme280"))
+
+    def test_rejected_device_ids(self):
+        for device_id in ("", "x" * 65, "kit\tchen", "kit\\chen", "kit\x00chen", "kit\nchen"):
+            with self.subTest(device_id=device_id):
+                self.assertIsNone(parse_topic(device_id + "/bme280/temp"))
+
+
+class BridgeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_dir)
+        self.bridge = MqttBridge(spool_dir=self.spool_dir, flush_interval=0.01)
+        patch = mock.patch.object(mqtt_bridge, "connection", no_connection)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def queued(self):
+        return self.bridge._drain()
+
+    def write_segment(self, *lines):
+        self.bridge._write_segment(list(lines))
+
+    def test_handle_queues_reading(self):
+        self.assertTrue(self.bridge.handle("kitchen/bme280/temp", b"21.5", ts=1000.0))
+        self.assertEqual(self.queued(), ["kitchen\ttemperature\t1000.0\t21.5\n"])
+
+    def test_handle_ignores_invalid_values(self):
+        for payload in (b"warm", b"", b"nan", b"inf", b"-inf", b"1e300", b"-1e39"):
+            with self.subTest(payload=payload):
+                self.assertFalse(self.bridge.handle("kitchen/bme280/temp", payload))
+        self.assertTrue(self.bridge.handle("kitchen/bme280/pressure", b"3.4e38"))
+        self.assertEqual(self.bridge.counters["ignored"], 7)
+        self.assertEqual(self.bridge.counters["received"], 1)
+        self.assertEqual(len(self.queued()), 1)
+
+    def test_handle_ignores_rejected_topics(self):
+        self.assertFalse(self.bridge.handle("kit\\chen/bme280/temp", b"21.5"))
+        self.assertFalse(self.bridge.handle("kitchen/bme280/light", b"21.5"))
+        self.assertEqual(self.queued(), [])
+
+    def test_flush_spools_and_replays(self):
+        self.bridge.handle("kitchen/bme280/temp", b"21.5", ts=1000.0)
+        self.bridge.handle("kitchen/bme280/humid", b"40", ts=1000.0)
+        with mock.patch.object(mqtt_bridge, "write_rows", side_effect=psycopg2.OperationalError):
+            self.assertFalse(self.bridge.flush())
+        self.assertEqual(len(self.bridge.pending_segments()), 1)
+
+        self.bridge._retry_at = 0
+        with mock.patch.object(mqtt_bridge, "write_rows") as write_rows:
+            self.assertTrue(self.bridge.replay())
+        write_rows.assert_called_once_with(None, "kitchen\ttemperature\t1000.0\t21.5\n"
+                                                 "kitchen\thumidity\t1000.0\t40.0\n")
+        self.assertEqual(self.bridge.stats()["pending_segments"], 0)
+        self.assertEqual(self.bridge.counters["written"], 2)
+
+    def test_lost_connection_keeps_segments(self):
+        self.write_segment("kitchen\ttemperature\t1000.0\t21.5\n")
+        bridge = self.bridge
+        with mock.patch.object(mqtt_bridge, "write_rows", side_effect=psycopg2.OperationalError):
+            for _ in range(bridge.max_attempts + 1):
+                bridge._retry_at = 0
+                self.assertFalse(bridge.replay())
+        self.assertEqual(len(bridge.pending_segments()), 1)
+        self.assertEqual(bridge.dead_segments(), [])
+
+    def test_rejected_segment_moved_aside(self):
+        self.write_segment("kitchen\ttemperature\t1000.0\t1e39\n")
+        self.write_segment("kitchen\ttemperature\t1060.0\t21.5\n")
+        poison = self.bridge.pending_segments()[0]
+
+        def write_rows(conn, data):
+            if "1e39" in data:
+                raise psycopg2.DataError("value out of range for type real")
+
+        with mock.patch.object(mqtt_bridge, "write_rows", side_effect=write_rows):
+            self.assertTrue(self.bridge.replay())
+        self.assertEqual(self.bridge.pending_segments(), [])
+        self.assertEqual(self.bridge.dead_segments(), [poison[:-len(".tsv")] + ".dead"])
+        self.assertEqual(self.bridge.counters["written"], 1)
+        self.assertEqual(self.bridge.counters["dead"], 1)
+
+    def test_failing_segment_moved_aside_after_max_attempts(self):
+        self.write_segment("kitchen\ttemperature\t1000.0\t21.5\n")
+        self.write_segment("kitchen\ttemperature\t1060.0\t21.5\n")
+        first, second = self.bridge.pending_segments()
+        written = []
+
+        def write_rows(conn, data):
+            if "1000.0" in data:
+                raise ValueError("broken segment")
+            written.append(data)
+
+        with mock.patch.object(mqtt_bridge, "write_rows", side_effect=write_rows):
+            for _ in range(self.bridge.max_attempts - 1):
+                self.bridge._retry_at = 0
+                self.assertFalse(self.bridge.replay())
+            self.assertEqual(self.bridge.pending_segments(), [first, second])
+            self.bridge._retry_at = 0
+            self.assertTrue(self.bridge.replay())
+
+        self.assertEqual(written, ["kitchen\ttemperature\t1060.0\t21.5\n"])
+        self.assertEqual(os.listdir(self.spool_dir), [first[:-len(".tsv")] + ".dead"])
+        self.assertEqual(self.bridge.counters["failures"], self.bridge.max_attempts)
+
+    def test_counters_from_many_threads(self):
+        def publish():
+            for _ in range(2000):
+                self.bridge.handle("kitchen/bme280/temp", b"21.5")
+                self.bridge.handle("kitchen/bme280/temp", b"nan")
+
+        threads = [threading.Thread(target=publish) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = self.bridge.stats()
+        self.assertEqual((stats["received"], stats["ignored"]), (8000, 8000))
+
+
+@unittest.skipUnless(broker_reachable(), "MQTT broker not reachable at " + BROKER)
+class BrokerTest(unittest.TestCase):
+
+    def setUp(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        self.written = []
+        for patch in (mock.patch.object(mqtt_bridge, "connection", no_connection),
+                      mock.patch.object(mqtt_bridge, "write_rows",
+                                        side_effect=lambda conn, data: self.written.append(data))):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.device = "haqs-test-{}".format(os.getpid())
+        host, port = broker_address()
+        self.bridge = MqttBridge(host, port, spool_dir=spool_dir, flush_interval=0.05,
+                                 topics=(self.device + "/bme280/+", self.device + "/" + BATCH_TOPIC),
+                                 client_id=self.device + "-bridge")
+        self.bridge.start()
+        self.addCleanup(self.bridge.stop)
+
+        self.publisher = mqtt_bridge._mqtt_client(self.device + "-publisher")
+        self.publisher.connect(host, port)
+        self.publisher.loop_start()
+        self.addCleanup(self.publisher.loop_stop)
+        self.addCleanup(self.publisher.disconnect)
+
+    def test_published_readings_are_written(self):
+        self.assertTrue(wait_for(self.bridge._client.is_connected))
+        # subscription is sent from on_connect callback
+        time.sleep(0.5)
+
+        messages = [(self.device + "/bme280/temp", b"21.5"),
+                    (self.device + "/bme280/humid", b"warm"),
+                    (self.device + "/" + BATCH_TOPIC,
+                     encode_batch(1539550800, {"pm10": (20.0, 24.5, 31.0)}, interval=60, samples=60))]
+        for topic, payload in messages:
+            self.publisher.publish(topic, payload, qos=1).wait_for_publish(5)
+
+        self.assertTrue(wait_for(lambda: self.bridge.stats()["written"] >= 4))
+        rows = sorted(line.split("\t")[1] for line in "".join(self.written).splitlines())
+        self.assertEqual(rows, ["pm10", "pm10_max", "pm10_min", "temperature"])
+        self.assertEqual(self.bridge.stats()["ignored"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Choice of rollup grain for requested range and number of points.
+
+Example:
+    $ cd python && python -m pytest tests/test_rollups.py
+"""
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from haqs_api import rollups
+from haqs_api.rollups import choose_rollup, return_rollup_df
+
+
+class ChooseRollupTest(unittest.TestCase):
+
+    def test_grain_of_resolution(self):
+        self.assertIsNone(choose_rollup(timedelta(minutes=30)))
+        self.assertEqual(choose_rollup(timedelta(hours=1)), "hour")
+        self.assertEqual(choose_rollup(timedelta(hours=2)), "day")
+        self.assertEqual(choose_rollup(timedelta(days=3)), "month")
+        self.assertEqual(choose_rollup(timedelta(days=90)), "month")
+
+    def return_table(self, start, end, max_points, **kwargs):
+        """
+        Function returns table read by return_rollup_df().
+        """
+        queries = []
+        read_sql_query = mock.Mock(side_effect=lambda sql, **kw: queries.append(sql))
+        with mock.patch.object(rollups, "pd", mock.Mock(read_sql_query=read_sql_query)), \
+                mock.patch.object(rollups, "flags_exist", return_value=False):
+            return_rollup_df(mock.Mock(), start, end, max_points=max_points, **kwargs)
+        return queries[0].split("FROM")[1].split()[0]
+
+    def test_ranges_do_not_exceed_max_points(self):
+        start = datetime(2018, 1, 1)
+        cases = [(timedelta(days=1), 400, "readings"),
+                 (timedelta(days=31), 400, "public.readings_daily"),
+                 (timedelta(days=365), 400, "public.readings_daily"),
+                 (timedelta(days=365), 100, "public.readings_monthly"),
+                 (timedelta(days=31), 1000, "readings"),
+                 (timedelta(days=40), 960, "public.readings_hourly")]
+        for length, max_points, table in cases:
+            with self.subTest(days=length.days, max_points=max_points):
+                self.assertEqual(self.return_table(start, start + length, max_points, sensor_id=642),
+                                 table)
+
+    def test_parameter_tables(self):
+        start = datetime(2018, 1, 1)
+        self.assertEqual(self.return_table(start, datetime(2019, 1, 1), 12, parameter="PM10"),
+                         "public.parameter_readings_monthly")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -30,6 +30,13 @@ have been changed from 9, 10 to 4, 2 as follows:
   #define RX1 4
   #define TX1 2
 Sketch may not compile without this change.
+
+Readings are sampled every second and published once per
+BATCH_INTERVAL seconds as one binary message (min, mean and max
+of each channel, see haqs_batch.h) to DEVICE_ID "/haqs/batch" topic.
+Set PUBLISH_TEXT_TOPICS to 1 to publish per-second text messages
+(bme280/temp, pms7003/pm2pt5, ...) as well.
+RTC should be set to UTC, batches are timestamped with RTC time.
 Serial2 does not require redefinition.
 Further explanation can be found on Andreas Spiess account:
 https://www.youtube.com/watch?v=GwShqW39jlE
@@ -51,6 +58,7 @@ By default sensors uses following i2c addresses:
 #include <PubSubClient.h>  // MQTT library
 #include <WiFiMulti.h>
 #include "wifi_config.h"
+#include "haqs_batch.h"
 
 HardwareSerial Serial2(2);
 
@@ -58,6 +66,9 @@ HardwareSerial Serial2(2);
 #define I2C_SDA 21
 #define I2C_SCL 22
 #define BME280_ADDRESS 0x76
+#define DEVICE_ID "home"
+#define BATCH_INTERVAL 60  // seconds
+#define PUBLISH_TEXT_TOPICS 0
 /*
 If the sensor does not work, try the 0x77 address as well
 or try to scan your connection with i2c scanner
@@ -102,6 +113,9 @@ char pressure_msg[20];
 char pm1pt_msg[20];
 char pm2pt5_msg[20];
 char pm10pt_msg[20];
+haqs_batch_t batch;
+uint8_t batch_msg[HAQS_BATCH_MAX_SIZE];
+unsigned long batch_started = 0;
 
 void setup()
 {
@@ -139,6 +153,9 @@ void setup()
   // Configure MQTT server
   client.setServer(MQTT_SERVER, MQTT_PORT);
   client.setCallback(receivedCallback);
+
+  haqs_batch_reset(&batch, rtc.now().unixtime());
+  batch_started = millis();
 }
 
 void loop()
@@ -175,8 +192,11 @@ void loop()
     Serial2.print("Temperature (*C): ");
     Serial2.println(t);
     display.drawString(0, 20, "Temperature " + String(t) + " [*C]");
+    haqs_batch_add(&batch, HAQS_TEMPERATURE, t);
+#if PUBLISH_TEXT_TOPICS
     snprintf (temp_msg, 20, "%lf", t);
     client.publish("bme280/temp", temp_msg);
+#endif
   }
 
   if (!isnan(h))
@@ -184,8 +204,11 @@ void loop()
     Serial2.print("Humidity (%): ");
     Serial2.println(h);
     display.drawString(0, 30, "Humidity " + String(h) + " [%]");
+    haqs_batch_add(&batch, HAQS_HUMIDITY, h);
+#if PUBLISH_TEXT_TOPICS
     snprintf (humid_msg, 20, "%lf", h);
     client.publish("bme280/humid", humid_msg);
+#endif
   }
 
   if (!isnan(p))
@@ -193,8 +216,11 @@ void loop()
     Serial2.print("Pressure (hPa): ");
     Serial2.println(p);
     display.drawString(0, 40, "Pressure " + String(p) + " [hPa]");
+    haqs_batch_add(&batch, HAQS_PRESSURE, p);
+#if PUBLISH_TEXT_TOPICS
     snprintf (pressure_msg, 20, "%lf", p);
     client.publish("bme280/pressure", pressure_msg);
+#endif
   }
 
   // read from PMS7003
@@ -209,8 +235,11 @@ void loop()
       Serial2.print("PM 1.0 (ug/m3): ");
       Serial2.println(data.PM_AE_UG_1_0);
       //display.drawString(0, 50, "PM 1.0 " + String(data.PM_AE_UG_1_0) + " [ug/m3]");
+      haqs_batch_add(&batch, HAQS_PM1, pm1);
+#if PUBLISH_TEXT_TOPICS
       snprintf (pm1pt_msg, 20, "%lu", pm1);
       client.publish("pms7003/pm1pt", pm1pt_msg);
+#endif
     }
 
     if (!isnan(pm2_5))
@@ -218,8 +247,11 @@ void loop()
       Serial2.print("PM 2.5 (ug/m3): ");
       Serial2.println(data.PM_AE_UG_2_5);
       display.drawString(0, 50, "PM 2.5 " + String(data.PM_AE_UG_2_5) + " [ug/m3]");
+      haqs_batch_add(&batch, HAQS_PM2_5, pm2_5);
+#if PUBLISH_TEXT_TOPICS
       snprintf (pm2pt5_msg, 20, "%lu", pm2_5);
       client.publish("pms7003/pm2pt5", pm2pt5_msg);
+#endif
     }
 
     if (!isnan(pm1))
@@ -227,11 +259,17 @@ void loop()
       Serial2.print("PM 10.0 (ug/m3): ");
       Serial2.println(data.PM_AE_UG_10_0);
       //display.drawString(0, 50, "PM 10.0 " + String(data.PM_AE_UG_10_0) + " [ug/m3]");
+      haqs_batch_add(&batch, HAQS_PM10, pm10);
+#if PUBLISH_TEXT_TOPICS
       snprintf (pm10pt_msg, 20, "%lu", pm10);
       client.publish("pms7003/pm10pt", pm10pt_msg);
+#endif
     }
   }
 
+  haqs_batch_sample(&batch);
+  publishBatch();
+
   display.drawString(0, 80, "Home Air Monitoring Station");
 
   Serial2.println();
@@ -241,6 +279,21 @@ void loop()
 }
 
 
+void publishBatch()
+{
+  if (millis() - batch_started < BATCH_INTERVAL * 1000UL)
+  {
+    return;
+  }
+
+  size_t length = haqs_batch_encode(&batch, BATCH_INTERVAL, batch_msg);
+  client.publish(DEVICE_ID "/haqs/batch", batch_msg, length);
+
+  haqs_batch_reset(&batch, rtc.now().unixtime());
+  batch_started = millis();
+}
+
+
 void initBME280()
 {
   bool status = bme.begin(BME280_ADDRESS);
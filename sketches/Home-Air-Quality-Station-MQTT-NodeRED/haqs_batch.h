@@ -0,0 +1,123 @@
+/*
+Home Air Quality Station binary batch encoder.
+
+Samples collected during interval are aggregated into min, mean
+and max of each channel and encoded into one message, which is
+published to "<DEVICE_ID>/haqs/batch" topic.
+Format is described (and decoded) in python/haqs_api/home_protocol.py:
+
+  header (12 bytes, little-endian)
+    'H' 'Q'        magic
+    uint8_t        version (1)
+    uint8_t        channel mask, bit i set when channel i is present
+    uint32_t       timestamp of first sample, seconds since epoch
+    uint16_t       interval in seconds
+    uint16_t       number of samples
+  then for each present channel
+    float min, float mean, float max
+
+ESP32 is little-endian, so numbers are copied as they are.
+*/
+
+#ifndef HAQS_BATCH_H
+#define HAQS_BATCH_H
+
+#include <stdint.h>
+#include <string.h>
+#include <math.h>
+
+#define HAQS_BATCH_VERSION 1
+#define HAQS_HEADER_SIZE 12
+#define HAQS_CHANNEL_SIZE 12
+
+enum haqs_channel
+{
+  HAQS_TEMPERATURE = 0,
+  HAQS_HUMIDITY,
+  HAQS_PRESSURE,
+  HAQS_PM1,
+  HAQS_PM2_5,
+  HAQS_PM10,
+  HAQS_CHANNELS
+};
+
+#define HAQS_BATCH_MAX_SIZE (HAQS_HEADER_SIZE + HAQS_CHANNELS * HAQS_CHANNEL_SIZE)
+
+typedef struct
+{
+  float min;
+  float max;
+  float sum;
+  uint16_t count;
+} haqs_stats_t;
+
+typedef struct
+{
+  uint32_t timestamp;
+  uint16_t samples;
+  haqs_stats_t channels[HAQS_CHANNELS];
+} haqs_batch_t;
+
+static inline void haqs_batch_reset(haqs_batch_t *batch, uint32_t timestamp)
+{
+  memset(batch, 0, sizeof(*batch));
+  batch->timestamp = timestamp;
+}
+
+// adds one value of channel, NaN values are skipped
+static inline void haqs_batch_add(haqs_batch_t *batch, uint8_t channel, float value)
+{
+  if (channel >= HAQS_CHANNELS || isnan(value))
+  {
+    return;
+  }
+  haqs_stats_t *stats = &batch->channels[channel];
+  if (stats->count == 0 || value < stats->min)
+  {
+    stats->min = value;
+  }
+  if (stats->count == 0 || value > stats->max)
+  {
+    stats->max = value;
+  }
+  stats->sum += value;
+  stats->count++;
+}
+
+// marks end of one sampling loop
+static inline void haqs_batch_sample(haqs_batch_t *batch)
+{
+  batch->samples++;
+}
+
+// writes batch into out buffer (HAQS_BATCH_MAX_SIZE bytes), returns payload length
+static inline size_t haqs_batch_encode(const haqs_batch_t *batch, uint16_t interval, uint8_t *out)
+{
+  uint8_t mask = 0;
+  size_t length = HAQS_HEADER_SIZE;
+
+  for (uint8_t channel = 0; channel < HAQS_CHANNELS; channel++)
+  {
+    const haqs_stats_t *stats = &batch->channels[channel];
+    if (stats->count == 0)
+    {
+      continue;
+    }
+    float values[3] = {stats->min, stats->sum / stats->count, stats->max};
+    mask |= 1 << channel;
+    memcpy(out + length, values, sizeof(values));
+    length += HAQS_CHANNEL_SIZE;
+  }
+
+  out[0] = 'H';
+  out[1] = 'Q';
+  out[2] = HAQS_BATCH_VERSION;
+  out[3] = mask;
+  memcpy(out + 4, &batch->timestamp, 4);
+  memcpy(out + 8, &interval, 2);
+  memcpy(out + 10, &batch->samples, 2);
+
+  return length;
+}
+
+#endif
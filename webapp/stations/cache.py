@@ -0,0 +1,91 @@
+"""
+Pre-serialized responses for rarely changing tables.
+
+Each table is versioned by table_versions row which is bumped
+by DataBase trigger on every change (see migration 0002),
+so cached documents are invalidated no matter if stations were
+changed by Django or by haqs_api scripts.
+"""
+import gzip
+import hashlib
+from calendar import timegm
+
+from django.core.cache import cache
+from django.core.serializers import serialize
+from django.db import connection
+
+from .metrics import track_serialization
+from .models import Stations
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is used instead
+    brotli = None
+
+
+def table_version(table_name):
+    """
+    Function returns (version, modified_at timestamp) of table.
+    """
+    with connection.cursor() as cur:
+        cur.execute("SELECT version, modified_at FROM table_versions WHERE table_name = %s;",
+                    [table_name])
+        row = cur.fetchone()
+    if row is None:
+        return 0, None
+    return row[0], timegm(row[1].utctimetuple())
+
+
+def compressed_entry(body, last_modified=None):
+    """
+    Function returns cache entry with body in all supported encodings.
+    """
+    with track_serialization('gzip'):
+        entry = {
+            'etag': 'W/"{}"'.format(hashlib.sha1(body).hexdigest()),
+            'last_modified': last_modified,
+            'identity': body,
+            'gzip': gzip.compress(body, 9),
+        }
+    if brotli is not None:
+        with track_serialization('brotli'):
+            entry['br'] = brotli.compress(body, quality=11)
+    return entry
+
+
+def stations_geojson():
+    """
+    Function returns cached GeoJSON document with all stations.
+    Document is serialized again only when stations table changes.
+    """
+    version, last_modified = table_version('stations')
+    key = 'stations_geojson:{}'.format(version)
+    entry = cache.get(key)
+    if entry is None:
+        with track_serialization('geojson'):
+            body = serialize('geojson', Stations.objects.all()).encode('utf-8')
+        entry = compressed_entry(body, last_modified)
+        cache.set(key, entry, None)
+    return entry
+
+
+def preferred_encoding(accept_encoding, entry):
+    """
+    Function returns best encoding of entry accepted by client.
+    """
+    accepted = set()
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                pass
+        if quality > 0:
+            accepted.add(name.strip().lower())
+    for encoding in ('br', 'gzip'):
+        if encoding in entry and (encoding in accepted or '*' in accepted):
+            return encoding
+    return 'identity'
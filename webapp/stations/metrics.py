@@ -0,0 +1,131 @@
+"""
+Prometheus metrics of the webapp.
+
+MetricsMiddleware records latency of every request per view and
+status, and time of SQL statements executed while serving it
+(through connection.execute_wrapper). Serialization of cached
+documents is timed in cache module. Metrics are served in
+Prometheus text format by views.metrics.
+
+prometheus_client is optional, middleware does nothing and
+/metrics answers 501 when it is not installed. When Django runs
+in several processes, set PROMETHEUS_MULTIPROC_DIR so metrics
+of all processes are collected.
+
+Settings:
+    MIDDLEWARE = ['stations.metrics.MetricsMiddleware', ...]
+"""
+import os
+import re
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+try:
+    import prometheus_client
+except ImportError:  # prometheus_client is optional, metrics are disabled
+    prometheus_client = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_TARGET_RE = re.compile(r'\b(?:into|from|update)\s+(?:public\.)?"?(\w+)', re.IGNORECASE)
+
+if prometheus_client is not None:
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        'haqs_webapp_request_seconds', 'Request latency in seconds',
+        ['view', 'method', 'status'], buckets=LATENCY_BUCKETS)
+    REQUEST_EXCEPTIONS = prometheus_client.Counter(
+        'haqs_webapp_request_exceptions_total', 'Requests which raised exception',
+        ['view', 'reason'])
+    SQL_SECONDS = prometheus_client.Histogram(
+        'haqs_webapp_sql_seconds', 'SQL statement latency in seconds',
+        ['view', 'statement'], buckets=LATENCY_BUCKETS)
+    SQL_FAILURES = prometheus_client.Counter(
+        'haqs_webapp_sql_failures_total', 'Failed SQL statements',
+        ['view', 'statement', 'reason'])
+    SERIALIZATION_SECONDS = prometheus_client.Histogram(
+        'haqs_webapp_serialization_seconds', 'Serialization time in seconds',
+        ['format'], buckets=LATENCY_BUCKETS)
+
+
+def statement_of(sql):
+    """
+    Function returns low cardinality label of SQL statement,
+    its first keyword and first table, i.e. 'select:latest_readings'.
+    """
+    words = sql.split(None, 1)
+    if not words:
+        return 'empty'
+    target = _TARGET_RE.search(sql)
+    if target is None:
+        return words[0].lower()
+    return '{}:{}'.format(words[0].lower(), target.group(1).lower())
+
+
+@contextmanager
+def track_serialization(format):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if prometheus_client is not None:
+            SERIALIZATION_SECONDS.labels(format).observe(time.perf_counter() - start)
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.view_name or match.url_name or 'unnamed'
+
+
+class MetricsMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if prometheus_client is None:
+            return self.get_response(request)
+
+        def sql_timer(execute, sql, params, many, context):
+            start = time.perf_counter()
+            statement = statement_of(sql)
+            try:
+                return execute(sql, params, many, context)
+            except Exception as e:
+                SQL_FAILURES.labels(_view_name(request), statement, type(e).__name__).inc()
+                raise
+            finally:
+                SQL_SECONDS.labels(_view_name(request), statement).observe(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(sql_timer):
+            response = self.get_response(request)
+        REQUEST_SECONDS.labels(_view_name(request), request.method,
+                               response.status_code).observe(time.perf_counter() - start)
+        return response
+
+    def process_exception(self, request, exception):
+        # exceptions of views are turned into responses by Django,
+        # so they are counted here and not in __call__
+        if prometheus_client is not None:
+            REQUEST_EXCEPTIONS.labels(_view_name(request), type(exception).__name__).inc()
+
+
+def exposition():
+    """
+    Function returns (body, content_type) of all metrics
+    in Prometheus text format, None when prometheus_client
+    is not installed.
+    """
+    if prometheus_client is None:
+        return None
+    registry = prometheus_client.REGISTRY
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir'):
+        from prometheus_client import multiprocess
+
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,46 @@
+from django.db import migrations
+
+
+TABLE_VERSIONS_SQL = """
+    CREATE TABLE IF NOT EXISTS public.table_versions
+    (
+        table_name VARCHAR(63) PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 1,
+        modified_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+
+    CREATE OR REPLACE FUNCTION public.bump_table_version() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO public.table_versions (table_name, version, modified_at)
+        VALUES (TG_TABLE_NAME, 1, now())
+        ON CONFLICT (table_name) DO UPDATE
+        SET version = table_versions.version + 1, modified_at = now();
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS stations_bump_version ON public.stations;
+    CREATE TRIGGER stations_bump_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.stations
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.bump_table_version();
+
+    INSERT INTO public.table_versions (table_name) VALUES ('stations')
+    ON CONFLICT (table_name) DO NOTHING;
+"""
+
+DROP_TABLE_VERSIONS_SQL = """
+    DROP TRIGGER IF EXISTS stations_bump_version ON public.stations;
+    DROP FUNCTION IF EXISTS public.bump_table_version();
+    DROP TABLE IF EXISTS public.table_versions;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stations', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunSQL(TABLE_VERSIONS_SQL, DROP_TABLE_VERSIONS_SQL),
+    ]
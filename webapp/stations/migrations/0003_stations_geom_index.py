@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stations', '0002_table_versions'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX IF NOT EXISTS stations_geom_gist ON public.stations USING GIST (geom);",
+            "DROP INDEX IF EXISTS public.stations_geom_gist;",
+        ),
+    ]
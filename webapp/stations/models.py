@@ -23,11 +23,27 @@ class Sensors(models.Model):
 
 
 class Readings(models.Model):
-    sensor = models.ForeignKey('Sensors', models.DO_NOTHING, blank=True, null=True)
-    date = models.CharField(max_length=19)
+    id = models.BigAutoField(primary_key=True)
+    sensor = models.ForeignKey('Sensors', models.DO_NOTHING)
+    ts = models.DateTimeField()
     reading = models.FloatField(blank=True, null=True)
 
     class Meta:
         verbose_name_plural = "Reading"
         managed = False
         db_table = 'readings'
+        unique_together = (('sensor', 'ts'),)
+
+
+class LatestReadings(models.Model):
+    sensor = models.OneToOneField('Sensors', models.DO_NOTHING, primary_key=True)
+    sensor_parameter = models.CharField(max_length=10)
+    station = models.ForeignKey('Stations', models.DO_NOTHING)
+    ts = models.DateTimeField()
+    reading = models.FloatField()
+    geom = models.PointField(srid=4326)
+
+    class Meta:
+        verbose_name_plural = "Latest reading"
+        managed = False
+        db_table = 'latest_readings'
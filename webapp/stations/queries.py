@@ -0,0 +1,205 @@
+"""
+Raw SQL queries used by map endpoints.
+
+Latest reading of every sensor is read from latest_readings
+materialized view maintained by haqs_api ingestion, stations
+are filtered by bounding box through its GiST index on geom.
+At low zoom levels stations are clustered on a grid, so number
+of returned features depends on map size rather than on number
+of stations.
+Nearest sensors of a location are found with KNN ordering
+over geography GiST index of the same view.
+"""
+from django.db import connection
+
+# zoom levels below CLUSTER_ZOOM return clustered features
+CLUSTER_ZOOM = 9
+# clusters are built on grid of TILE_SIZE / CLUSTER_CELL pixels
+CLUSTER_CELL = 64
+TILE_SIZE = 256
+MVT_EXTENT = 4096
+WEB_MERCATOR_HALF = 20037508.342789244
+
+LATEST_READINGS_SQL = """
+    SELECT station_id, sensor_id, geom, ts, reading
+    FROM latest_readings
+    WHERE sensor_parameter = %(parameter)s
+        AND geom && {envelope}
+"""
+
+
+def cluster_cell_size(zoom, world_size=360.0):
+    """
+    Function returns grid cell size used to cluster
+    stations at given zoom, in world_size units.
+    """
+    return world_size / (2 ** zoom) * CLUSTER_CELL / TILE_SIZE
+
+
+def readings_geojson(parameter, bbox, zoom):
+    """
+    Function returns GeoJSON FeatureCollection (bytes)
+    with latest readings of parameter within bbox.
+
+    Args:
+        parameter (string):
+            one of GIOŚ parameters, i.e. 'PM10'
+
+        bbox (tuple):
+            (min_lon, min_lat, max_lon, max_lat)
+
+        zoom (int):
+            map zoom level, stations are clustered
+            below CLUSTER_ZOOM
+    """
+    latest = LATEST_READINGS_SQL.format(
+        envelope="ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 4326)")
+    params = {'parameter': parameter, 'xmin': bbox[0], 'ymin': bbox[1],
+              'xmax': bbox[2], 'ymax': bbox[3]}
+
+    if zoom < CLUSTER_ZOOM:
+        params['cell'] = cluster_cell_size(zoom)
+        sql = """
+            SELECT ST_AsGeoJSON(ST_Centroid(ST_Collect(geom)), 5),
+                json_build_object('count', count(*),
+                                  'reading', round(avg(reading)::numeric, 2),
+                                  'max', max(reading),
+                                  'ts', max(ts))
+            FROM ({latest}) latest
+            GROUP BY ST_SnapToGrid(geom, %(cell)s)
+        """.format(latest=latest)
+    else:
+        sql = """
+            SELECT ST_AsGeoJSON(geom, 6),
+                json_build_object('count', 1,
+                                  'station_id', station_id,
+                                  'sensor_id', sensor_id,
+                                  'reading', reading,
+                                  'ts', ts)
+            FROM ({latest}) latest
+        """.format(latest=latest)
+
+    sql = """
+        SELECT json_build_object('type', 'FeatureCollection',
+                                 'features', coalesce(json_agg(json_build_object(
+                                     'type', 'Feature',
+                                     'geometry', features.geometry::json,
+                                     'properties', features.properties)), '[]'::json))::text
+        FROM ({}) AS features (geometry, properties)
+    """.format(sql)
+
+    with connection.cursor() as cur:
+        cur.execute(sql, params)
+        return cur.fetchone()[0].encode('utf-8')
+
+
+def tile_envelope(z, x, y):
+    """
+    Function returns Web Mercator bounds of XYZ tile.
+    """
+    size = 2 * WEB_MERCATOR_HALF / (2 ** z)
+    xmin = -WEB_MERCATOR_HALF + x * size
+    ymax = WEB_MERCATOR_HALF - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def readings_mvt(parameter, z, x, y):
+    """
+    Function returns Mapbox Vector Tile (bytes) with latest
+    readings of parameter, layer is named 'readings'.
+    """
+    xmin, ymin, xmax, ymax = tile_envelope(z, x, y)
+    latest = LATEST_READINGS_SQL.format(
+        envelope="ST_Transform(ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 3857), 4326)")
+    params = {'parameter': parameter, 'xmin': xmin, 'ymin': ymin,
+              'xmax': xmax, 'ymax': ymax, 'extent': MVT_EXTENT}
+
+    if z < CLUSTER_ZOOM:
+        params['cell'] = cluster_cell_size(z, 2 * WEB_MERCATOR_HALF)
+        columns = 'count, reading, max, ts'
+        features = """
+            SELECT ST_Centroid(ST_Collect(geom)) AS geom, count(*) AS count,
+                avg(reading) AS reading, max(reading) AS max,
+                extract(epoch from max(ts))::bigint AS ts
+            FROM (SELECT ST_Transform(geom, 3857) AS geom, reading, ts
+                  FROM ({latest}) latest) latest
+            GROUP BY ST_SnapToGrid(geom, %(cell)s)
+        """.format(latest=latest)
+    else:
+        columns = 'count, station_id, sensor_id, reading, ts'
+        features = """
+            SELECT ST_Transform(geom, 3857) AS geom, 1 AS count,
+                station_id, sensor_id, reading,
+                extract(epoch from ts)::bigint AS ts
+            FROM ({latest}) latest
+        """.format(latest=latest)
+
+    sql = """
+        SELECT ST_AsMVT(tile, 'readings', %(extent)s, 'geom')
+        FROM
+        (
+            SELECT ST_AsMVTGeom(features.geom,
+                                ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 3857),
+                                %(extent)s, 64, true) AS geom,
+                {columns}
+            FROM ({features}) features
+        ) tile
+    """.format(columns=columns, features=features)
+
+    with connection.cursor() as cur:
+        cur.execute(sql, params)
+        tile = cur.fetchone()[0]
+    return bytes(tile) if tile is not None else b''
+
+
+def nearest_json(lat, lon, k, parameters=None):
+    """
+    Function returns JSON list (bytes) of k nearest sensors
+    of each parameter with their latest readings and distances
+    in meters, nearest first. Every parameter is answered
+    by single KNN scan of latest_readings geography index.
+
+    Args:
+        lat, lon (float):
+            location in WGS84 degrees
+
+        k (int):
+            number of sensors per parameter
+
+        parameters (list) - default None:
+            GIOŚ parameters, all available parameters when None
+    """
+    if parameters is None:
+        parameters_sql = "SELECT DISTINCT sensor_parameter FROM latest_readings"
+    else:
+        parameters_sql = "SELECT unnest(%(parameters)s::varchar[])"
+
+    sql = """
+        WITH location AS
+        (
+            SELECT ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326)::geography AS geog
+        )
+        SELECT coalesce(json_agg(json_build_object(
+                   'parameter', parameters.parameter,
+                   'station_id', nearest.station_id,
+                   'sensor_id', nearest.sensor_id,
+                   'distance', round(ST_Distance(nearest.geog, location.geog)::numeric, 1),
+                   'reading', nearest.reading,
+                   'ts', nearest.ts)
+               ORDER BY parameters.parameter, ST_Distance(nearest.geog, location.geog)),
+               '[]'::json)::text
+        FROM location
+        CROSS JOIN ({parameters}) AS parameters (parameter)
+        CROSS JOIN LATERAL
+        (
+            SELECT station_id, sensor_id, reading, ts, geom::geography AS geog
+            FROM latest_readings
+            WHERE sensor_parameter = parameters.parameter
+            ORDER BY geom::geography <-> location.geog
+            LIMIT %(k)s
+        ) nearest
+    """.format(parameters=parameters_sql)
+
+    with connection.cursor() as cur:
+        cur.execute(sql, {'lat': lat, 'lon': lon, 'k': k, 'parameters': parameters})
+        return cur.fetchone()[0].encode('utf-8')
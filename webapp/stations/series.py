@@ -0,0 +1,241 @@
+"""
+Downsampled time series of station readings for charts.
+
+Series are read from rollup tables maintained by haqs_api
+ingestion (readings_hourly, readings_daily), raw readings are
+used for buckets shorter than one hour or when rollups were not
+created. Raw readings flagged by haqs_api anomaly detection
+(reading_flags table) are skipped, as they are in rollups.
+Two downsampling modes are available:
+
+    minmax - requested range is split into equal buckets, mean
+             (weighted by count), min and max of every bucket are
+             computed in SQL, so spikes are never lost
+    lttb   - Largest-Triangle-Three-Buckets selection of hourly
+             (daily for ranges longer than LTTB_MAX_HOURS) means,
+             computed with NumPy, keeps visual shape of the line
+
+Timestamps are returned as epoch seconds (bucket starts).
+"""
+import numpy as np
+from django.db import connection
+
+from .metrics import track_serialization
+
+# longest range (in hours) which LTTB reads from hourly rollup
+LTTB_MAX_HOURS = 5 * 366 * 24
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+RAW_SOURCE = ('readings', 'ts', 'reading', 'reading', 'reading', '1')
+
+UNFLAGGED_SQL = """
+            AND NOT EXISTS (SELECT 1 FROM public.reading_flags
+                            WHERE reading_flags.sensor_id = readings.sensor_id
+                                AND reading_flags.ts = readings.ts)"""
+
+
+def rollups_exist():
+    """
+    Function returns True when haqs_api rollup tables exist.
+    """
+    with connection.cursor() as cur:
+        cur.execute("SELECT to_regclass('public.readings_hourly') IS NOT NULL;")
+        return cur.fetchone()[0]
+
+
+def flags_exist():
+    """
+    Function returns True when haqs_api reading_flags table exists.
+    """
+    with connection.cursor() as cur:
+        cur.execute("SELECT to_regclass('public.reading_flags') IS NOT NULL;")
+        return cur.fetchone()[0]
+
+
+def _unflagged(table):
+    """
+    Function returns condition skipping flagged readings
+    of raw readings table, rollups are already filtered.
+    """
+    return UNFLAGGED_SQL if table == RAW_SOURCE[0] and flags_exist() else ''
+
+
+def sensor_of(station_id, parameter):
+    """
+    Function returns sensor_id of station measuring
+    parameter, None when there is no such sensor.
+    """
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT sensor_id FROM sensors
+            WHERE station_id = %s AND sensor_parameter = %s
+            ORDER BY sensor_id LIMIT 1;
+        """, [station_id, parameter])
+        row = cur.fetchone()
+    return row[0] if row is not None else None
+
+
+def _source(width, with_rollups):
+    """
+    Function returns (table, time, mean, min, max, count) columns
+    of coarsest source which buckets fit into width seconds.
+    """
+    if with_rollups and width >= DAY:
+        return ('readings_daily', 'bucket', 'mean', 'min', 'max', 'count')
+    if with_rollups and width >= HOUR:
+        return ('readings_hourly', 'bucket', 'mean', 'min', 'max', 'count')
+    return RAW_SOURCE
+
+
+def minmax_series(sensor_id, start, end, points):
+    """
+    Function returns series of points equal buckets
+    between start and end, empty buckets are skipped.
+
+    Returns:
+        series (dict):
+            bucket_seconds and ts, mean, min, max
+            and count arrays
+    """
+    width = max((end - start).total_seconds() / points, 1.0)
+    table, ts, mean, low, high, count = _source(width, rollups_exist())
+    sql = """
+        SELECT floor(extract(epoch from {ts} - %(start)s) / %(width)s)::int AS slot,
+            sum({mean} * {count}) / sum({count}), min({low}), max({high}), sum({count})
+        FROM {table}
+        WHERE sensor_id = %(sensor_id)s
+            AND {ts} >= %(start)s AND {ts} < %(end)s
+            AND {mean} IS NOT NULL{unflagged}
+        GROUP BY slot
+        ORDER BY slot;
+    """.format(table=table, ts=ts, mean=mean, low=low, high=high, count=count,
+               unflagged=_unflagged(table))
+
+    with connection.cursor() as cur:
+        cur.execute(sql, {'sensor_id': sensor_id, 'start': start, 'end': end, 'width': width})
+        rows = np.array(cur.fetchall(), dtype=float).reshape(-1, 5)
+
+    return {'bucket_seconds': width,
+            'ts': start.timestamp() + rows[:, 0] * width,
+            'mean': rows[:, 1],
+            'min': rows[:, 2],
+            'max': rows[:, 3],
+            'count': rows[:, 4].astype(np.int64)}
+
+
+def lttb(x, y, threshold):
+    """
+    Function returns indices of threshold points selected
+    by Largest-Triangle-Three-Buckets algorithm, first
+    and last points are always selected.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # bucket i covers [edges[i], edges[i + 1]), first and last point are buckets of their own
+    edges = (np.floor(np.arange(threshold - 1) * (n - 2) / (threshold - 2)) + 1).astype(np.int64)
+    edges[-1] = n - 1
+    cx = np.concatenate([[0.0], np.cumsum(x)])
+    cy = np.concatenate([[0.0], np.cumsum(y)])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_stop = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_stop = n - 1, n
+        size = next_stop - next_start
+        avg_x = (cx[next_stop] - cx[next_start]) / size
+        avg_y = (cy[next_stop] - cy[next_start]) / size
+
+        area = np.abs((x[a] - avg_x) * (y[start:stop] - y[a])
+                      - (x[a] - x[start:stop]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def lttb_series(sensor_id, start, end, points):
+    """
+    Function returns at most points (ts, value) pairs
+    of hourly (or daily) means selected by LTTB.
+
+    Returns:
+        series (dict):
+            bucket_seconds and ts, value arrays
+    """
+    hours = (end - start).total_seconds() / HOUR
+    with_rollups = rollups_exist()
+    width = DAY if hours > LTTB_MAX_HOURS else HOUR
+    table, ts, mean, _, _, _ = _source(width, with_rollups)
+    sql = """
+        SELECT extract(epoch from {ts}), {mean}
+        FROM {table}
+        WHERE sensor_id = %(sensor_id)s
+            AND {ts} >= %(start)s AND {ts} < %(end)s
+            AND {mean} IS NOT NULL{unflagged}
+        ORDER BY {ts};
+    """.format(table=table, ts=ts, mean=mean, unflagged=_unflagged(table))
+
+    with connection.cursor() as cur:
+        cur.execute(sql, {'sensor_id': sensor_id, 'start': start, 'end': end})
+        rows = np.array(cur.fetchall(), dtype=float).reshape(-1, 2)
+
+    selected = lttb(rows[:, 0], rows[:, 1], points)
+    return {'bucket_seconds': width if table != 'readings' else None,
+            'ts': rows[selected, 0],
+            'value': rows[selected, 1]}
+
+
+def series_columns(series):
+    """
+    Function returns list of (name, array) columns of series.
+    """
+    names = ('ts', 'mean', 'min', 'max', 'count') if 'mean' in series else ('ts', 'value')
+    return [(name, series[name]) for name in names]
+
+
+def series_json(meta, series, decimals=3):
+    """
+    Function returns compact JSON (bytes) with meta fields
+    and one array per column, timestamps in epoch seconds.
+    """
+    import json
+
+    with track_serialization('series_json'):
+        document = dict(meta, bucket_seconds=series['bucket_seconds'])
+        for name, values in series_columns(series):
+            if name in ('ts', 'count'):
+                document[name] = values.astype(np.int64).tolist()
+            else:
+                document[name] = np.round(values, decimals).tolist()
+        return json.dumps(document, separators=(',', ':')).encode('utf-8')
+
+
+def series_arrow(meta, series):
+    """
+    Function returns Arrow IPC stream (bytes) with series
+    columns, meta fields are stored in schema metadata.
+    pyarrow is required.
+    """
+    import pyarrow as pa
+
+    with track_serialization('series_arrow'):
+        columns = series_columns(series)
+        arrays = [pa.array(values.astype(np.int64) if name in ('ts', 'count')
+                           else values.astype(np.float32)) for name, values in columns]
+        metadata = {key: str(value)
+                    for key, value in dict(meta, bucket_seconds=series['bucket_seconds']).items()}
+        table = pa.Table.from_arrays(arrays, names=[name for name, _ in columns])
+        table = table.replace_schema_metadata(metadata)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
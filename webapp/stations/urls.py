@@ -7,4 +7,9 @@ app_name = 'stations'
 urlpatterns = [
     url(r'^$', views.HomePageView.as_view(), name='home'),
     url(r'^stations_data/', views.stations_dataset, name='stations'),
+    url(r'^readings_data/', views.readings_dataset, name='readings'),
+    url(r'^nearest/', views.nearest_dataset, name='nearest'),
+    url(r'^stations/(?P<station_id>[0-9]+)/series$', views.station_series, name='station-series'),
+    url(r'^metrics$', views.metrics, name='metrics'),
+    url(r'^tiles/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)\.mvt$', views.readings_tile, name='readings-tile'),
 ]
\ No newline at end of file
@@ -1,14 +1,203 @@
+import gzip
+import math
+from datetime import datetime, timedelta, timezone
+
 from django.views.generic import TemplateView
 from django.shortcuts import render
-from django.core.serializers import serialize
-from django.http import HttpResponse
-from .models import Stations
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import http_date
+from . import metrics as webapp_metrics
+from .cache import preferred_encoding, stations_geojson
+from .queries import nearest_json, readings_geojson, readings_mvt
+from . import series
+
+MAX_NEAREST = 20
+MAX_ZOOM = 22
+DEFAULT_POINTS = 500
+MAX_POINTS = 5000
+SERIES_MODES = ('minmax', 'lttb')
+SERIES_FORMATS = {'json': 'application/json',
+                  'arrow': 'application/vnd.apache.arrow.stream'}
 
 
 class HomePageView(TemplateView):
     template_name = 'stations/index.html'
 
 
+def cached_response(request, entry, content_type='application/json'):
+    """
+    Function returns response with cached entry in encoding
+    preferred by client, or 304 Not Modified when client
+    already has current version.
+    """
+    response = get_conditional_response(request, etag=entry['etag'],
+                                        last_modified=entry['last_modified'])
+    if response is None:
+        encoding = preferred_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''), entry)
+        response = HttpResponse(entry[encoding], content_type=content_type)
+        if encoding != 'identity':
+            response['Content-Encoding'] = encoding
+
+    response['ETag'] = entry['etag']
+    if entry['last_modified'] is not None:
+        response['Last-Modified'] = http_date(entry['last_modified'])
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = 'public, no-cache'
+    return response
+
+
 def stations_dataset(request):
-    stations = serialize('geojson', Stations.objects.all())
-    return HttpResponse(stations, content_type='json')
+    return cached_response(request, stations_geojson())
+
+
+def readings_dataset(request):
+    """
+    Returns GeoJSON with latest readings of selected parameter
+    within map bounding box. Request parameters:
+        bbox - min_lon,min_lat,max_lon,max_lat
+        parameter - default PM10
+        zoom - default 10, stations are clustered at low zoom levels
+    """
+    try:
+        bbox = [float(value) for value in request.GET['bbox'].split(',')]
+        zoom = int(request.GET.get('zoom', 10))
+        if len(bbox) != 4 or not all(math.isfinite(value) for value in bbox):
+            raise ValueError
+        if not 0 <= zoom <= MAX_ZOOM:
+            raise ValueError
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('bbox=min_lon,min_lat,max_lon,max_lat and '
+                                      'zoom (0-{}) are expected'.format(MAX_ZOOM))
+    parameter = request.GET.get('parameter', 'PM10')
+
+    response = HttpResponse(readings_geojson(parameter, bbox, zoom),
+                            content_type='application/json')
+    response['Cache-Control'] = 'public, max-age=300'
+    return response
+
+
+def nearest_dataset(request):
+    """
+    Returns JSON list with k nearest sensors of each parameter,
+    their latest readings and distances in meters. Request parameters:
+        lat, lon - location
+        k - default 3, at most MAX_NEAREST
+        parameter - optional, can be repeated
+    """
+    try:
+        lat = float(request.GET['lat'])
+        lon = float(request.GET['lon'])
+        k = int(request.GET.get('k', 3))
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180 and 0 < k <= MAX_NEAREST):
+            raise ValueError
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('lat, lon and k (1-{}) are required'.format(MAX_NEAREST))
+    parameters = request.GET.getlist('parameter') or None
+
+    response = HttpResponse(nearest_json(lat, lon, k, parameters),
+                            content_type='application/json')
+    response['Cache-Control'] = 'public, max-age=300'
+    return response
+
+
+def parse_timestamp(value):
+    """
+    Function returns aware datetime of ISO 8601 date or
+    datetime, naive values are UTC. Raises ValueError.
+    """
+    timestamp = parse_datetime(value)
+    if timestamp is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(value)
+        timestamp = datetime(date.year, date.month, date.day)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+
+def station_series(request, station_id):
+    """
+    Returns downsampled readings of station. Request parameters:
+        parameter - default PM10
+        start, end - ISO 8601 dates, default last 365 days
+        points - default DEFAULT_POINTS, at most MAX_POINTS
+        mode - minmax (default, mean/min/max buckets) or lttb
+        format - json (default) or arrow, arrow requires pyarrow
+    """
+    try:
+        end = parse_timestamp(request.GET['end']) if 'end' in request.GET else datetime.now(timezone.utc)
+        start = parse_timestamp(request.GET['start']) if 'start' in request.GET else end - timedelta(days=365)
+        points = int(request.GET.get('points', DEFAULT_POINTS))
+        mode = request.GET.get('mode', 'minmax')
+        format = request.GET.get('format', 'json')
+        if not (start < end and 2 < points <= MAX_POINTS
+                and mode in SERIES_MODES and format in SERIES_FORMATS):
+            raise ValueError
+    except ValueError:
+        return HttpResponseBadRequest('start < end (ISO 8601), points (3-{}), mode ({}) '
+                                      'and format ({}) are expected'.format(
+                                          MAX_POINTS, '|'.join(SERIES_MODES), '|'.join(SERIES_FORMATS)))
+    if format == 'arrow':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return HttpResponse('pyarrow is not installed', status=501, content_type='text/plain')
+    parameter = request.GET.get('parameter', 'PM10')
+
+    sensor_id = series.sensor_of(int(station_id), parameter)
+    if sensor_id is None:
+        return HttpResponseNotFound('Station {} does not measure {}'.format(station_id, parameter))
+    if mode == 'lttb':
+        data = series.lttb_series(sensor_id, start, end, points)
+    else:
+        data = series.minmax_series(sensor_id, start, end, points)
+
+    meta = {'station_id': int(station_id), 'sensor_id': sensor_id, 'parameter': parameter,
+            'mode': mode, 'start': start.isoformat(), 'end': end.isoformat()}
+    if format == 'arrow':
+        body = series.series_arrow(meta, data)
+    else:
+        body = series.series_json(meta, data)
+
+    response = HttpResponse(content_type=SERIES_FORMATS[format])
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        with webapp_metrics.track_serialization('gzip'):
+            body = gzip.compress(body, 6)
+        response['Content-Encoding'] = 'gzip'
+    response.content = body
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = 'public, max-age=300'
+    return response
+
+
+def metrics(request):
+    """
+    Returns metrics in Prometheus text format.
+    """
+    exposition = webapp_metrics.exposition()
+    if exposition is None:
+        return HttpResponse('prometheus_client is not installed', status=501,
+                            content_type='text/plain')
+    body, content_type = exposition
+    response = HttpResponse(body, content_type=content_type)
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+def readings_tile(request, z, x, y):
+    """
+    Returns Mapbox Vector Tile with latest readings
+    of parameter (default PM10) in 'readings' layer.
+    """
+    z, x, y = int(z), int(x), int(y)
+    if not 0 <= z <= MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        return HttpResponseBadRequest('Tile out of range')
+    parameter = request.GET.get('parameter', 'PM10')
+
+    response = HttpResponse(readings_mvt(parameter, z, x, y),
+                            content_type='application/vnd.mapbox-vector-tile')
+    response['Cache-Control'] = 'public, max-age=300'
+    return response